@@ -0,0 +1,333 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger("almacen")
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    last_seen INTEGER NOT NULL
+)'''
+
+INSERT_USER = "INSERT INTO users (username, password, last_seen) VALUES (?, ?, ?)"
+SELECT_PASSWORD = "SELECT password FROM users WHERE username=?"
+UPDATE_LAST_SEEN = "UPDATE users SET last_seen=? WHERE username=?"
+UPDATE_PASSWORD = "UPDATE users SET password=? WHERE username=?"
+SELECT_USERNAMES = "SELECT username FROM users ORDER BY username"
+
+# Server-side store-and-forward queue for users who are offline. Rows are
+# read and pruned per recipient in id order through the index, so a
+# delivery page and a cumulative ack are both range scans.
+OUTBOX_SCHEMA = '''CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    body TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    ts REAL NOT NULL
+)'''
+OUTBOX_INDEX = "CREATE INDEX IF NOT EXISTS outbox_recipient_id ON outbox (recipient, id)"
+OUTBOX_MAX_MESSAGES = 1000      # queued per recipient
+OUTBOX_MAX_BYTES = 1024 * 1024  # queued body bytes per recipient
+
+INSERT_OUTBOX = "INSERT INTO outbox (recipient, sender, body, size, ts) VALUES (?, ?, ?, ?, ?)"
+SELECT_OUTBOX = "SELECT id, sender, body, ts FROM outbox WHERE recipient=? AND id>? ORDER BY id LIMIT ?"
+SUM_OUTBOX = "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outbox WHERE recipient=?"
+COUNT_OUTBOX_BY_RECIPIENT = "SELECT recipient, COUNT(*) FROM outbox GROUP BY recipient"
+DELETE_OUTBOX_UPTO = "DELETE FROM outbox WHERE recipient=? AND id<=?"
+
+# Client-side chat history. Append-only; read newest first through the
+# (peer, ts) index, with (ts, id) as the keyset cursor for older pages.
+MESSAGES_SCHEMA = '''CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    type TEXT NOT NULL,
+    text TEXT,
+    caption TEXT,
+    path TEXT,
+    ts REAL NOT NULL
+)'''
+MESSAGES_INDEX = "CREATE INDEX IF NOT EXISTS messages_peer_ts ON messages (peer, ts)"
+
+INSERT_MESSAGE = "INSERT INTO messages (peer, sender, type, text, caption, path, ts) VALUES (?, ?, ?, ?, ?, ?, ?)"
+SELECT_LATEST = ("SELECT id, sender, type, text, caption, path, ts FROM messages "
+                 "WHERE peer=? ORDER BY ts DESC, id DESC LIMIT ?")
+SELECT_BEFORE = ("SELECT id, sender, type, text, caption, path, ts FROM messages "
+                 "WHERE peer=? AND ts <= ? AND (ts < ? OR id < ?) ORDER BY ts DESC, id DESC LIMIT ?")
+
+
+POOL_SIZE = 8  # SQLite connections per store, whatever the number of threads
+
+
+# At most `size` connections, shared by every thread: an operation checks
+# one out and gives it back, so open connections (with their WAL handles
+# and statement caches) do not grow with the number of client threads.
+# sqlite3 keeps the compiled statements of each connection in its
+# statement cache, so the constant SQL strings above are only prepared
+# once per pooled connection.
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        conn = sqlite3.connect(self.path, timeout=5, cached_statements=64, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Closes the idle connections; call once no operation is running.
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# observe(op, seconds), when given, is called with the latency of every
+# query so the server can export it.
+class Store:
+    def __init__(self, path, flush_interval=0.05, observe=None,
+                 outbox_max_messages=OUTBOX_MAX_MESSAGES, outbox_max_bytes=OUTBOX_MAX_BYTES, pool_size=POOL_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.observe = observe
+        self.pool = ConnectionPool(path, pool_size)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=1024)
+        self.writes = 0
+        self.rows_written = 0
+        self.max_latency = 0.0
+        self.last_batch = 0
+        self.closed = threading.Event()
+        self.outbox_max_messages = outbox_max_messages
+        self.outbox_max_bytes = outbox_max_bytes
+        self.waiting = {}  # recipient -> queued messages, see outbox_count
+        self.waiting_lock = threading.Lock()
+
+        with self.pool.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+            conn.execute(OUTBOX_SCHEMA)
+            conn.execute(OUTBOX_INDEX)
+            conn.commit()
+            self.waiting = dict(conn.execute(COUNT_OUTBOX_BY_RECIPIENT).fetchall())
+
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def _record_write(self, op, started, rows):
+        elapsed = time.perf_counter() - started
+        if self.observe:
+            self.observe(op, elapsed)
+        with self.stats_lock:
+            self.latencies.append(elapsed)
+            self.writes += 1
+            self.rows_written += rows
+            self.max_latency = max(self.max_latency, elapsed)
+            self.last_batch = rows
+
+    # `password` is what gets stored: the server passes a
+    # credenciales.hash_password() string.
+    def register(self, username, password):
+        started = time.perf_counter()
+        try:
+            with self.pool.connection() as conn, conn:
+                conn.execute(INSERT_USER, (username, password, int(time.time())))
+        except sqlite3.IntegrityError:
+            return False, "Username exists"
+        self._record_write("register", started, 1)
+        return True, "Registered"
+
+    # The stored password hash (or plain password, for rows from before
+    # hashing), or None for an unknown user.
+    def password_hash(self, username):
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            row = conn.execute(SELECT_PASSWORD, (username,)).fetchone()
+        if self.observe:
+            self.observe("password_hash", time.perf_counter() - started)
+        return row[0] if row else None
+
+    def set_password(self, username, password):
+        started = time.perf_counter()
+        with self.pool.connection() as conn, conn:
+            conn.execute(UPDATE_PASSWORD, (password, username))
+        self._record_write("set_password", started, 1)
+
+    def usernames(self):
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            names = [row[0] for row in conn.execute(SELECT_USERNAMES)]
+        if self.observe:
+            self.observe("usernames", time.perf_counter() - started)
+        return names
+
+    # Queues `body` (an encoded message) for `recipient`. Returns the row
+    # id, or None when it would take the recipient over its quota. The
+    # quota is read from the table through the recipient index inside the
+    # same IMMEDIATE transaction as the insert, so concurrent senders (in
+    # this process or another one on the same file) cannot overshoot it.
+    def outbox_put(self, recipient, sender, body, ts=None):
+        size = len(body)
+        started = time.perf_counter()
+        with self.pool.connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            count, used = conn.execute(SUM_OUTBOX, (recipient,)).fetchone()
+            if count >= self.outbox_max_messages or used + size > self.outbox_max_bytes:
+                return None
+            cur = conn.execute(INSERT_OUTBOX, (recipient, sender, body, size, ts or time.time()))
+        with self.waiting_lock:
+            self.waiting[recipient] = self.waiting.get(recipient, 0) + 1
+        self._record_write("outbox_put", started, 1)
+        return cur.lastrowid
+
+    # Queued messages for `recipient` after id `after`, oldest first, as
+    # (id, sender, body, ts) rows.
+    def outbox_page(self, recipient, after=0, limit=500):
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            rows = conn.execute(SELECT_OUTBOX, (recipient, after, limit)).fetchall()
+        if self.observe:
+            self.observe("outbox_page", time.perf_counter() - started)
+        return rows
+
+    # Cumulative ack: deletes everything queued for `recipient` up to and
+    # including `upto` in one statement. Returns the number of rows removed.
+    def outbox_ack(self, recipient, upto):
+        started = time.perf_counter()
+        with self.pool.connection() as conn, conn:
+            count = conn.execute(DELETE_OUTBOX_UPTO, (recipient, upto)).rowcount
+        if count:
+            with self.waiting_lock:
+                left = self.waiting.get(recipient, 0) - count
+                if left > 0:
+                    self.waiting[recipient] = left
+                else:
+                    self.waiting.pop(recipient, None)
+        self._record_write("outbox_ack", started, count)
+        return count
+
+    # Messages waiting for `recipient`, from memory: counted once from the
+    # table at startup and kept by outbox_put/outbox_ack, so the server can
+    # ask from its event loop without touching SQLite. The quota itself
+    # is still checked against the table (see outbox_put); rows another
+    # process adds to the same file are only counted after a restart.
+    def outbox_count(self, recipient):
+        with self.waiting_lock:
+            return self.waiting.get(recipient, 0)
+
+    def outbox_pending(self):
+        with self.waiting_lock:
+            return sum(self.waiting.values())
+
+    def touch(self, username, ts=None):
+        with self.pending_lock:
+            self.pending[username] = int(ts or time.time())
+
+    def touch_many(self, usernames, ts=None):
+        ts = int(ts or time.time())
+        with self.pending_lock:
+            self.pending.update(dict.fromkeys(usernames, ts))
+
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        with self.pool.connection() as conn, conn:
+            conn.executemany(UPDATE_LAST_SEEN, [(ts, user) for user, ts in batch.items()])
+        self._record_write("flush_last_seen", started, len(batch))
+        return len(batch)
+
+    def _writer_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.error("last_seen flush failed: %s", e)
+
+    def stats(self):
+        with self.stats_lock:
+            samples = sorted(self.latencies)
+            result = {
+                "writes": self.writes,
+                "rows_written": self.rows_written,
+                "last_batch": self.last_batch,
+                "max_ms": self.max_latency * 1000,
+            }
+        with self.pending_lock:
+            result["pending_last_seen"] = len(self.pending)
+        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            result[name] = samples[int(q * (len(samples) - 1))] * 1000 if samples else 0.0
+        return result
+
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        self.flush()
+        self.pool.close()
+
+
+class MessageStore:
+    def __init__(self, path, pool_size=2):
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        with self.pool.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(MESSAGES_SCHEMA)
+            conn.execute(MESSAGES_INDEX)
+            conn.commit()
+
+    def append(self, peer, sender, kind, ts, text=None, caption=None, path=None):
+        with self.pool.connection() as conn, conn:
+            cur = conn.execute(INSERT_MESSAGE, (peer, sender, kind, text, caption, path, ts))
+        return cur.lastrowid
+
+    # Returns up to `limit` messages with `peer`, oldest first, that come
+    # before the (ts, id) cursor `before` (the newest ones when None).
+    def page(self, peer, before=None, limit=50):
+        if before is None:
+            with self.pool.connection() as conn:
+                rows = conn.execute(SELECT_LATEST, (peer, limit)).fetchall()
+        else:
+            ts, msg_id = before
+            with self.pool.connection() as conn:
+                rows = conn.execute(SELECT_BEFORE, (peer, ts, ts, msg_id, limit)).fetchall()
+        rows.reverse()
+        return [{"id": r[0], "sender": r[1], "type": r[2], "text": r[3], "caption": r[4] or "",
+                 "image_path": r[5], "ts": r[6]} for r in rows]
+
+    def close(self):
+        self.pool.close()
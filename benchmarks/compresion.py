@@ -0,0 +1,110 @@
+# Per-codec cost of compressing protocol messages.
+# Uso: python -m benchmarks.compresion [--input mensajes.jsonl] [--rounds 3] [--json out.json]
+# --input takes recorded payloads, one JSON object per line; without it
+# the synthetic mixes below are used.
+import argparse
+import json
+import random
+import time
+
+import protocolo
+
+WORDS = ("hola que tal bien gracias nos vemos luego mañana archivo imagen enviado recibido "
+         "conexion peer servidor usuario mensaje listo ok vale perfecto donde cuando").split()
+
+
+def username(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 10))) + str(rng.randint(0, 999))
+
+
+def text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def synthetic_mixes(count, seed=0):
+    rng = random.Random(seed)
+    names = sorted({username(rng) for _ in range(5000)})
+    chat = []
+    for _ in range(count):
+        words = rng.randint(2, 15) if rng.random() < 0.9 else rng.randint(100, 400)
+        chat.append({"type": "text", "from": rng.choice(names), "text": text(rng, words), "ts": time.time()})
+    directory = []
+    for _ in range(count):
+        start = rng.randrange(len(names) - 500)
+        page = names[start:start + rng.choice((50, 200, 500))]
+        directory.append({"action": "user_list", "users": page, "prefix": "", "cursor": None, "next_cursor": page[-1]})
+    control = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            control.append({"action": "peer_info", "peer_username": rng.choice(names), "ip": "192.168.1.%d" % rng.randint(2, 254),
+                            "tcp_port": rng.randint(1024, 65535), "udp_port": rng.randint(1024, 65535)})
+        elif kind < 0.8:
+            control.append({"action": "presence", "version": rng.randint(1, 10 ** 6),
+                            "joined": rng.sample(names, rng.randint(0, 5)), "left": rng.sample(names, rng.randint(0, 5))})
+        else:
+            control.append({"action": "presence", "version": rng.randint(1, 10 ** 6), "snapshot": rng.sample(names, 1000)})
+    return {"chat": chat, "directorio": directory, "control": control, "mixto": chat + directory + control}
+
+
+def run_codec(messages, wire, rounds):
+    plain = sum(len(json.dumps(m).encode()) for m in messages)
+    frames = []
+    enc_cpu = enc_wall = dec_cpu = dec_wall = 0.0
+    for _ in range(rounds):
+        cpu, wall = time.process_time(), time.perf_counter()
+        frames = [protocolo.encode(m, wire=wire) for m in messages]
+        enc_cpu += time.process_time() - cpu
+        enc_wall += time.perf_counter() - wall
+
+        cpu, wall = time.process_time(), time.perf_counter()
+        for frame in frames:
+            _, flags = protocolo.HEADER.unpack_from(frame)
+            protocolo.decode(flags, memoryview(frame)[protocolo.HEADER.size:])
+        dec_cpu += time.process_time() - cpu
+        dec_wall += time.perf_counter() - wall
+    wire_bytes = sum(len(f) for f in frames)
+    n = len(messages) * rounds
+    return {
+        "messages": len(messages),
+        "json_bytes": plain,
+        "wire_bytes": wire_bytes,
+        "ratio": wire_bytes / plain if plain else 0.0,
+        "compressed_frames": sum(1 for f in frames if f[4] & (protocolo.ZLIB | protocolo.LZ4)),
+        "encode_msgs_per_s": n / enc_wall if enc_wall else 0.0,
+        "decode_msgs_per_s": n / dec_wall if dec_wall else 0.0,
+        "encode_mb_per_s": plain * rounds / enc_wall / 1e6 if enc_wall else 0.0,
+        "decode_mb_per_s": plain * rounds / dec_wall / 1e6 if dec_wall else 0.0,
+        "encode_cpu_us_per_msg": enc_cpu / n * 1e6,
+        "decode_cpu_us_per_msg": dec_cpu / n * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de compresión de mensajes")
+    parser.add_argument("--input", help="mensajes grabados, un JSON por línea")
+    parser.add_argument("--count", type=int, default=2000, help="mensajes por mezcla sintética")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--threshold", type=int, default=protocolo.COMPRESS_THRESHOLD)
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            mixes = {"grabado": [json.loads(line) for line in f if line.strip()]}
+    else:
+        mixes = synthetic_mixes(args.count)
+
+    codecs = [None] + list(protocolo.CODECS)
+    result = {"threshold": args.threshold, "codecs": [c or "none" for c in codecs], "mixes": {}}
+    for name, messages in mixes.items():
+        result["mixes"][name] = {codec or "none": run_codec(messages, protocolo.Wire(codec, args.threshold), args.rounds)
+                                 for codec in codecs}
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Synthetic UDP media benchmark on loopback.
+# Uso: python -m benchmarks.medios_udp --packets 200000 --size 1200 --rate 50000
+import argparse
+import json
+import multiprocessing
+import socket
+import threading
+import time
+
+import medios
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def run_sender(port, packets, size, rate, streams):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    senders = [medios.MediaSender(sock, ("127.0.0.1", port), sid) for sid in range(streams)]
+    payload = bytes(size)
+    started = time.perf_counter()
+    for i in range(packets):
+        senders[i % streams].send(payload)
+        if rate:
+            ahead = (i + 1) / rate - (time.perf_counter() - started)
+            if ahead > 0.001:
+                time.sleep(ahead)
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de medios UDP en loopback")
+    parser.add_argument("--packets", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=1200, help="bytes de payload por paquete")
+    parser.add_argument("--rate", type=int, default=20000, help="paquetes/s (0 = sin límite)")
+    parser.add_argument("--streams", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--delay", type=float, default=medios.JITTER_DELAY)
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    args = parser.parse_args()
+
+    sock = medios.open_socket(0, "127.0.0.1")
+    port = sock.getsockname()[1]
+    latencies = []
+    first_last = [None, None]
+
+    def on_packet(key, seq, ts, payload):
+        now = time.time_ns()
+        latencies.append(now - ts)
+        if first_last[0] is None:
+            first_last[0] = now
+        first_last[1] = now
+
+    receiver = medios.MediaReceiver(sock, on_packet, delay=args.delay, batch=args.batch,
+                                    packet_size=medios.HEADER.size + args.size)
+    thread = threading.Thread(target=receiver.run, daemon=True)
+    thread.start()
+
+    sender = multiprocessing.Process(target=run_sender, args=(port, args.packets, args.size, args.rate, args.streams))
+    sender.start()
+    sender.join()
+    time.sleep(args.delay * 4 + 0.2)
+    receiver.stop()
+    thread.join()
+
+    latencies.sort()
+    elapsed = (first_last[1] - first_last[0]) / 1e9 if latencies else 0.0
+    totals = {"delivered": 0, "lost": 0, "late": 0, "reordered": 0}
+    for stats in receiver.stats().values():
+        for k in totals:
+            totals[k] += stats[k]
+    result = {
+        "packets_sent": args.packets,
+        "payload_bytes": args.size,
+        "streams": args.streams,
+        "delivered": totals["delivered"],
+        "lost": totals["lost"] + args.packets - totals["delivered"] - totals["lost"],
+        "late": totals["late"],
+        "reordered": totals["reordered"],
+        "packets_per_s": totals["delivered"] / elapsed if elapsed else 0.0,
+        "datagrams_per_wakeup": receiver.datagrams / max(receiver.wakeups, 1),
+        "latency_ms": {name: percentile(latencies, q) / 1e6
+                       for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+    }
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Encode/decode cost and size per action type for each serializer.
+# Uso: python -m benchmarks.serializacion [--seconds 0.5] [--json out.json]
+# "json-stdlib" is the old json.dumps/json.loads path, kept as baseline;
+# "json" is what protocolo uses (orjson when installed).
+import argparse
+import base64
+import json
+import os
+import random
+import time
+
+import protocolo
+
+
+def sample_messages(seed=0):
+    rng = random.Random(seed)
+    names = sorted("user%05d" % rng.randrange(10 ** 5) for _ in range(500))
+    return {
+        "login": {"action": "login", "username": "usuario42", "password": "secreto123",
+                  "tcp_port": 8081, "udp_port": 9090, "caps": protocolo.capabilities()},
+        "peer_info": {"action": "peer_info", "peer_username": "usuario17", "ip": "192.168.1.73",
+                      "tcp_port": 8081, "udp_port": 9090},
+        "user_list": {"action": "user_list", "users": names, "prefix": "", "cursor": None, "next_cursor": names[-1]},
+        "text": {"type": "text", "from": "usuario42", "text": "hola, ¿nos vemos mañana a las 10?", "ts": time.time()},
+        "image": {"type": "image", "from": "usuario42", "image_b64": base64.b64encode(os.urandom(48 * 1024)).decode(),
+                  "caption": "foto", "ts": time.time()},
+    }
+
+
+def rate(fn, seconds):
+    n = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(50):
+            fn()
+        n += 50
+        now = time.perf_counter()
+        if now >= deadline:
+            return n / (now - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark de serialización por tipo de mensaje")
+    parser.add_argument("--seconds", type=float, default=0.5, help="duración de cada medición")
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    args = parser.parse_args()
+
+    serializers = {"json-stdlib": (lambda p: json.dumps(p).encode(), lambda b: json.loads(str(b, "utf-8")))}
+    for name, (_, dumps, loads) in protocolo.SERIALIZERS.items():
+        serializers[name] = (dumps, loads)
+
+    result = {"serializers": list(serializers), "actions": {}}
+    for action, payload in sample_messages().items():
+        row = {}
+        for name, (dumps, loads) in serializers.items():
+            body = dumps(payload)
+            assert loads(body) == json.loads(json.dumps(payload)), (name, action)
+            row[name] = {
+                "bytes": len(body),
+                "encode_ops_per_s": rate(lambda: dumps(payload), args.seconds),
+                "decode_ops_per_s": rate(lambda: loads(body), args.seconds),
+            }
+        result["actions"][action] = row
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
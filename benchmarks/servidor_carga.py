@@ -0,0 +1,272 @@
+# Load generator for the rendezvous server.
+# Uso: python -m benchmarks.servidor_carga --clients 2000 --duration 10 --rate 2 \
+#          --mix list_users=70,connect_to_peer=25,login=5 --mode asyncio --json carga.json
+# Starts servidor.py on loopback with a temporary Users.db (unless
+# --server host:port is given), logs every simulated client in, then runs
+# the request mix for --duration seconds at --rate requests/s per client
+# (Poisson arrivals). Clients are asyncio connections split over --procs
+# processes. Latency is measured from send to the matching reply.
+# "resume" logs in again with the session token from the setup login
+# instead of the password (the reconnect path).
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import protocolo
+
+ACTIONS = ("register", "login", "resume", "list_users", "connect_to_peer")
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "servidor.py")
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.pending = []  # [(action, target, sent_at, future)] in request order
+        self.pushes = 0
+        self.token = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(protocolo.HEADER.size)
+                length, flags = protocolo.HEADER.unpack(header)
+                body = await self.reader.readexactly(length)
+                self._dispatch(protocolo.decode(flags, body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for _, _, _, fut in self.pending:
+                if not fut.done():
+                    fut.set_result(False)
+            self.pending.clear()
+
+    # Replies come back in request order; peer_info for someone else's
+    # connect_to_peer and presence deltas are counted as pushes.
+    def _dispatch(self, msg):
+        if self.pending:
+            action, target, sent_at, fut = self.pending[0]
+            if action == "list_users":
+                matched = msg.get("action") == "user_list"
+            elif action == "connect_to_peer":
+                matched = (msg.get("action") == "peer_info" and msg.get("peer_username") == target) or "status" in msg
+            else:
+                matched = "status" in msg
+            if matched:
+                self.pending.pop(0)
+                self.token = msg.get("token") or self.token
+                ok = msg.get("status", "ok") == "ok"
+                self.stats.setdefault(action, []).append((time.perf_counter() - sent_at, ok))
+                fut.set_result(ok)
+                return
+        self.pushes += 1
+
+    def request(self, payload, target=None, name=None):
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((name or payload["action"], target, time.perf_counter(), fut))
+        self.writer.write(protocolo.encode(payload))
+        return fut
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_shard(shard, names, everyone, args, results):
+    stats = {}
+    rng = random.Random(shard)
+    clients = [Client(name, stats) for name in names]
+    started = time.perf_counter()
+
+    # Setup: connect, register and log in at --ramp clients/s per shard.
+    async def setup(client, delay):
+        await asyncio.sleep(delay)
+        await client.connect(args.host, args.port)
+        await client.request({"action": "register", "username": client.name, "password": "bench"})
+        await client.request({"action": "login", "username": client.name, "password": "bench",
+                              "tcp_port": 1, "udp_port": 1})
+        if args.presence:
+            client.writer.write(protocolo.encode({"action": "subscribe_presence"}))
+
+    ramp = args.ramp / args.procs if args.ramp else 0
+    await asyncio.gather(*(setup(c, i / ramp if ramp else 0) for i, c in enumerate(clients)))
+    setup_time = time.perf_counter() - started
+    setup_stats = {k: list(v) for k, v in stats.items()}
+    stats.clear()
+
+    actions, weights = zip(*args.mix.items())
+    deadline = time.perf_counter() + args.duration
+
+    async def drive(client):
+        while True:
+            delay = rng.expovariate(args.rate)
+            if time.perf_counter() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+            action = rng.choices(actions, weights)[0]
+            if action == "list_users":
+                await client.request({"action": "list_users", "cursor": rng.choice(everyone), "limit": args.page})
+            elif action == "connect_to_peer":
+                target = rng.choice(everyone)
+                await client.request({"action": "connect_to_peer", "target_username": target}, target)
+            elif action == "login":
+                await client.request({"action": "login", "username": client.name, "password": "bench",
+                                      "tcp_port": 1, "udp_port": 1})
+            elif action == "resume":
+                await client.request({"action": "login", "username": client.name, "token": client.token,
+                                      "tcp_port": 1, "udp_port": 1}, name="resume")
+            else:
+                await client.request({"action": "register", "username": f"{client.name}-{rng.randrange(10 ** 9)}",
+                                      "password": "bench"})
+
+    mix_started = time.perf_counter()
+    await asyncio.gather(*(drive(c) for c in clients))
+    mix_time = time.perf_counter() - mix_started
+    pushes = sum(c.pushes for c in clients)
+    for c in clients:
+        c.close()
+    results.put({"setup": setup_stats, "mix": stats, "setup_time": setup_time, "mix_time": mix_time, "pushes": pushes})
+
+
+def shard_main(shard, names, everyone, args, results):
+    raise_fd_limit()
+    asyncio.run(run_shard(shard, names, everyone, args, results))
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s[0] for s in samples)
+    return {
+        "count": len(samples),
+        "errors": sum(1 for s in samples if not s[1]),
+        "per_s": len(samples) / elapsed if elapsed else 0.0,
+        "latency_ms": {name: percentile(latencies, q) * 1000
+                       for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+    }
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start on {host}:{port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga para servidor.py")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--procs", type=int, default=max(1, min(4, os.cpu_count() or 1)), help="procesos generadores")
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos de la fase de mezcla")
+    parser.add_argument("--rate", type=float, default=1.0, help="peticiones/s por cliente")
+    parser.add_argument("--ramp", type=float, default=0, help="conexiones/s al iniciar (0 = todas a la vez)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("list_users=70,connect_to_peer=25,login=5"))
+    parser.add_argument("--page", type=int, default=50, help="limit de list_users")
+    parser.add_argument("--presence", action="store_true", help="suscribir a todos los clientes a presencia")
+    parser.add_argument("--server", help="host:puerto de un servidor ya iniciado")
+    parser.add_argument("--mode", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    args = parser.parse_args()
+
+    fd_limit = raise_fd_limit()
+    if args.clients / args.procs + 64 > fd_limit:
+        print(f"[BENCH] Warning: {args.clients} clients over {args.procs} procs may exceed the fd limit ({fd_limit})", file=sys.stderr)
+
+    server = None
+    tmpdir = tempfile.TemporaryDirectory()
+    if args.server:
+        args.host, port = args.server.rsplit(":", 1)
+        args.port = int(port)
+    else:
+        args.host, args.port = "127.0.0.1", free_port()
+        server = subprocess.Popen([sys.executable, SERVER, "--mode", args.mode,
+                                   "--host", args.host, "--port", str(args.port),
+                                   "--db", os.path.join(tmpdir.name, "Users.db")],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+        run_id = f"{os.getpid()}-{int(time.time())}"
+        everyone = [f"bench{run_id}-{i}" for i in range(args.clients)]
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=shard_main, args=(i, everyone[i::args.procs], everyone, args, results))
+                 for i in range(args.procs)]
+        for p in procs:
+            p.start()
+        shards = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        tmpdir.cleanup()
+
+    setup_time = max(s["setup_time"] for s in shards)
+    mix_time = max(s["mix_time"] for s in shards)
+    setup, mix = {}, {}
+    for s in shards:
+        for action, samples in s["setup"].items():
+            setup.setdefault(action, []).extend(samples)
+        for action, samples in s["mix"].items():
+            mix.setdefault(action, []).extend(samples)
+    everything = [x for samples in mix.values() for x in samples]
+    result = {
+        "config": {"clients": args.clients, "procs": args.procs, "duration": args.duration, "rate": args.rate,
+                   "ramp": args.ramp, "mix": args.mix, "page": args.page, "presence": args.presence,
+                   "mode": args.mode, "server": args.server},
+        "setup": {"seconds": setup_time, "actions": {a: summarize(s, setup_time) for a, s in setup.items()}},
+        "mix": {"seconds": mix_time, "total": summarize(everything, mix_time),
+                "actions": {a: summarize(s, mix_time) for a, s in mix.items()}},
+        "pushes": sum(s["pushes"] for s in shards),
+    }
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import threading
+import weakref
+from collections import deque
+
+import protocolo
+
+# Logical channels of a peer link, highest priority first.
+CONTROL, TEXT, BULK = 0, 1, 2
+# Largest bulk frame written in one go; a text message waits for at most
+# one of these before it goes out.
+FRAME_CAP = 16 * 1024
+# How often stream(wait=True) calls its tick while it waits.
+TICK_INTERVAL = 0.1
+
+_links = weakref.WeakKeyDictionary()
+_links_guard = threading.Lock()
+
+
+# One writer thread per peer socket. Control and text frames are queued
+# whole; bulk transfers are generators that write one frame per step, so
+# the writer can check the higher-priority queues between every chunk and
+# round-robin between transfers running at the same time. Frames are
+# still plain protocolo frames (chunks carry their transfer id), so the
+# receiving side needs nothing new.
+class LinkScheduler:
+    def __init__(self, sock, frame_cap=FRAME_CAP):
+        self.sock = sock
+        self.frame_cap = frame_cap
+        self.cond = threading.Condition()
+        self.queues = (deque(), deque())  # CONTROL, TEXT: encoded frames
+        self.bulk = deque()               # [generator, Event, error]
+        self.error = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # Queues a message; returns once it is queued, not sent. Frames over
+    # the cap go behind the running transfers instead of jumping ahead of
+    # the chat.
+    def send(self, payload, channel=TEXT):
+        frame = protocolo.encode(payload, wire=protocolo.get_wire(self.sock))
+        if channel == BULK or (channel == TEXT and len(frame) > self.frame_cap):
+            self.stream(self._whole(frame), wait=False)
+            return
+        with self.cond:
+            self._check()
+            self.queues[channel].append(frame)
+            self.cond.notify()
+
+    # A frame over the cap (the base64 image for peers without file
+    # transfers) is one message to the peer, so nothing else can go out
+    # in the middle of it. It is written FRAME_CAP bytes per step: the
+    # steps yield True while the frame is unfinished, and _run keeps
+    # stepping it (checking for a closed link in between) rather than
+    # switching to another queue.
+    def _whole(self, frame):
+        view = memoryview(frame)
+        with protocolo.send_lock(self.sock):
+            for start in range(0, len(view), self.frame_cap):
+                self.sock.sendall(view[start:start + self.frame_cap])
+                if start + self.frame_cap < len(view):
+                    yield True
+        yield
+
+    # Runs `frames` (a generator that writes one frame per next()) on the
+    # bulk channel. With wait=True blocks until it is exhausted and
+    # re-raises the error that stopped the link, if any; `tick`, if given,
+    # is called every TICK_INTERVAL seconds while waiting and once at the
+    # end, on the caller's thread (the frames run on the writer thread).
+    def stream(self, frames, wait=True, tick=None):
+        entry = [frames, threading.Event(), None]
+        with self.cond:
+            self._check()
+            self.bulk.append(entry)
+            self.cond.notify()
+        if wait:
+            while not entry[1].wait(TICK_INTERVAL if tick else None):
+                tick()
+            if tick:
+                tick()
+            if entry[2] is not None:
+                raise entry[2]
+
+    def _check(self):
+        if self.error is not None:
+            raise ConnectionError(f"peer link closed: {self.error}")
+
+    def _next(self):
+        with self.cond:
+            while self.error is None and not (self.queues[0] or self.queues[1] or self.bulk):
+                self.cond.wait()
+            if self.error is not None:
+                return None, None
+            for queue in self.queues:
+                if queue:
+                    return queue.popleft(), None
+            return None, self.bulk.popleft()
+
+    def _run(self):
+        entry = None
+        try:
+            while True:
+                frame, entry = self._next()
+                if frame is not None:
+                    with protocolo.send_lock(self.sock):
+                        self.sock.sendall(frame)
+                elif entry is not None:
+                    try:
+                        while next(entry[0]):
+                            self._check()
+                    except StopIteration:
+                        entry[1].set()
+                        continue
+                    with self.cond:
+                        self.bulk.append(entry)
+                else:
+                    return
+        except Exception as e:
+            if entry is not None:
+                entry[2] = e
+                entry[1].set()
+            self.close(e)
+
+    def close(self, error=None):
+        with self.cond:
+            if self.error is None:
+                self.error = error or ConnectionError("closed")
+            pending, self.bulk = list(self.bulk), deque()
+            for queue in self.queues:
+                queue.clear()
+            self.cond.notify()
+        for entry in pending:
+            entry[2] = ConnectionError(f"peer link closed: {self.error}")
+            entry[1].set()
+
+
+def attach(sock, frame_cap=FRAME_CAP):
+    with _links_guard:
+        link = _links.get(sock)
+        if link is None:
+            link = _links[sock] = LinkScheduler(sock, frame_cap)
+        return link
+
+
+def get(sock):
+    with _links_guard:
+        return _links.get(sock)
+
+
+def detach(sock):
+    with _links_guard:
+        link = _links.pop(sock, None)
+    if link is not None:
+        link.close()
@@ -1,134 +1,166 @@
+import os
 import socket
 import threading
-import json
 import time
 
+import conexiones
+import medios
+import presencia
+import transferencia
+
 SERVER_HOST = "192.168.1.73"
 SERVER_PORT = 8080
 
 
 LOCAL_TCP_PORT = 8081
 LOCAL_UDP_PORT = 9090
+LIST_PAGE_SIZE = 20
+DOWNLOAD_DIR = "descargas"
+FILE_CHUNK_SIZE = transferencia.DEFAULT_CHUNK_SIZE
+MEDIA_FRAME_RATE = 50  # packets/s of the synthetic test stream
+MEDIA_FRAME_SIZE = 960
+
+manager = None
+presence = presencia.PresenceView()
+directory_page = {"prefix": "", "cursor": None}
+seen_streams = set()
+
+
+def on_media(key, seq, ts, payload):
+    if key not in seen_streams:
+        seen_streams.add(key)
+        print(f"\n[UDP] New media stream {key[1]} from {key[0]}\nEnter command: ", end="")
 
-peers = {}  # peer_username -> {"tcp_sock": socket, "udp_addr": (ip, port)}
-lock = threading.Lock()
 
-def tcp_listen():
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.bind(('', LOCAL_TCP_PORT))
-    server_sock.listen()
-    print(f"[TCP] Listening for P2P messages on port {LOCAL_TCP_PORT}")
+# The receiver forgets idle streams; forget them here too, so the set stays
+# as small as its table and a stream that comes back is announced again.
+def on_media_end(key):
+    seen_streams.discard(key)
+
+# Prints what the connection manager reports from its listener threads.
+def event_loop():
     while True:
-        conn, addr = server_sock.accept()
-        threading.Thread(target=handle_tcp_peer, args=(conn, addr), daemon=True).start()
+        payload = manager.events.get()
+        kind = payload.get("action") or payload.get("type")
+
+        if kind == "presence":
+            if not presence.apply(payload):
+                try:
+                    manager.send_server({"action": "subscribe_presence"})
+                except OSError:
+                    pass
+
+        elif kind == "user_list":
+            print("\n[ONLINE USERS]:")
+            if payload["users"]:
+                for user in payload["users"]:
+                    print(f"- {user}")
+            else:
+                print("No other users are online.")
+            directory_page["prefix"] = payload.get("prefix", "")
+            directory_page["cursor"] = payload.get("next_cursor")
+            if directory_page["cursor"]:
+                print("(more users: type 'more')")
+
+        elif kind == "peer_connected":
+            via = " via server relay" if payload.get("relayed") else ""
+            print(f"\n[TCP] Connected to {payload['username']}{via}. You can now send messages.\nEnter command: ", end="")
+
+        elif kind == "peer_disconnected":
+            print(f"\n[TCP] {payload['username']} disconnected.\nEnter command: ", end="")
+
+        elif kind == "file_progress":
+            print(f"\n[FILE] {payload.get('name')}: {payload['done'] * 100 // max(payload['total'], 1)}%\nEnter command: ", end="")
+
+        elif kind == "file_error":
+            print(f"\n[FILE] {payload.get('name')}: transfer discarded ({payload.get('reason')})\nEnter command: ", end="")
+
+        elif kind == "file":
+            print(f"\n[FILE RECEIVED] {payload['from']}: {payload['name']} -> {payload['path']}\nEnter command: ", end="")
+
+        elif kind == "text":
+            tag = "OFFLINE MSG" if payload.get("offline") else "MSG RECEIVED"
+            print(f"\n[{tag}] {payload.get('from', payload.get('_from_addr'))}: {payload.get('text', '')}\nEnter command: ", end="")
+
+        elif kind == "server_disconnected":
+            print("[SERVER] Disconnected." + (" Reconnecting..." if payload.get("reconnecting") else ""))
 
-def handle_tcp_peer(conn, addr):
+        elif kind == "server_reconnected":
+            print("\n[SERVER] Reconnected.\nEnter command: ", end="")
+
+        elif kind == "error":
+            print(f"\n[ERROR] {payload.get('content')}\nEnter command: ", end="")
+
+        elif payload.get("status") == "error":
+            print(f"\n[SERVER ERROR] {payload.get('msg')}")
+
+# Directory requests are not queued while the manager reconnects: a stale
+# page is no use, so the user is told to ask again.
+def request_list(req):
     try:
-        while True:
-            data = conn.recv(1024)
-            if not data:
-                break
-            print(f"\n[MSG RECEIVED] {data.decode().strip()}\nEnter command: ", end="")
-    except:
-        pass
-    finally:
-        conn.close()
+        manager.send_server(req)
+    except OSError:
+        if manager.reconnecting:
+            print("[SERVER] Reconnecting to the server; try again in a moment.")
+        else:
+            print("[ERROR] Not connected to the server.")
 
-def udp_listen():
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.bind(('', LOCAL_UDP_PORT))
-    print(f"[UDP] Listening for P2P multimedia on port {LOCAL_UDP_PORT}")
-    while True:
-        data, addr = udp_sock.recvfrom(4096)
-        print(f"\n[UDP RECEIVED] {len(data)} bytes from {addr}\nEnter command: ", end="")
 
+def send_file(peer_name, path):
+    name = os.path.basename(path)
+    try:
+        step = {"next": 0}
+        def progress(tid, done, total):
+            if done >= step["next"]:
+                print(f"\n[FILE] {name}: {done * 100 // max(total, 1)}%\nEnter command: ", end="")
+                step["next"] = done + total // 10
+        if not manager.send_file(peer_name, path, FILE_CHUNK_SIZE, progress):
+            print(f"\n[FILE] {peer_name} did not accept {name}\nEnter command: ", end="")
+    except Exception as e:
+        print(f"\n[FILE] Error sending {path} to {peer_name}: {e}\nEnter command: ", end="")
 
-def connect_to_peer(peer_username, peer_ip, peer_tcp_port, peer_udp_port):
-    
-    if peer_username in peers:
-        print(f"[TCP] Already connected to {peer_username}")
-        return
-        
-    while True:
-        try:
-            tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tcp_sock.connect((peer_ip, peer_tcp_port))
-            with lock:
-                peers[peer_username] = {"tcp_sock": tcp_sock, "udp_addr": (peer_ip, peer_udp_port)}
-            print(f"\n[TCP] Connected to {peer_username}. You can now send messages.")
-            break
-        except Exception as e:
-            print(f"[TCP] Could not connect to {peer_username}: {e}, retrying in 5s")
-            time.sleep(5)
+def stream_to_peer(peer_name, udp_addr, seconds):
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = medios.MediaSender(udp_sock, udp_addr, int(time.time()) & 0xFFFF)
+    frame = bytes(MEDIA_FRAME_SIZE)
+    interval = 1 / MEDIA_FRAME_RATE
+    deadline = time.monotonic() + seconds
+    try:
+        while time.monotonic() < deadline:
+            sender.send(frame)
+            time.sleep(interval)
+        print(f"\n[UDP] Sent {sender.seq} packets to {peer_name}\nEnter command: ", end="")
+    finally:
+        udp_sock.close()
 
 
 def main():
+    global manager
     username = input("Username: ")
     password = input("Password: ")
-
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    manager = conexiones.ConnectionManager((SERVER_HOST, SERVER_PORT), username, LOCAL_TCP_PORT, LOCAL_UDP_PORT,
+                                           DOWNLOAD_DIR, on_media=on_media,
+                                           on_media_end=on_media_end)
     try:
-        server_socket.connect((SERVER_HOST, SERVER_PORT))
-        login_msg = {
-            "action": "login", "username": username, "password": password,
-            "tcp_port": LOCAL_TCP_PORT, "udp_port": LOCAL_UDP_PORT
-        }
-        server_socket.sendall((json.dumps(login_msg) + "\n").encode())
         print("[SERVER] Connected and attempting to log in...")
+        ok, msg = manager.login(password)
     except Exception as e:
         print(f"[SERVER] Cannot connect: {e}")
         return
+    if not ok:
+        print(f"[SERVER ERROR] {msg}")
+        return
 
-    threading.Thread(target=tcp_listen, daemon=True).start()
-    threading.Thread(target=udp_listen, daemon=True).start()
-
-    def server_listener():
-        nonlocal server_socket
-        while True:
-            try:
-                data = server_socket.recv(1024)
-                if not data:
-                    print("[SERVER] Disconnected.")
-                    break
-                
-                messages = data.decode().split("\n")
-                for msg in messages:
-                    if not msg.strip():
-                        continue
-                    payload = json.loads(msg)
-                    
-                    action = payload.get("action")
-                    if action == "peer_info":
-                        peer_username = payload["peer_username"]
-                        peer_ip = payload["ip"]
-                        peer_tcp_port = payload["tcp_port"]
-                        peer_udp_port = payload["udp_port"]
-                        print(f"\n[PEER INFO] Received data for {peer_username} at {peer_ip} TCP:{peer_tcp_port}")
-                        threading.Thread(target=connect_to_peer, args=(peer_username, peer_ip, peer_tcp_port, peer_udp_port), daemon=True).start()
-                    
-                    elif action == "user_list":
-                        print("\n[ONLINE USERS]:")
-                        if payload["users"]:
-                            for user in payload["users"]:
-                                print(f"- {user}")
-                        else:
-                            print("No other users are online.")
-                    
-                    elif payload.get("status") == "error":
-                        print(f"\n[SERVER ERROR] {payload.get('msg')}")
-
-            except Exception as e:
-                print(f"[SERVER] Error: {e}")
-                break
+    threading.Thread(target=event_loop, daemon=True).start()
 
-    threading.Thread(target=server_listener, daemon=True).start()
-    
-    time.sleep(1) 
-    
     print("\n--- Commands ---")
-    print("list              - See online users")
+    print("list [prefix]     - See online users (optionally by name prefix)")
+    print("more              - Next page of the last list")
     print("connect <user>    - Connect to a user")
     print("<user>: <message> - Send a message to a connected user")
+    print("send <user> <path> - Send a file to a connected user")
+    print("stream <user> <s> - Send a synthetic UDP media stream for <s> seconds")
+    print("media             - Show received UDP stream statistics")
     print("exit              - Close the application")
     print("------------------")
 
@@ -137,36 +169,70 @@ def main():
         if cmd.lower() == 'exit':
             break
 
-        if cmd.lower() == 'list':
-            list_req = {"action": "list_users"}
-            server_socket.sendall((json.dumps(list_req) + "\n").encode())
+        if cmd.lower() == 'list' or cmd.lower().startswith('list '):
+            prefix = cmd[5:].strip()
+            request_list({"action": "list_users", "prefix": prefix, "limit": LIST_PAGE_SIZE})
+
+        elif cmd.lower() == 'more':
+            if directory_page["cursor"]:
+                list_req = {"action": "list_users", "prefix": directory_page["prefix"],
+                            "cursor": directory_page["cursor"], "limit": LIST_PAGE_SIZE}
+                request_list(list_req)
+            else:
+                print("[ERROR] No more users to list.")
 
         elif cmd.lower().startswith('connect '):
             parts = cmd.split(' ', 1)
             if len(parts) > 1:
                 target_user = parts[1].strip()
-                connect_req = {"action": "connect_to_peer", "target_username": target_user}
-                server_socket.sendall((json.dumps(connect_req) + "\n").encode())
+                if target_user in manager.peers_snapshot():
+                    print(f"[TCP] Already connected to {target_user}")
+                else:
+                    manager.connect(target_user)
             else:
                 print("[ERROR] Please specify a user to connect to. Usage: connect <username>")
-        
+
+        elif cmd.lower().startswith('send '):
+            parts = cmd.split(' ', 2)
+            if len(parts) == 3 and os.path.isfile(parts[2].strip()):
+                peer_name, path = parts[1].strip(), parts[2].strip()
+                if peer_name in manager.peers_snapshot():
+                    threading.Thread(target=send_file, args=(peer_name, path), daemon=True).start()
+                else:
+                    print(f"[ERROR] No TCP connection to {peer_name}. Use 'connect {peer_name}' first.")
+            else:
+                print("[ERROR] Usage: send <username> <path to an existing file>")
+
+        elif cmd.lower().startswith('stream '):
+            parts = cmd.split()
+            udp_addr = manager.peer_udp_addr(parts[1]) if len(parts) == 3 else None
+            if udp_addr and parts[2].isdigit():
+                threading.Thread(target=stream_to_peer, args=(parts[1], udp_addr, int(parts[2])), daemon=True).start()
+            else:
+                print("[ERROR] Usage: stream <connected user> <seconds>")
+
+        elif cmd.lower() == 'media':
+            stats = manager.media_stats()
+            if not stats:
+                print("No UDP streams received.")
+            for (addr, stream_id), s in stats.items():
+                print(f"- stream {stream_id} from {addr}: {s['delivered']} delivered, {s['lost']} lost ({s['loss_pct']:.1f}%), {s['reordered']} reordered, {s['late']} late")
+
         elif ":" in cmd:
             peer_name, message = cmd.split(":", 1)
             peer_name = peer_name.strip()
             message = message.strip()
-            with lock:
-                if peer_name in peers:
-                    try:
-                        peers[peer_name]["tcp_sock"].sendall(message.encode())
-                    except Exception as e:
-                        print(f"[TCP] Error sending to {peer_name}: {e}")
-                else:
-                    print(f"[ERROR] No TCP connection to {peer_name}. Use 'connect {peer_name}' first.")
+            try:
+                if not manager.send_text(peer_name, message):
+                    manager.send_offline(peer_name, message)
+                    print(f"[OFFLINE] No TCP connection to {peer_name}; the server will deliver it when possible.")
+            except Exception as e:
+                print(f"[TCP] Error sending to {peer_name}: {e}")
         else:
             if cmd:
                 print("[ERROR] Invalid command format.")
 
-    server_socket.close()
+    manager.close()
     print("Application closed.")
 
 if __name__ == "__main__":
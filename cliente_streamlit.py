@@ -1,123 +1,41 @@
 import streamlit as st
-import socket
+import os
 import threading
-import json
 import time
 import base64
-from queue import Queue, Empty
+from queue import Empty
+
+import almacen
+import conexiones
+import imagenes
+import presencia
+import transferencia
 
 SERVER_HOST = "192.168.1.73"
 SERVER_PORT = 8080
+USER_PAGE_SIZE = 50
+QUEUE_POLL_INTERVAL = 0.1  # seconds between checks of the listeners' event queue
+DOWNLOAD_DIR = "descargas"
+FILE_CHUNK_SIZE = transferencia.DEFAULT_CHUNK_SIZE
+CHAT_WINDOW = 50  # messages per conversation kept in memory; older pages load on demand
+IMAGE_CACHE_BYTES = imagenes.CACHE_BYTES
 
 
-def server_listener(server_sock, message_queue):
-    
-    buffer = ""
-    try:
-        while True:
-            try:
-                data = server_sock.recv(4096)
-                if not data:
-                    message_queue.put({"type": "server_disconnected"})
-                    break
-                buffer += data.decode(errors="ignore")
-                while "\n" in buffer:
-                    raw, buffer = buffer.split("\n", 1)
-                    raw = raw.strip()
-                    if not raw:
-                        continue
-                    try:
-                        payload = json.loads(raw)
-                    except Exception as e:
-                        print("[DEBUG] JSON parse fail from server:", e, raw[:200])
-                        continue
-                    message_queue.put(payload)
-            except Exception as e:
-                print("[ERROR CLIENT] server_listener:", e)
-                message_queue.put({"type": "error", "content": f"[SERVER ERROR] {e}"})
-                break
-    finally:
-        message_queue.put({"type": "server_disconnected"})
-
-def tcp_listen(tcp_port, message_queue):
-    
-    try:
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sock.bind(('', tcp_port))
-        server_sock.listen()
-        print(f"[TCP LISTEN] P2P TCP listening on {tcp_port}")
-        while True:
-            conn, addr = server_sock.accept()
-            threading.Thread(target=handle_tcp_peer, args=(conn, addr, message_queue), daemon=True).start()
-    except Exception as e:
-        print("[ERROR] tcp_listen:", e)
-        message_queue.put({"type": "error", "content": f"[ERROR TCP Listen] {e}"})
-
-def handle_tcp_peer(conn, addr, message_queue):
-    
-    buffer = ""
-    peer_username = None
-    try:
-        conn.settimeout(0.5)
-        while True:
-            try:
-                data = conn.recv(4096)
-            except socket.timeout:
-                continue
-            except Exception:
-                break
-
-            if not data:
-                break
-            buffer += data.decode(errors="ignore")
-            while "\n" in buffer:
-                raw, buffer = buffer.split("\n", 1)
-                raw = raw.strip()
-                if not raw:
-                    continue
-                try:
-                    payload = json.loads(raw)
-                    payload["_from_addr"] = addr
-                    message_queue.put(payload)
-                    if payload.get("type") in ("text", "image") and "from" in payload:
-                        peer_username = payload["from"]
-                        with _peers_lock:
-                            if peer_username and peer_username not in st.session_state.peers:
-                                st.session_state.peers[peer_username] = {"tcp_sock": conn, "addr": addr}
-                except Exception as e:
-                    message_queue.put({"type": "text", "from": st.session_state.get("chatting_with", "Peer"), "text": raw})
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
-        with _peers_lock:
-            to_delete = []
-            for uname, info in st.session_state.peers.items():
-                sock = info.get("tcp_sock")
-                if sock is conn:
-                    to_delete.append(uname)
-            for u in to_delete:
-                del st.session_state.peers[u]
-        message_queue.put({"type": "peer_disconnected", "addr": addr, "username": peer_username})
-
-
-_peers_lock = threading.Lock()
-
 def initialize_session_state():
     defaults = {
         "logged_in": False,
         "username": "",
-        "server_socket": None,
         "chat_log": {},         
         "online_users": [],    
+        "directory_prefix": None,
+        "directory_cursor": None,
+        "presence": presencia.PresenceView(),
         "chatting_with": None, 
-        "peer_socket": None,   
-        "peers": {},            
-        "message_queue": Queue(),
+        "incoming_files": {},
+        "expanded_image": None,
         "local_tcp_port": 8081,
         "local_udp_port": 9090,
+        "events": None,         # this session's subscription to the manager's events
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -131,7 +49,7 @@ def login_page():
         username = st.text_input("Usuario", value=st.session_state.get("username",""))
         password = st.text_input("Contraseña", type="password")
         tcp_port = st.number_input("Puerto TCP Local", 1024, 65535, value=st.session_state.local_tcp_port)
-        udp_port = st.number_input("Puerto UDP Local (informativo)", 1024, 65535, value=st.session_state.local_udp_port)
+        udp_port = st.number_input("Puerto UDP Local (medios)", 1024, 65535, value=st.session_state.local_udp_port)
         col1, col2 = st.columns(2)
         if col1.form_submit_button("Iniciar Sesión"):
             connect_to_server("login", username, password, int(tcp_port), int(udp_port))
@@ -139,86 +57,100 @@ def login_page():
             connect_to_server("register", username, password, int(tcp_port), int(udp_port))
 
 
+# One manager per (user, ports) for the whole process: a browser refresh or
+# a second tab reuses the open sockets and listener threads instead of
+# logging in again. Each session subscribes to its events, and the
+# subscriptions count its users: logout closes it with the last one.
+@st.cache_resource(show_spinner=False)
+def get_manager(username, tcp_port, udp_port):
+    return conexiones.ConnectionManager((SERVER_HOST, SERVER_PORT), username, tcp_port, udp_port,
+                                        DOWNLOAD_DIR)
+
+
+# Held while a session joins or leaves a manager, so a logout in one tab
+# cannot close the manager another tab is just starting to use.
+@st.cache_resource(show_spinner=False)
+def get_sessions_lock():
+    return threading.Lock()
+
+
+def current_manager():
+    return get_manager(st.session_state.username, st.session_state.local_tcp_port, st.session_state.local_udp_port)
+
+
 def connect_to_server(action, username, password, tcp_port, udp_port):
     try:
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.settimeout(5)
-        server_sock.connect((SERVER_HOST, SERVER_PORT))
-        server_sock.settimeout(None)
-        request = {"action": action, "username": username, "password": password, "tcp_port": tcp_port, "udp_port": udp_port}
-        server_sock.sendall((json.dumps(request) + "\n").encode())
-
-        resp = server_sock.recv(4096).decode().strip()
-        try:
-            response = json.loads(resp.split("\n")[0])
-        except:
-            st.error("Respuesta inválida del servidor.")
-            server_sock.close()
+        if action == "register":
+            ok, msg = conexiones.register((SERVER_HOST, SERVER_PORT), username, password)
+            if ok:
+                st.success(f"Usuario '{username}' registrado. Ahora puedes iniciar sesión.")
+            else:
+                st.error(f"Error: {msg}")
             return
 
-        if response.get("status") == "ok":
-            if action == "login":
-                st.session_state.logged_in = True
-                st.session_state.username = username
-                st.session_state.server_socket = server_sock
-                st.session_state.local_tcp_port = tcp_port
-                st.session_state.local_udp_port = udp_port
-                t1 = threading.Thread(target=server_listener, args=(server_sock, st.session_state.message_queue), daemon=True)
-                t1.start()
-                t2 = threading.Thread(target=tcp_listen, args=(tcp_port, st.session_state.message_queue), daemon=True)
-                t2.start()
-                st.success(f"Conectado como {username}")
-                time.sleep(0.2)
-                st.rerun()
-            else:
-                st.success(f"Usuario '{username}' registrado. Ahora puedes iniciar sesión.")
-                server_sock.close()
-        else:
-            st.error(f"Error: {response.get('msg')}")
-            server_sock.close()
-    except Exception as e:
+        with get_sessions_lock():
+            manager = get_manager(username, tcp_port, udp_port)
+            ok, msg = manager.login(password)
+            if ok:
+                st.session_state.events = manager.events.subscribe()
+        if not ok:
+            st.error(f"Error: {msg}")
+            return
+        st.session_state.logged_in = True
+        st.session_state.username = username
+        st.session_state.local_tcp_port = tcp_port
+        st.session_state.local_udp_port = udp_port
+        st.session_state.presence = presencia.PresenceView()
+        # A reused manager is already subscribed; ask again so this session gets a snapshot.
+        manager.send_server({"action": "subscribe_presence"})
+        st.success(f"Conectado como {username}")
+        time.sleep(0.2)
+        st.rerun()
+    except (OSError, ValueError, StopIteration) as e:
         st.error(f"No se pudo conectar al servidor: {e}")
 
 
 def chat_page():
     st.title(f"Chat P2P - Conectado como: {st.session_state.username}")
 
+    manager = current_manager()
     with st.sidebar:
         st.header("Usuarios Conectados (servidor)")
-        if st.button("Actualizar Lista"):
-            try:
-                req = {"action": "list_users"}
-                st.session_state.server_socket.sendall((json.dumps(req) + "\n").encode())
-                st.toast("Solicitando lista...")
-            except Exception as e:
-                st.error("No se puede pedir lista al servidor: " + str(e))
+        prefix = st.text_input("Buscar usuario", key="user_prefix")
+        if st.button("Actualizar Lista") or prefix != st.session_state.directory_prefix:
+            request_user_page(prefix)
         st.markdown("---")
+        view = st.session_state.presence
         if not st.session_state.online_users:
             st.write("Nadie conectado (o no hay respuesta). Intenta actualizar.")
         else:
             for user in st.session_state.online_users:
                 if user == st.session_state.username:
                     continue
+                if view.version is not None and user not in view.users:
+                    continue
                 if st.button(f"Chatear con {user}", key=f"connect_{user}"):
                     try:
-                        connect_req = {"action": "connect_to_peer", "target_username": user}
-                        st.session_state.server_socket.sendall((json.dumps(connect_req) + "\n").encode())
+                        manager.connect(user)
                         st.session_state.chatting_with = user
-                        if user not in st.session_state.chat_log:
-                            st.session_state.chat_log[user] = []
                     except Exception as e:
                         st.error("Fallo al solicitar conexión: " + str(e))
 
+            if st.session_state.directory_cursor and st.button("Cargar más"):
+                request_user_page(prefix, st.session_state.directory_cursor)
+
         st.markdown("---")
         st.header("Peers conectados (P2P)")
-        if not st.session_state.peers:
+        peers = manager.peers_snapshot()
+        if not peers:
             st.write("No hay peers conectados directamente.")
         else:
-            for p in st.session_state.peers:
-                info = st.session_state.peers[p]
-                addr = info.get("addr")
+            for p, addr in peers.items():
                 st.write(f"- {p} @ {addr}")
 
+        for (addr, stream_id), s in manager.media_stats().items():
+            st.caption(f"UDP {stream_id} de {addr[0]}: {s['delivered']} recibidos, {s['loss_pct']:.1f}% perdidos")
+
         st.markdown("---")
         if st.button("Cerrar sesión"):
             logout()
@@ -230,38 +162,26 @@ def chat_page():
         return
 
     st.header(f"Conversación con: {chatting}")
-    if chatting not in st.session_state.chat_log:
-        st.session_state.chat_log[chatting] = []
+    window = chat_window(chatting)
+    if window["more"] and st.button("Cargar mensajes anteriores"):
+        load_older_messages(chatting)
 
     chat_container = st.container()
     with chat_container:
-        for msg in st.session_state.chat_log[chatting]:
-            sender = msg.get("sender")
-            mtype = msg.get("type", "text")
-            if mtype == "text":
-                if sender == st.session_state.username:
-                    with st.chat_message("user"):
-                        st.write(msg.get("text"))
-                else:
-                    with st.chat_message("assistant"):
-                        st.write(msg.get("text"))
-            elif mtype == "image":
-                caption = msg.get("caption", "")
-                img_bytes = msg.get("image_bytes")
-                if img_bytes:
-                    if sender == st.session_state.username:
-                        with st.chat_message("user"):
-                            st.image(img_bytes, caption=caption)
-                    else:
-                        with st.chat_message("assistant"):
-                            st.image(img_bytes, caption=caption)
+        for msg in window["messages"]:
+            role = "user" if msg.get("sender") == st.session_state.username else "assistant"
+            with st.chat_message(role):
+                if msg.get("type") != "image":
+                    st.write(msg.get("text"))
+                elif msg.get("image_path") and os.path.exists(msg["image_path"]):
+                    render_image(msg)
+                elif role == "user":
+                    st.write("[Imagen (no disponible)] " + msg.get("caption", ""))
                 else:
-                    if sender == st.session_state.username:
-                        with st.chat_message("user"):
-                            st.write("[Imagen (no disponible)] " + caption)
-                    else:
-                        with st.chat_message("assistant"):
-                            st.write("[Imagen recibida] " + caption)
+                    st.write("[Imagen recibida] " + msg.get("caption", ""))
+
+    for name, fraction in list(st.session_state.incoming_files.values()):
+        st.progress(fraction, text=f"Recibiendo {name}...")
 
     col_text, col_file = st.columns([4,1])
     with col_text:
@@ -275,68 +195,124 @@ def chat_page():
         if uploaded is not None:
             caption = st.text_input("Pie de imagen (opcional)", key=f"cap_{chatting}")
             if st.button("Enviar imagen", key=f"send_img_{chatting}"):
-                send_image(chatting, uploaded.read(), caption)
+                send_image(chatting, uploaded.getvalue(), caption, uploaded.name)
                 st.rerun()
 
 
-def send_text_message(target_username, text):
-   
-    payload = {"type": "text", "from": st.session_state.username, "text": text, "ts": time.time()}
-    st.session_state.chat_log.setdefault(target_username, []).append({"sender": st.session_state.username, "type": "text", "text": text, "ts": time.time()})
+@st.cache_resource(show_spinner=False)
+def get_history(username):
+    folder = os.path.join(DOWNLOAD_DIR, username)
+    os.makedirs(folder, exist_ok=True)
+    return almacen.MessageStore(os.path.join(folder, "historial.db"))
 
-    with _peers_lock:
-        peer_info = st.session_state.peers.get(target_username)
-        sock = peer_info.get("tcp_sock") if peer_info else None
 
-    if sock:
-        try:
-            sock.sendall((json.dumps(payload) + "\n").encode())
-            return True
-        except Exception as e:
-            st.error(f"Error enviando mensaje a {target_username}: {e}")
-            with _peers_lock:
-                if target_username in st.session_state.peers:
-                    try:
-                        st.session_state.peers[target_username]["tcp_sock"].close()
-                    except:
-                        pass
-                    del st.session_state.peers[target_username]
+# Inline images (sent by us, or base64 from old peers) are stored next to
+# the transferred files, named by content hash, so history rows and the
+# chat window only hold a path.
+@st.cache_resource(show_spinner=False)
+def get_images(username):
+    return imagenes.ImageCache(os.path.join(DOWNLOAD_DIR, username), IMAGE_CACHE_BYTES)
+
+
+def save_media(data, name):
+    return get_images(st.session_state.username).put(data, name)
+
+
+# In-memory window of one conversation: the newest CHAT_WINDOW messages
+# from history, plus whatever older pages were loaded with the button.
+def render_image(msg):
+    images = get_images(st.session_state.username)
+    path = msg["image_path"]
+    if st.session_state.expanded_image == path:
+        st.image(images.original(path), caption=msg.get("caption", ""))
+        if st.button("Ver miniatura", key=f"thumb_{msg['id']}"):
+            st.session_state.expanded_image = None
+            st.rerun()
     else:
-        st.warning("Aún no hay conexión TCP directa con el peer. Intenta conectar desde la barra lateral.")
-        return False
+        st.image(images.thumbnail(path), caption=msg.get("caption", ""))
+        if st.button("Ver original", key=f"full_{msg['id']}"):
+            st.session_state.expanded_image = path
+            st.rerun()
 
-def send_image(target_username, image_bytes, caption=""):
-    
-    b64 = base64.b64encode(image_bytes).decode()
-    payload = {"type": "image", "from": st.session_state.username, "image_b64": b64, "caption": caption, "ts": time.time()}
-    st.session_state.chat_log.setdefault(target_username, []).append({"sender": st.session_state.username, "type": "image", "image_bytes": image_bytes, "caption": caption, "ts": time.time()})
 
-    with _peers_lock:
-        peer_info = st.session_state.peers.get(target_username)
-        sock = peer_info.get("tcp_sock") if peer_info else None
+def chat_window(peer):
+    window = st.session_state.chat_log.get(peer)
+    if window is None:
+        messages = get_history(st.session_state.username).page(peer, limit=CHAT_WINDOW)
+        window = st.session_state.chat_log[peer] = {"messages": messages, "more": len(messages) == CHAT_WINDOW}
+    return window
 
-    if sock:
-        try:
-            sock.sendall((json.dumps(payload) + "\n").encode())
+
+def load_older_messages(peer):
+    window = chat_window(peer)
+    if not window["messages"]:
+        return
+    first = window["messages"][0]
+    older = get_history(st.session_state.username).page(peer, (first["ts"], first["id"]), CHAT_WINDOW)
+    window["messages"][:0] = older
+    window["more"] = len(older) == CHAT_WINDOW
+
+
+# Appends to the on-disk history; an open window gets the message too and
+# is trimmed back to the newest CHAT_WINDOW messages.
+def record_message(peer, sender, kind, ts, text=None, caption="", path=None):
+    msg_id = get_history(st.session_state.username).append(peer, sender, kind, ts, text, caption, path)
+    window = st.session_state.chat_log.get(peer)
+    if window is not None:
+        window["messages"].append({"id": msg_id, "sender": sender, "type": kind, "text": text,
+                                   "caption": caption, "image_path": path, "ts": ts})
+        if len(window["messages"]) > CHAT_WINDOW:
+            del window["messages"][:-CHAT_WINDOW]
+            window["more"] = True
+
+
+def request_user_page(prefix, cursor=None):
+    st.session_state.directory_prefix = prefix
+    req = {"action": "list_users", "prefix": prefix, "cursor": cursor, "limit": USER_PAGE_SIZE}
+    try:
+        current_manager().send_server(req)
+    except Exception as e:
+        st.error("No se puede pedir lista al servidor: " + str(e))
+
+
+def send_text_message(target_username, text):
+   
+    record_message(target_username, st.session_state.username, "text", time.time(), text=text)
+    try:
+        if current_manager().send_text(target_username, text):
             return True
-        except Exception as e:
-            st.error(f"Error enviando imagen a {target_username}: {e}")
-            with _peers_lock:
-                if target_username in st.session_state.peers:
-                    try:
-                        st.session_state.peers[target_username]["tcp_sock"].close()
-                    except:
-                        pass
-                    del st.session_state.peers[target_username]
-            return False
-    else:
+        current_manager().send_offline(target_username, text)
+    except OSError as e:
+        st.error(f"Error enviando mensaje a {target_username}: {e}")
+        return False
+    st.toast(f"Sin conexión directa con {target_username}: el servidor guardará el mensaje y lo entregará cuando sea posible.")
+    return True
+
+def send_image(target_username, image_bytes, caption="", name="imagen.png"):
+    
+    path = save_media(image_bytes, name)
+    record_message(target_username, st.session_state.username, "image", time.time(), caption=caption, path=path)
+
+    manager = current_manager()
+    if target_username not in manager.peers_snapshot():
         st.warning("Aún no hay conexión TCP directa con el peer. Intenta conectar desde la barra lateral.")
         return False
+    bar = st.progress(0.0, text=f"Enviando {name}...")
+    try:
+        return manager.send_image(target_username, path, caption, name, FILE_CHUNK_SIZE,
+                                  progress=lambda tid, done, total: bar.progress(done / max(total, 1)))
+    except OSError as e:
+        st.error(f"Error enviando imagen a {target_username}: {e}")
+        return False
+    finally:
+        bar.empty()
 
 
 def process_message_queue():
-    rerun_needed = False
-    mq = st.session_state.message_queue
+    manager = current_manager()
+    # A session that fell too far behind (its tab was left closed) was
+    # dropped by the manager; it gets every new event again from here.
+    mq = manager.events.subscribe(st.session_state.events)
     while True:
         try:
             msg = mq.get_nowait()
@@ -347,96 +323,102 @@ def process_message_queue():
 
         action = msg.get("action") or msg.get("type")
         if action == "user_list":
-            st.session_state.online_users = msg.get("users", [])
-            rerun_needed = True
-
-        elif action == "peer_info":
-            peer_username = msg.get("peer_username")
-            ip = msg.get("ip")
-            tcp_port = msg.get("tcp_port")
-            try:
-                peer_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                peer_sock.settimeout(5)
-                peer_sock.connect((ip, tcp_port))
-                peer_sock.settimeout(None)
-                with _peers_lock:
-                    st.session_state.peers[peer_username] = {"tcp_sock": peer_sock, "addr": (ip, tcp_port)}
-                st.toast(f"Conectado TCP a {peer_username}")
-                intro = {"type": "text", "from": st.session_state.username, "text": f"[conexion directa establecida]", "ts": time.time()}
-                peer_sock.sendall((json.dumps(intro) + "\n").encode())
-                rerun_needed = True
-            except Exception as e:
-                st.error(f"Fallo al conectar a peer {peer_username} ({ip}:{tcp_port}): {e}")
+            if msg.get("prefix", "") == st.session_state.directory_prefix:
+                if msg.get("cursor"):
+                    st.session_state.online_users.extend(msg.get("users", []))
+                else:
+                    st.session_state.online_users = msg.get("users", [])
+                st.session_state.directory_cursor = msg.get("next_cursor")
+
+        elif action == "presence":
+            view = st.session_state.presence
+            if not view.apply(msg):
+                try:
+                    manager.send_server({"action": "subscribe_presence"})
+                except OSError:
+                    pass
+
+        elif action == "peer_connected":
+            via = " (relevo por el servidor)" if msg.get("relayed") else ""
+            st.toast(f"Conectado TCP a {msg.get('username')}{via}")
 
         elif action == "server_disconnected":
-            st.warning("Servidor central desconectado. Seguirás en modo P2P con peers ya conectados.")
-            
+            if msg.get("reconnecting"):
+                st.warning("Servidor central desconectado; reconectando. Los peers ya conectados siguen disponibles.")
+            else:
+                st.warning("Servidor central desconectado. Seguirás en modo P2P con peers ya conectados.")
 
-        elif action == "error":
+        elif action == "server_reconnected":
+            st.toast("Reconectado al servidor central")
+
+        elif action == "error" or msg.get("status") == "error":
             st.error(msg.get("content") or msg.get("msg"))
 
         elif action == "peer_disconnected":
             uname = msg.get("username")
-            if uname and uname in st.session_state.peers:
-                with _peers_lock:
-                    try:
-                        st.session_state.peers[uname]["tcp_sock"].close()
-                    except:
-                        pass
-                    del st.session_state.peers[uname]
+            if uname:
                 st.toast(f"Peer {uname} se desconectó")
-                rerun_needed = True
+
+        elif action == "file_progress":
+            st.session_state.incoming_files[msg["transfer_id"]] = (msg.get("name"), msg["done"] / max(msg["total"], 1))
+
+        elif action == "file_error":
+            st.session_state.incoming_files.pop(msg["transfer_id"], None)
+            st.error(f"Se descartó {msg.get('name')}: {msg.get('reason')}")
+
+        elif action == "file":
+            sender = msg.get("from") or "Peer"
+            st.session_state.incoming_files.pop(os.path.splitext(os.path.basename(msg["path"]))[0], None)
+            ts = msg.get("ts", time.time())
+            if (msg.get("mime") or "").startswith("image/"):
+                record_message(sender, sender, "image", ts, caption=msg.get("caption", ""), path=msg["path"])
+            else:
+                record_message(sender, sender, "text", ts, text=f"[Archivo recibido] {msg.get('name')} ({msg['path']})")
 
         elif msg.get("type") in ("text", "image"):
             sender = msg.get("from") or msg.get("sender") or "Peer"
             mtype = msg.get("type")
             if mtype == "text":
-                text = msg.get("text", "")
-                st.session_state.chat_log.setdefault(sender, []).append({"sender": sender, "type": "text", "text": text, "ts": msg.get("ts", time.time())})
+                record_message(sender, sender, "text", msg.get("ts", time.time()), text=msg.get("text", ""))
             elif mtype == "image":
                 b64 = msg.get("image_b64")
-                caption = msg.get("caption", "")
                 try:
-                    img_bytes = base64.b64decode(b64) if b64 else None
+                    path = save_media(base64.b64decode(b64), msg.get("name", "imagen.png")) if b64 else None
                 except Exception:
-                    img_bytes = None
-                st.session_state.chat_log.setdefault(sender, []).append({"sender": sender, "type": "image", "image_bytes": img_bytes, "caption": caption, "ts": msg.get("ts", time.time())})
-            rerun_needed = True
-
-        else:
-            if "sender" in msg and ("text" in msg or "image_bytes" in msg):
-                sender = msg.get("sender")
-                if msg.get("text"):
-                    st.session_state.chat_log.setdefault(sender, []).append({"sender": sender, "type": "text", "text": msg.get("text"), "ts": time.time()})
-                elif msg.get("image_bytes"):
-                    st.session_state.chat_log.setdefault(sender, []).append({"sender": sender, "type": "image", "image_bytes": msg.get("image_bytes"), "caption": msg.get("caption",""), "ts": time.time()})
-                rerun_needed = True
-
-    if rerun_needed:
-        try:
-            st.rerun()
-        except Exception:
-            pass
+                    path = None
+                record_message(sender, sender, "image", msg.get("ts", time.time()), caption=msg.get("caption", ""), path=path)
 
 
 def logout():
-    try:
-        if st.session_state.server_socket:
-            st.session_state.server_socket.close()
-    except:
-        pass
-    with _peers_lock:
-        for p in list(st.session_state.peers.keys()):
-            try:
-                st.session_state.peers[p]["tcp_sock"].close()
-            except:
-                pass
-            del st.session_state.peers[p]
+    with get_sessions_lock():
+        manager = current_manager()
+        if not manager.events.unsubscribe(st.session_state.events):
+            manager.close()
+            # Only this login's entry: other users in the same process keep theirs.
+            get_manager.clear(st.session_state.username, st.session_state.local_tcp_port, st.session_state.local_udp_port)
+    st.session_state.events = None
     st.session_state.logged_in = False
     st.session_state.username = ""
-    st.session_state.server_socket = None
     st.session_state.chatting_with = None
+    st.session_state.chat_log = {}
     st.session_state.online_users = []
+    st.session_state.directory_prefix = None
+    st.session_state.directory_cursor = None
+    st.session_state.presence = presencia.PresenceView()
+
+
+# The listener threads cannot rerun the page themselves, so this fragment
+# polls their queue: only the fragment reruns every QUEUE_POLL_INTERVAL,
+# and the full page reruns only when there is something to process.
+# Streamlit versions without st.fragment fall back to rerunning the whole
+# page on the same interval.
+def watch_message_queue():
+    if st.session_state.events is not None and not st.session_state.events.empty():
+        st.rerun()
+
+
+if hasattr(st, "fragment"):
+    watch_message_queue = st.fragment(run_every=QUEUE_POLL_INTERVAL)(watch_message_queue)
 
 
 def main():
@@ -446,9 +428,11 @@ def main():
     if st.session_state.logged_in:
         process_message_queue()
         chat_page()
-
-        time.sleep(0.5)
-        st.rerun()
+        if hasattr(st, "fragment"):
+            watch_message_queue()
+        else:
+            time.sleep(QUEUE_POLL_INTERVAL)
+            st.rerun()
 
     else:
         login_page()
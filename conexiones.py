@@ -0,0 +1,828 @@
+import base64
+import hashlib
+import itertools
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from queue import Full, Queue
+
+import canales
+import credenciales
+import descubrimiento
+import medios
+import protocolo
+import transferencia
+
+CONNECT_TIMEOUT = 5  # deadline for a direct connection before falling back to the relay
+DIAL_GRACE = 3  # seconds the larger username waits for the smaller one to dial
+RELAY_JOIN_TIMEOUT = 15  # seconds to wait for the peer to join a relay
+# Reconnecting to the server: attempt n waits a random time between 0 and
+# min(RECONNECT_MAX, RECONNECT_BASE * 2**n), so clients dropped together by
+# a server restart come back spread out instead of all at once.
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30
+PENDING_CONNECT_TTL = 60  # seconds a connect request is worth repeating after a reconnect
+HELLO_MAX_AGE = 60  # seconds a hello's nonce is accepted; each one only once
+# Skip direct connections and always use the server relay (NAT testing on
+# loopback).
+FORCE_RELAY = os.environ.get("P2P_FORCE_RELAY") == "1"
+# Find peers on the same subnet through UDP announcements (descubrimiento.py)
+# and dial them without asking the server for their address. Off unless
+# P2P_LAN_DISCOVERY=1: it announces the user to everyone on the subnet.
+LAN_DISCOVERY = os.environ.get("P2P_LAN_DISCOVERY") == "1"
+SUBSCRIBER_MAX_EVENTS = 10_000  # a subscriber this far behind has stopped reading and is dropped
+
+
+# shutdown() first so reader threads blocked in recv on the socket wake up.
+def _close(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def _base64(source):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = f.read()
+    return base64.b64encode(source).decode()
+
+
+def _number(value, default):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else default
+
+
+# The UI event for a chat message from a peer, rebuilt from its fields:
+# only the wire types ("text", "image") come from peers, so a peer cannot
+# post the manager's own events (file, file_progress, peer_connected...).
+# Anything else is None. The sender is the link's, once its hello named
+# it; old peers without a hello name themselves.
+def _peer_event(payload, peer_username, addr):
+    sender = peer_username or payload.get("from")
+    if not isinstance(sender, str):
+        sender = None
+    kind = payload.get("type")
+    if kind == "text" and isinstance(payload.get("text"), str):
+        return {"type": "text", "from": sender, "text": payload["text"], "ts": _number(payload.get("ts"), time.time()),
+                "_from_addr": addr}
+    if kind == "image" and isinstance(payload.get("image_b64"), str):
+        caption = payload.get("caption")
+        return {"type": "image", "from": sender, "image_b64": payload["image_b64"],
+                "caption": caption if isinstance(caption, str) else "", "ts": _number(payload.get("ts"), time.time()),
+                "_from_addr": addr}
+    return None
+
+
+# Sends one request to the server on a new socket and returns the socket,
+# its protocolo.FrameReader and the first response.
+def request(server_addr, payload, timeout=CONNECT_TIMEOUT):
+    sock = socket.create_connection(server_addr, timeout=timeout)
+    try:
+        protocolo.send(sock, payload)
+        reader = protocolo.FrameReader(sock)
+        response = protocolo.decode(*next(iter(reader)))
+        sock.settimeout(None)
+    except:
+        sock.close()
+        raise
+    return sock, reader, response
+
+
+def register(server_addr, username, password):
+    sock, _, response = request(server_addr, {"action": "register", "username": username, "password": password})
+    sock.close()
+    return response.get("status") == "ok", response.get("msg")
+
+
+# A manager's event queue. Several consumers of one manager (Streamlit
+# sessions of the same user) each subscribe() and get every event on a
+# queue of their own; with no subscribers, events stay on this queue for
+# whoever reads it directly (the CLI, tests). The first subscriber takes
+# over what was already queued.
+class EventQueue(Queue):
+    def __init__(self):
+        super().__init__()
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+
+    def subscribe(self, queue=None):
+        queue = queue if queue is not None else Queue(SUBSCRIBER_MAX_EVENTS)
+        with self.subscribers_lock:
+            if not self.subscribers:
+                while not self.empty():
+                    queue.put_nowait(self.get_nowait())
+            if queue not in self.subscribers:
+                self.subscribers.append(queue)
+        return queue
+
+    # Returns the number of subscribers left.
+    def unsubscribe(self, queue):
+        with self.subscribers_lock:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+            return len(self.subscribers)
+
+    def put(self, item, block=True, timeout=None):
+        with self.subscribers_lock:
+            if not self.subscribers:
+                return super().put(item, block, timeout)
+            for queue in list(self.subscribers):
+                try:
+                    queue.put_nowait(item)
+                except Full:
+                    self.subscribers.remove(queue)
+
+
+# Owns every socket and background thread of one logged-in client: the
+# server connection, the P2P TCP listener, the peer links, file transfers
+# and the UDP media receiver. Listener threads never touch UI state; they
+# put events (dicts) on `events`, and the UI reads peers through
+# peers_snapshot(). Created once per process so UI reruns reuse it.
+#
+# Each pair of users shares one link. The peer links start with a hello
+# that carries the sender's username; the user whose name sorts first is
+# the one that dials, the other only dials if nothing arrived after
+# DIAL_GRACE. If both links come up anyway, both sides keep the one dialed
+# by the smaller name and close the other.
+#
+# When the direct connection fails, the link goes through the server
+# instead (relay_request / relay_join, see relevo.py on the server): the
+# relayed socket carries the same peer protocol, with the smaller name in
+# the dialer role, and a direct link that comes up later replaces it.
+#
+# If the server connection drops after a login, a supervisor thread logs
+# in again with backoff (see RECONNECT_BASE) and replays what the server
+# lost with it: the presence subscription, connect requests that had not
+# produced a link yet (again when the target shows up in presence) and
+# send_offline requests it never answered. Peer
+# links are not affected. A replayed send_offline whose answer was lost
+# can be stored twice; delivery is at least once.
+#
+# With LAN discovery, connect() dials a peer found in the discovery cache
+# directly; the server's connect_to_peer / peer_info is only the fallback
+# when the peer is not cached, the cached address does not answer, or
+# what answers cannot prove it is that user (see _lan_handshake).
+class ConnectionManager:
+    def __init__(self, server_addr, username, tcp_port, udp_port, download_dir, events=None, on_media=None,
+                 on_media_end=None, force_relay=FORCE_RELAY, lan_discovery=LAN_DISCOVERY):
+        self.server_addr = server_addr
+        self.username = username
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.events = events if events is not None else EventQueue()
+        self.lock = threading.Lock()
+        self.peers_changed = threading.Condition(self.lock)
+        self.peers = {}      # username -> {"tcp_sock", "addr", "udp_addr", "dialer", "relayed"}
+        self.dialing = set()
+        self.on_media = on_media or (lambda key, seq, ts, payload: None)
+        self.on_media_end = on_media_end
+        self.force_relay = force_relay
+        self.lan_discovery = lan_discovery
+        self.discovery = None
+        self.offline_acked = 0  # highest outbox id acknowledged to the server
+        self.server_sock = None
+        self.password_digest = None
+        self.session_token = None  # from the last login; used instead of the password next time
+        self.password = None       # for the supervisor, when the token is refused
+        self.peer_key = None       # (key, expires) from the server, to answer LAN dialers
+        self.closed = threading.Event()
+        self.reconnecting = False
+        self.pending_connects = {}  # target -> (request, sent at), until a link to target comes up
+        self.unacked = {}           # ref -> send_offline request, until the server answers it
+        self.calls = {}             # ref -> [Event, reply] for _server_call
+        self.verified = {}          # (username, ip, port) -> until when a LAN address is known good
+        self.seen_nonces = {}       # nonce of an incoming hello -> when it arrived
+        self.refs = itertools.count(1)
+        self.listen_sock = None
+        self.media_receiver = None
+        self.transfers = transferencia.Transfers(os.path.join(download_dir, username), on_progress=self._file_progress,
+                                                  on_error=self._file_error)
+
+    @property
+    def connected(self):
+        return self.server_sock is not None
+
+    # Logging in again after a disconnect sends the session token from the
+    # previous login instead of the password, which the server checks
+    # without hashing; if it was refused (server restarted, token expired)
+    # the password is sent as usual.
+    def login(self, password):
+        digest = hashlib.sha256(password.encode()).digest()
+        with self.lock:
+            if self.server_sock is not None:
+                if digest == self.password_digest:
+                    return True, "Logged in"
+                return False, "Invalid credentials"
+            token = self.session_token if digest == self.password_digest else None
+        response = None
+        if token:
+            sock, reader, response = self._login_request(token=token)
+            if response.get("status") != "ok":
+                sock.close()
+                response = None
+        if response is None:
+            sock, reader, response = self._login_request(password=password)
+        if response.get("status") != "ok":
+            sock.close()
+            return False, response.get("msg")
+        protocolo.set_wire(sock, protocolo.accept_caps(response.get("caps")))
+        with self.lock:
+            if self.server_sock is not None:  # the supervisor got there first
+                sock.close()
+                return True, "Logged in"
+            self.server_sock = sock
+            self.password_digest = digest
+            self.password = password
+            self.session_token = response.get("token")
+            if response.get("peer_key"):
+                self.peer_key = (response["peer_key"], response.get("peer_key_expires"))
+            now = time.monotonic()
+            replay = [req for target, (req, sent) in self.pending_connects.items()
+                      if target not in self.peers and now - sent < PENDING_CONNECT_TTL]
+            replay += list(self.unacked.values())
+        protocolo.send(sock, {"action": "subscribe_presence"})
+        for req in replay:
+            protocolo.send(sock, req)
+        threading.Thread(target=self._server_listener, args=(sock, reader, response.get("heartbeat")), daemon=True).start()
+        self._start_listeners()
+        return True, response.get("msg")
+
+    def _login_request(self, **credentials):
+        return request(self.server_addr, dict(
+            credentials, action="login", username=self.username, tcp_port=self.tcp_port, udp_port=self.udp_port,
+            caps=dict(protocolo.capabilities(), heartbeat=True)))
+
+    def _start_listeners(self):
+        with self.lock:
+            if self.listen_sock is not None:
+                return
+            self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen_sock.bind(('', self.tcp_port))
+            self.listen_sock.listen()
+            print(f"[TCP LISTEN] P2P TCP listening on {self.tcp_port}")
+            threading.Thread(target=self._tcp_listen, args=(self.listen_sock,), daemon=True).start()
+        except OSError as e:
+            self.events.put({"type": "error", "content": f"[ERROR TCP Listen] {e}"})
+        try:
+            self.media_receiver = medios.MediaReceiver(medios.open_socket(self.udp_port), self.on_media,
+                                                       on_stream_end=self.on_media_end)
+            threading.Thread(target=self.media_receiver.run, daemon=True).start()
+        except OSError as e:
+            self.events.put({"type": "error", "content": f"No se pudo abrir el puerto UDP {self.udp_port}: {e}"})
+        if self.lan_discovery:
+            try:
+                self.discovery = descubrimiento.Discovery(self.username, self.tcp_port, self.udp_port)
+                self.discovery.start()
+                threading.Thread(target=self._refresh_peer_key, daemon=True).start()
+            except OSError as e:
+                self.events.put({"type": "error", "content": f"Descubrimiento en la LAN desactivado: {e}"})
+
+    # The peer key expires; ask for a new one halfway through its life. A
+    # reconnect gets a fresh one with the login anyway.
+    def _refresh_peer_key(self):
+        while not self.closed.wait(credenciales.PEER_KEY_TTL / 2):
+            try:
+                self.send_server({"action": "peer_key"})
+            except OSError:
+                pass
+
+    # `heartbeat` is the longest silence the server allows. It pings us
+    # before that when we are quiet and answers our pings, so if nothing
+    # arrives for that long we ping it, and a second silent period means the
+    # server (or the path to it) is gone even though TCP never said so.
+    def _server_listener(self, sock, reader, heartbeat=None):
+        missed = False
+        try:
+            if heartbeat:
+                sock.settimeout(heartbeat)
+            while True:
+                try:
+                    for flags, body in reader:
+                        missed = False
+                        self._server_message(sock, flags, body)
+                    break
+                except socket.timeout:
+                    if missed:
+                        raise ConnectionError("the server stopped answering heartbeats")
+                    missed = True
+                    protocolo.send(sock, {"action": "ping"})
+        except Exception as e:
+            print("[ERROR CLIENT] server_listener:", e)
+            self.events.put({"type": "error", "content": f"[SERVER ERROR] {e}"})
+        finally:
+            with self.lock:
+                lost = self.server_sock is sock
+                if lost:
+                    self.server_sock = None
+                supervise = lost and self.password is not None and not self.closed.is_set() and not self.reconnecting
+                if supervise:
+                    self.reconnecting = True
+            _close(sock)
+            self.events.put({"type": "server_disconnected", "reconnecting": supervise or self.reconnecting})
+            if supervise:
+                threading.Thread(target=self._reconnect, daemon=True).start()
+
+    def _reconnect(self):
+        try:
+            for attempt in itertools.count():
+                if self.closed.wait(random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt))):
+                    return
+                try:
+                    ok, msg = self.login(self.password)
+                except (OSError, ValueError, StopIteration):
+                    continue
+                if ok:
+                    self.events.put({"type": "server_reconnected", "attempts": attempt + 1})
+                else:
+                    self.events.put({"type": "error", "content": f"[SERVER ERROR] No se pudo volver a iniciar sesión: {msg}"})
+                return
+        finally:
+            with self.lock:
+                self.reconnecting = False
+
+    def _server_message(self, sock, flags, body):
+        try:
+            payload = protocolo.decode(flags, body)
+        except Exception as e:
+            print("[DEBUG] JSON parse fail from server:", e, bytes(body[:200]))
+            return
+        if "ref" in payload:
+            with self.lock:
+                self.unacked.pop(payload["ref"], None)
+                waiter = self.calls.get(payload["ref"])
+            if waiter is not None:
+                waiter[1] = payload
+                waiter[0].set()
+                return
+        if payload.get("action") == "ping":
+            protocolo.send(sock, {"action": "pong"})
+        elif payload.get("action") == "pong":
+            pass  # receiving it already reset the heartbeat timeout
+        elif payload.get("action") == "peer_key":
+            self.peer_key = (payload.get("key"), payload.get("expires"))
+        elif payload.get("action") == "peer_info":
+            threading.Thread(target=self.connect_peer, args=(payload.get("peer_username"), payload.get("ip"), payload.get("tcp_port"), payload.get("udp_port")), daemon=True).start()
+        elif payload.get("action") == "relay_info":
+            threading.Thread(target=self._join_relay, args=(payload.get("peer_username"), payload.get("token")), daemon=True).start()
+        elif payload.get("action") == "offline_batch":
+            self._offline_batch(sock, payload.get("messages") or [])
+        else:
+            if payload.get("action") == "presence":
+                self._retry_connects(sock, payload.get("snapshot") or payload.get("joined") or ())
+            self.events.put(payload)
+
+    # A replayed connect request fails if the target has not logged back in
+    # yet; it is sent again when presence reports them online.
+    def _retry_connects(self, sock, online):
+        now = time.monotonic()
+        with self.lock:
+            retry = [req for target, (req, sent) in self.pending_connects.items()
+                     if target in online and target not in self.peers and now - sent < PENDING_CONNECT_TTL]
+        for req in retry:
+            protocolo.send(sock, req)
+
+    # Messages stored by the server while we were offline arrive as text
+    # events (marked "offline"), rebuilt here so a stored message cannot
+    # pose as any other event; one cumulative ack per batch lets the
+    # server prune them. Ids already acked are redeliveries and skipped.
+    def _offline_batch(self, sock, items):
+        for item in items:
+            msg = item.get("message")
+            if item["id"] <= self.offline_acked or not isinstance(msg, dict):
+                continue
+            if msg.get("type") != "text" or not isinstance(msg.get("text"), str):
+                continue
+            self.events.put({"type": "text", "from": item["from"], "text": msg["text"], "ts": _number(msg.get("ts"), item["ts"]),
+                             "offline": True})
+        if items:
+            self.offline_acked = max(self.offline_acked, items[-1]["id"])
+            protocolo.send(sock, {"action": "ack_offline", "upto": self.offline_acked})
+
+    def _tcp_listen(self, listen_sock):
+        try:
+            while True:
+                conn, addr = listen_sock.accept()
+                threading.Thread(target=self._peer_reader, args=(conn, addr), daemon=True).start()
+        except OSError as e:
+            if self.listen_sock is listen_sock:
+                print("[ERROR] tcp_listen:", e)
+
+    # Returns False when `sock` lost the tie-break against the link already
+    # registered for `peer`; the caller closes it. A link that wins
+    # replaces (and closes) the current one. An incoming link whose hello
+    # could not be verified (`trusted` False) never replaces a live one:
+    # otherwise anyone reaching our port could claim a name that wins the
+    # tie-break and take the link over.
+    def _register_link(self, peer, sock, addr, dialer, udp_addr=None, relayed=False, trusted=True):
+        winner = min(self.username, peer)
+        with self.lock:
+            current = self.peers.get(peer)
+            if current and current["tcp_sock"] is not sock and (not trusted or (current["dialer"] == winner and dialer != winner)):
+                return False
+            self.peers[peer] = {"tcp_sock": sock, "addr": addr, "dialer": dialer, "relayed": relayed,
+                                "udp_addr": udp_addr or (current or {}).get("udp_addr")}
+            self.pending_connects.pop(peer, None)
+            self.peers_changed.notify_all()
+        if current is None:
+            self.events.put({"type": "peer_connected", "username": peer, "relayed": relayed})
+        elif current["tcp_sock"] is not sock:
+            _close(current["tcp_sock"])
+        return True
+
+    # Asks for a link to `peer_username`: straight to its address when LAN
+    # discovery has it, otherwise through the server.
+    def connect(self, peer_username):
+        entry = self.discovery.lookup(peer_username) if self.discovery else None
+        if entry is None:
+            self.send_server({"action": "connect_to_peer", "target_username": peer_username})
+            return
+        threading.Thread(target=self.connect_peer, args=(peer_username, *entry), kwargs={"via_lan": True}, daemon=True).start()
+
+    # `via_lan`: only this side dials (the peer got no peer_info), so there
+    # is no grace period, and a failure falls back to the server.
+    def connect_peer(self, peer_username, ip, tcp_port, udp_port=None, via_lan=False):
+        with self.lock:
+            if peer_username in self.peers or peer_username in self.dialing:
+                return
+            self.dialing.add(peer_username)
+            if self.username > peer_username and not via_lan:
+                self.peers_changed.wait_for(lambda: peer_username in self.peers, DIAL_GRACE)
+                if peer_username in self.peers:
+                    self.dialing.discard(peer_username)
+                    return
+        try:
+            if self.force_relay:
+                raise ConnectionRefusedError("direct connections disabled (P2P_FORCE_RELAY)")
+            if via_lan:
+                peer_sock, frames = self._lan_handshake(peer_username, ip, tcp_port)
+            else:
+                peer_sock, frames = socket.create_connection((ip, tcp_port), timeout=CONNECT_TIMEOUT), None
+                peer_sock.settimeout(None)
+        except OSError as e:
+            if via_lan:
+                self.discovery.cache.drop(peer_username)
+                with self.lock:
+                    self.dialing.discard(peer_username)  # before peer_info can arrive
+                try:
+                    self.send_server({"action": "connect_to_peer", "target_username": peer_username})
+                except OSError as e:
+                    self.events.put({"type": "error", "content": f"No se pudo conectar a {peer_username}: {e}"})
+                return
+            if not self.force_relay:
+                self.events.put({"type": "error", "content": f"Fallo al conectar a peer {peer_username} ({ip}:{tcp_port}): {e}. Probando relevo por el servidor."})
+            self._request_relay(peer_username)
+            return
+        finally:
+            with self.lock:
+                self.dialing.discard(peer_username)
+        self._start_link(peer_username, peer_sock, (ip, tcp_port), (ip, udp_port) if udp_port else None, frames,
+                         greeted=via_lan)
+
+    # One request over the logged-in server connection; the reply is matched
+    # by the `ref` the server echoes. Raises ConnectionError when there is
+    # no connection or no answer in time.
+    def _server_call(self, payload, timeout=CONNECT_TIMEOUT):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            sock = self.server_sock
+            ref = payload["ref"] = next(self.refs)
+            self.calls[ref] = waiter
+        try:
+            if sock is None:
+                raise ConnectionError("no server connection")
+            protocolo.send(sock, payload)
+            if not waiter[0].wait(timeout):
+                raise ConnectionError("the server did not answer")
+            return waiter[1]
+        finally:
+            with self.lock:
+                self.calls.pop(ref, None)
+
+    # hello for a link to (ip, port). The nonce (time-stamped, so the
+    # receiver can refuse old ones) is what the peer's hello_ack answers;
+    # the proof is our own answer to it for the address we dialed, so the
+    # peer can check who is dialing. Relayed links have no address to bind
+    # and go without: the server paired them itself.
+    def _hello(self, ip=None, port=None):
+        nonce = f"{int(time.time())}.{secrets.token_urlsafe(12)}"
+        hello = {"type": "hello", "from": self.username, "udp_port": self.udp_port, "caps": protocolo.capabilities(),
+                 "nonce": nonce}
+        if ip is not None and self.peer_key:
+            hello["proof"] = {"expires": self.peer_key[1],
+                              "answer": credenciales.peer_answer(self.peer_key[0], nonce, ip, port)}
+        return hello
+
+    # Has the server check that `proof` is `username`'s answer to `nonce` for
+    # (ip, port). True or False, or None when there is no proof or the
+    # server cannot be asked.
+    def _verify_peer(self, username, proof, nonce, ip, port):
+        if not isinstance(proof, dict):
+            return None
+        try:
+            verdict = self._server_call({"action": "verify_peer", "username": username, "expires": proof.get("expires"),
+                                         "nonce": nonce, "ip": ip, "port": port, "answer": proof.get("answer")})
+        except OSError:
+            return None
+        return verdict.get("status") == "ok"
+
+    # Identity of an incoming hello: its proof must be for the address it
+    # reached us on, and its nonce recent and not seen before, so a hello
+    # captured on the way cannot be played again.
+    def _check_hello(self, conn, payload):
+        nonce = payload.get("nonce")
+        try:
+            age = abs(time.time() - int(nonce.partition(".")[0]))
+        except (AttributeError, ValueError):
+            return None
+        now = time.monotonic()
+        with self.lock:
+            if age > HELLO_MAX_AGE or nonce in self.seen_nonces:
+                return False
+            self.seen_nonces[nonce] = now
+            if len(self.seen_nonces) > 1024:
+                self.seen_nonces = {n: t for n, t in self.seen_nonces.items() if now - t <= 2 * HELLO_MAX_AGE}
+        return self._verify_peer(payload.get("from"), payload.get("proof"), nonce, *conn.getsockname()[:2])
+
+    # An address from a LAN announcement is only a claim. The hello_ack must
+    # carry the peer's answer to our hello's nonce, made with the key the
+    # server gave that user, and the server checks it (verify_peer, over
+    # the session we already have) before the link is registered. A checked
+    # address is trusted for as long as the discovery cache keeps it.
+    # Raises ConnectionError when the peer cannot prove who it is, so the
+    # caller falls back to the server.
+    def _lan_handshake(self, peer_username, ip, tcp_port):
+        hello = self._hello(ip, tcp_port)
+        sock, frames, ack = request((ip, tcp_port), hello)
+        try:
+            if ack.get("type") != "hello_ack" or ack.get("from") != peer_username:
+                raise ConnectionError(f"{ip}:{tcp_port} is not {peer_username}")
+            key = (peer_username, ip, tcp_port)
+            now = time.monotonic()
+            with self.lock:
+                known = self.verified.get(key, 0) > now
+            if not known:
+                if not self._verify_peer(peer_username, ack.get("proof"), hello["nonce"], ip, tcp_port):
+                    self.events.put({"type": "error", "content": f"{ip}:{tcp_port} se anunció como {peer_username} sin poder demostrarlo"})
+                    raise ConnectionError(f"{peer_username} on the LAN failed the identity check")
+                with self.lock:
+                    self.verified = {k: t for k, t in self.verified.items() if t > now}
+                    self.verified[key] = now + descubrimiento.PEER_TTL
+        except BaseException:
+            _close(sock)
+            raise
+        protocolo.set_wire(sock, protocolo.accept_caps(ack.get("caps")))
+        return sock, frames
+
+    # Dialer side of a link: register it, then hello and the intro text.
+    # hello goes on the CONTROL channel, ahead of anything queued for chat;
+    # `greeted` links already exchanged it in _lan_handshake.
+    def _start_link(self, peer_username, peer_sock, addr, udp_addr, frames=None, relayed=False, greeted=False):
+        link = canales.attach(peer_sock)
+        if not self._register_link(peer_username, peer_sock, addr, self.username, udp_addr, relayed):
+            canales.detach(peer_sock)
+            _close(peer_sock)
+            return
+        threading.Thread(target=self._peer_reader, args=(peer_sock, addr, peer_username, frames, relayed), daemon=True).start()
+        intro = "[conexion por relevo del servidor]" if relayed else "[conexion directa establecida]"
+        try:
+            if not greeted:
+                link.send(self._hello() if relayed else self._hello(*addr), canales.CONTROL)
+            link.send({"type": "text", "from": self.username, "text": intro, "ts": time.time()})
+        except OSError:
+            pass  # replaced by the peer's link in the meantime; the reader cleans up
+
+    def _request_relay(self, peer_username):
+        with self.lock:
+            if peer_username in self.peers:
+                return
+        try:
+            self.send_server({"action": "relay_request", "target_username": peer_username})
+        except OSError as e:
+            self.events.put({"type": "error", "content": f"No se pudo pedir relevo para {peer_username}: {e}"})
+
+    # Both users get relay_info with the same token and join from a new
+    # server connection; relay_ready arrives once the other side is there.
+    def _join_relay(self, peer_username, token):
+        with self.lock:
+            if not peer_username or peer_username in self.peers:
+                return
+        try:
+            sock, frames, response = request(self.server_addr, {"action": "relay_join", "token": token}, RELAY_JOIN_TIMEOUT)
+        except Exception as e:
+            self.events.put({"type": "error", "content": f"Relevo con {peer_username} falló: {e}"})
+            return
+        if response.get("action") != "relay_ready":
+            sock.close()
+            self.events.put({"type": "error", "content": f"Relevo con {peer_username} falló: {response.get('msg')}"})
+            return
+        # Frames the peer sent right behind relay_ready may already be
+        # buffered in `frames`, so the reader continues that iterator.
+        if self.username < peer_username:
+            self._start_link(peer_username, sock, self.server_addr, None, frames, relayed=True)
+        else:
+            threading.Thread(target=self._peer_reader, args=(sock, self.server_addr, peer_username, frames, True), daemon=True).start()
+
+    # Every peer socket gets a canales.LinkScheduler and only its writer
+    # thread writes to the socket: the reader queues hello_ack and the
+    # file_* replies on the CONTROL channel, so it never blocks on a peer
+    # that is itself blocked writing to us. A frame is encoded when it is
+    # queued, so hello_ack still goes out in the wire format from before
+    # the negotiation.
+    def _peer_reader(self, conn, addr, peer_username=None, frames=None, relayed=False):
+        link = canales.attach(conn)
+        try:
+            for flags, body in frames or protocolo.FrameReader(conn):
+                if flags & protocolo.BINARY:
+                    self.transfers.handle_chunk(conn, body)
+                    continue
+                try:
+                    payload = protocolo.decode(flags, body)
+                except ValueError:
+                    raw = str(body, "utf-8", "ignore").strip()
+                    self.events.put({"type": "text", "from": peer_username or "Peer", "text": raw})
+                    continue
+                if payload.get("type") == "hello":
+                    name = payload.get("from")
+                    if not name or name == self.username:
+                        break
+                    # A relay was paired by the server, so its peer is who the
+                    # server said. A direct hello either proves its name or
+                    # stays untrusted: a proof can also fail honestly (the
+                    # dialer went through a port forward, so the address it
+                    # signed is not ours), so that alone does not close it.
+                    if relayed and name != peer_username:
+                        break
+                    trusted = relayed or self._check_hello(conn, payload) is True
+                    udp_addr = (addr[0], payload["udp_port"]) if payload.get("udp_port") and not relayed else None
+                    if not self._register_link(name, conn, addr, name, udp_addr, relayed, trusted):
+                        break
+                    peer_username = name
+                    wire = protocolo.negotiate(payload.get("caps"))
+                    ack = {"type": "hello_ack", "from": self.username, "caps": protocolo.wire_caps(wire)}
+                    if isinstance(payload.get("nonce"), str) and self.peer_key:
+                        ip, port = conn.getsockname()[:2]  # the address the dialer used
+                        ack["proof"] = {"expires": self.peer_key[1],
+                                        "answer": credenciales.peer_answer(self.peer_key[0], payload["nonce"], ip, port)}
+                    link.send(ack, canales.CONTROL)
+                    protocolo.set_wire(conn, wire)
+                elif payload.get("type") == "hello_ack":
+                    protocolo.set_wire(conn, protocolo.accept_caps(payload.get("caps")))
+                elif payload.get("type") in transferencia.CONTROL_TYPES:
+                    done = self.transfers.handle_control(conn, payload)
+                    if done:
+                        self.events.put(done)
+                else:
+                    event = _peer_event(payload, peer_username, addr)
+                    if event:
+                        self.events.put(event)
+                # Old peers send no hello: learn the name from their first message.
+                if peer_username is None and payload.get("from") and payload.get("type") in ("text", "image", "file_offer"):
+                    peer_username = payload["from"]
+                    with self.lock:
+                        if peer_username not in self.peers:
+                            self.peers[peer_username] = {"tcp_sock": conn, "addr": addr, "dialer": peer_username, "relayed": False, "udp_addr": None}
+                            self.peers_changed.notify_all()
+        except Exception:
+            pass
+        finally:
+            canales.detach(conn)
+            self.transfers.drop(conn)
+            try:
+                conn.close()
+            except OSError:
+                pass
+            with self.lock:
+                gone = [u for u, info in self.peers.items() if info["tcp_sock"] is conn]
+                for uname in gone:
+                    del self.peers[uname]
+            # A link closed because it lost the tie-break was never the peer's link.
+            if gone:
+                self.events.put({"type": "peer_disconnected", "addr": addr, "username": gone[0]})
+
+    def _file_progress(self, meta, done, total):
+        self.events.put({"type": "file_progress", "transfer_id": meta["transfer_id"], "name": meta.get("name"), "done": done, "total": total})
+
+    def _file_error(self, meta, reason):
+        self.events.put({"type": "file_error", "transfer_id": meta["transfer_id"], "name": meta.get("name"), "reason": reason})
+
+    # Connect requests and send_offline are remembered for the supervisor
+    # first; while it is reconnecting they are only queued, other requests
+    # fail.
+    def send_server(self, payload):
+        action = payload.get("action")
+        with self.lock:
+            if action in ("connect_to_peer", "relay_request"):
+                self.pending_connects[payload.get("target_username")] = (payload, time.monotonic())
+            elif action == "send_offline":
+                payload["ref"] = next(self.refs)
+                self.unacked[payload["ref"]] = payload
+            sock = self.server_sock
+            queued = self.reconnecting and action in ("connect_to_peer", "relay_request", "send_offline")
+        if sock is None:
+            if queued:
+                return
+            raise ConnectionError("no server connection")
+        protocolo.send(sock, payload)
+
+    def _peer_sock(self, peer_username):
+        with self.lock:
+            info = self.peers.get(peer_username)
+        return info["tcp_sock"] if info else None
+
+    def _peer_link(self, peer_username):
+        sock = self._peer_sock(peer_username)
+        return canales.get(sock) if sock is not None else None
+
+    def drop_peer(self, peer_username):
+        with self.lock:
+            info = self.peers.pop(peer_username, None)
+        if info:
+            _close(info["tcp_sock"])
+
+    # Returns False when there is no direct link; send errors drop the link
+    # and are re-raised.
+    def send_text(self, peer_username, text):
+        link = self._peer_link(peer_username)
+        if link is None:
+            return False
+        try:
+            link.send({"type": "text", "from": self.username, "text": text, "ts": time.time()})
+        except OSError:
+            self.drop_peer(peer_username)
+            raise
+        return True
+
+    # Leaves a text with the server for a user we have no link with; it is
+    # delivered when they log in (right away if they are online). The
+    # server answers with a status reply on the events queue; until then
+    # the request is resent after every reconnect.
+    def send_offline(self, peer_username, text):
+        self.send_server({"action": "send_offline", "to": peer_username,
+                          "message": {"type": "text", "text": text, "ts": time.time()}})
+
+    # `source` is a path or bytes. The offer carries the content hash, so a
+    # peer that already has the image accepts at its full size and no data
+    # is sent; the base64 fallback is encoded once per content.
+    def send_image(self, peer_username, source, caption="", name="imagen.png", chunk_size=transferencia.DEFAULT_CHUNK_SIZE, progress=None):
+        sock = self._peer_sock(peer_username)
+        if sock is None:
+            return False
+        try:
+            meta = {"from": self.username, "name": name, "caption": caption, "ts": time.time()}
+            if not self.transfers.send(sock, source, meta, chunk_size, progress):
+                # Peer without file transfer support: old base64-in-JSON message.
+                b64 = self.transfers.encode_cached(self.transfers.digest(source), "base64", lambda: _base64(source))
+                link = canales.get(sock)
+                if link is None:
+                    raise ConnectionError("peer link closed")
+                link.send({"type": "image", "from": self.username, "image_b64": b64, "caption": caption, "ts": time.time()}, canales.BULK)
+        except OSError:
+            self.drop_peer(peer_username)
+            raise
+        return True
+
+    # Sends a file as-is (any type). Returns False when there is no link or
+    # the peer did not accept the offer.
+    def send_file(self, peer_username, path, chunk_size=transferencia.DEFAULT_CHUNK_SIZE, progress=None):
+        sock = self._peer_sock(peer_username)
+        if sock is None:
+            return False
+        meta = {"from": self.username, "name": os.path.basename(path), "ts": time.time()}
+        try:
+            return self.transfers.send(sock, path, meta, chunk_size, progress)
+        except OSError:
+            self.drop_peer(peer_username)
+            raise
+
+    def peer_udp_addr(self, peer_username):
+        with self.lock:
+            info = self.peers.get(peer_username)
+        return info["udp_addr"] if info else None
+
+    def peers_snapshot(self):
+        with self.lock:
+            return {name: info["addr"] for name, info in self.peers.items()}
+
+    def media_stats(self):
+        return self.media_receiver.stats() if self.media_receiver else {}
+
+    def close(self):
+        self.closed.set()
+        if self.discovery:
+            self.discovery.stop()
+        with self.lock:
+            server_sock, self.server_sock = self.server_sock, None
+            listen_sock, self.listen_sock = self.listen_sock, None
+            peers, self.peers = self.peers, {}
+        for sock in [server_sock, listen_sock] + [info["tcp_sock"] for info in peers.values()]:
+            if sock is not None:
+                _close(sock)
+        if self.media_receiver:
+            self.media_receiver.stop()
+            self.media_receiver = None
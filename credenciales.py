@@ -0,0 +1,177 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# scrypt cost: about 16 MB and a few tens of ms per hash. Hashes record
+# their parameters, so these can be raised without breaking stored ones.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600_000  # fallback when OpenSSL has no scrypt
+SALT_BYTES = 16
+
+SESSION_TTL = 12 * 3600  # seconds a resume token stays valid
+PEER_KEY_TTL = 3600  # seconds a peer key is accepted; clients refresh it halfway
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+# "scrypt$n$r$p$salt$hash" or "pbkdf2_sha256$iterations$salt$hash".
+def hash_password(password, salt=None):
+    salt = salt or os.urandom(SALT_BYTES)
+    if hasattr(hashlib, "scrypt"):
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+
+# Returns (ok, outdated). Rows written before hashing hold the plain
+# password; they still log in and come back as outdated so the caller can
+# store a hash instead.
+def verify_password(password, stored):
+    if not isinstance(password, str) or not stored:
+        return False, False
+    scheme, _, rest = stored.partition("$")
+    if scheme == "scrypt":
+        n, r, p, salt, digest = rest.split("$")
+        n, r, p = int(n), int(r), int(p)
+        candidate = hashlib.scrypt(password.encode(), salt=_unb64(salt), n=n, r=r, p=p,
+                                   maxmem=max(32 * 1024 * 1024, 256 * n * r))
+        outdated = (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    elif scheme == "pbkdf2_sha256":
+        iterations, salt, digest = rest.split("$")
+        candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), _unb64(salt), int(iterations))
+        outdated = hasattr(hashlib, "scrypt") or int(iterations) != PBKDF2_ITERATIONS
+    else:
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    return hmac.compare_digest(candidate, _unb64(digest)), outdated
+
+
+# Pool worker initializer, a backstop for when Hasher.close() never runs
+# (the server was killed with SIGKILL or crashed in C code): the workers
+# notice their parent is gone and exit instead of spinning on.
+def _exit_with_parent(parent):
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+# Runs hashing in worker processes: it is CPU-bound by design, and in the
+# server's threads or event loop it would hold the GIL against every
+# other connection. The methods block the calling thread; the asyncio
+# server already calls them from its executor. Workers are spawned, not
+# forked: the server is multithreaded by the time the first one starts.
+class Hasher:
+    def __init__(self, workers=None):
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_exit_with_parent, initargs=(os.getpid(),))
+        self.closed = False
+
+    def hash(self, password):
+        return self.pool.submit(hash_password, password).result()
+
+    def verify(self, password, stored):
+        return self.pool.submit(verify_password, password, stored).result()
+
+    # Waits for the hashes already running (tens of ms each) so no worker
+    # outlives the server. Safe to call more than once.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Resumable sessions: after a password login the client gets
+# "<id>.<signature>", an HMAC of the id with a per-process key, and can
+# log in again with it instead of the password. Checking one is an HMAC
+# and a dict lookup, with no hash and no database query, so a reconnect
+# storm costs no more than the connections themselves. Tokens live in
+# memory only: a restarted server (or another worker) refuses them and
+# the client falls back to its password.
+class SessionTokens:
+    def __init__(self, ttl=SESSION_TTL, key=None):
+        self.ttl = ttl
+        self.key = key or secrets.token_bytes(32)
+        self.sessions = {}  # id -> (username, expires)
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + ttl
+
+    def _sign(self, token_id):
+        return _b64(hmac.new(self.key, token_id.encode(), hashlib.sha256).digest())
+
+    def issue(self, username):
+        token_id = _b64(secrets.token_bytes(18))
+        now = time.monotonic()
+        with self.lock:
+            self.sessions[token_id] = (username, now + self.ttl)
+            if now >= self.next_sweep:
+                self.sessions = {k: v for k, v in self.sessions.items() if v[1] > now}
+                self.next_sweep = now + self.ttl
+        return f"{token_id}.{self._sign(token_id)}"
+
+    # The username the token was issued to, or None.
+    def verify(self, token):
+        if not isinstance(token, str):
+            return None
+        token_id, _, signature = token.partition(".")
+        if not hmac.compare_digest(signature.encode(), self._sign(token_id).encode()):
+            return None
+        with self.lock:
+            entry = self.sessions.get(token_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+# Answer to a LAN dialer's hello: binds its nonce to the address it dialed
+# (the accepted socket's local address), so an answer obtained by dialing
+# the real peer is no use to a host relaying it from another address.
+def peer_answer(key, nonce, ip, port):
+    return _b64(hmac.new(_unb64(key), f"{nonce}|{ip}|{port}".encode(), hashlib.sha256).digest())
+
+
+# Lets a client found through a LAN announcement prove it is logged in as
+# the name it announced. Each login gets a key derived from the username
+# and an expiry with a per-process secret; only that client receives it.
+# A dialer sends a fresh nonce, the peer returns peer_answer(), and the
+# dialer has the server recompute it (verify_peer). The key never goes to
+# peers, so neither the announcement nor a past answer can be replayed.
+class PeerKeys:
+    def __init__(self, ttl=PEER_KEY_TTL, key=None):
+        self.ttl = ttl
+        self.key = key or secrets.token_bytes(32)
+
+    def _derive(self, username, expires):
+        return _b64(hmac.new(self.key, f"{username}|{expires}".encode(), hashlib.sha256).digest())
+
+    # (key, expires): the key is valid until `expires` (Unix time).
+    def issue(self, username):
+        expires = int(time.time()) + self.ttl
+        return self._derive(username, expires), expires
+
+    def verify(self, username, expires, nonce, ip, port, answer):
+        if not all(isinstance(v, str) for v in (username, nonce, ip, answer)):
+            return False
+        if not isinstance(expires, int) or not isinstance(port, int) or expires <= time.time():
+            return False
+        expected = peer_answer(self._derive(username, expires), nonce, ip, port)
+        return hmac.compare_digest(expected.encode(), answer.encode())
@@ -0,0 +1,139 @@
+import ipaddress
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+# Announcements go to a multicast group (or a broadcast address) on the
+# LAN. For loopback tests, set P2P_DISCOVERY_IF=127.0.0.1 so every client
+# on the machine hears the others.
+DISCOVERY_ADDR = os.environ.get("P2P_DISCOVERY_ADDR", "239.255.77.77")
+DISCOVERY_PORT = int(os.environ.get("P2P_DISCOVERY_PORT", "9091"))
+DISCOVERY_IF = os.environ.get("P2P_DISCOVERY_IF", "0.0.0.0")
+ANNOUNCE_INTERVAL = 5  # seconds between announcements (with jitter)
+PEER_TTL = 3 * ANNOUNCE_INTERVAL  # an entry survives two lost announcements
+MAX_DATAGRAM = 1500
+
+
+# username -> (ip, tcp_port, udp_port), each entry valid for `ttl` seconds
+# after the announcement that wrote it.
+class PeerCache:
+    def __init__(self, ttl=PEER_TTL):
+        self.ttl = ttl
+        self.entries = {}  # username -> (ip, tcp_port, udp_port, expires)
+        self.lock = threading.Lock()
+
+    def put(self, username, ip, tcp_port, udp_port):
+        with self.lock:
+            self.entries[username] = (ip, tcp_port, udp_port, time.monotonic() + self.ttl)
+
+    def get(self, username):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            if entry[3] <= time.monotonic():
+                del self.entries[username]
+                return None
+        return entry[:3]
+
+    def drop(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+
+def open_socket(addr=DISCOVERY_ADDR, port=DISCOVERY_PORT, interface=DISCOVERY_IF):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Several clients on one machine share the port; multicast and
+        # broadcast datagrams reach all of them.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    if ipaddress.ip_address(addr).is_multicast:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(addr) + socket.inet_aton(interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # this subnet only
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return sock
+
+
+# Announces this client on the LAN and fills a PeerCache from the other
+# clients' announcements, so peers on the same subnet can be dialed
+# without asking the server for peer_info. The peer's IP is the source of
+# its datagram. A new client sends a query first and everyone answers
+# with an announcement, so it does not wait a full interval; a client
+# that leaves says bye. Announcements are not authenticated: a cache hit
+# is only an address to try, and the dialer has whatever answers there
+# prove its identity before using the link (conexiones._lan_handshake),
+# with the server as the fallback.
+class Discovery:
+    def __init__(self, username, tcp_port, udp_port, sock=None, addr=DISCOVERY_ADDR, port=DISCOVERY_PORT,
+                 interval=ANNOUNCE_INTERVAL, ttl=PEER_TTL):
+        self.username = username
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.sock = sock or open_socket(addr, port)
+        self.sock.settimeout(1.0)  # so the receiver notices stop()
+        self.dest = (addr, port)
+        self.interval = interval
+        self.cache = PeerCache(ttl)
+        self.stopped = threading.Event()
+        self.last_answer = 0.0
+
+    def start(self):
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+
+    def lookup(self, username):
+        return self.cache.get(username)
+
+    def _send(self, kind):
+        message = {"type": kind, "username": self.username, "tcp_port": self.tcp_port, "udp_port": self.udp_port}
+        try:
+            self.sock.sendto(json.dumps(message).encode(), self.dest)
+        except OSError:
+            pass  # no route to the group right now; the next round retries
+
+    def _announce_loop(self):
+        self._send("query")
+        while True:
+            self._send("announce")
+            if self.stopped.wait(self.interval * random.uniform(0.8, 1.2)):
+                return
+
+    def _receive(self):
+        while not self.stopped.is_set():
+            try:
+                data, (ip, _) = self.sock.recvfrom(MAX_DATAGRAM)
+                message = json.loads(data)
+                kind, username = message.get("type"), message.get("username")
+            except (OSError, ValueError, AttributeError):
+                if self.stopped.is_set():
+                    return
+                continue
+            if not isinstance(username, str) or username == self.username:
+                continue
+            if kind == "bye":
+                self.cache.drop(username)
+                continue
+            if isinstance(message.get("tcp_port"), int):
+                self.cache.put(username, ip, message["tcp_port"], message.get("udp_port"))
+            # At most one answer per second, however many clients start.
+            if kind == "query" and time.monotonic() - self.last_answer > 1:
+                self.last_answer = time.monotonic()
+                self._send("announce")
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self._send("bye")
+        self.stopped.set()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
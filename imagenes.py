@@ -0,0 +1,108 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import transferencia
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow thumbnails are the original bytes
+    Image = None
+
+THUMB_SIZE = 320
+CACHE_BYTES = 32 * 1024 * 1024
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# Content-addressed store for chat images. Originals live on disk in
+# `root` named by their sha256 (the same names file transfers use), and a
+# thumbnail is generated once per image into root/thumbs. In memory there
+# is only an LRU of recently shown thumbnails and originals, capped at
+# `budget` bytes, so RAM stays flat however many images arrive.
+class ImageCache:
+    def __init__(self, root, budget=CACHE_BYTES, thumb_size=THUMB_SIZE):
+        self.root = root
+        self.thumb_dir = os.path.join(root, "thumbs")
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        self.budget = budget
+        self.thumb_size = thumb_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (kind, path) -> bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, data, name):
+        path = os.path.join(self.root, transferencia.content_id(data) + os.path.splitext(name)[1])
+        if not os.path.exists(path):
+            _write(path, data)
+        return path
+
+    def thumbnail(self, path):
+        return self._get(("thumb", path), self._load_thumbnail)
+
+    def original(self, path):
+        return self._get(("full", path), _read)
+
+    def _get(self, key, load):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = load(key[1])
+        # An item bigger than a quarter of the budget would flush most of
+        # the cache for one view; it is served without being kept.
+        if len(data) > self.budget // 4:
+            return data
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+                while self.size > self.budget:
+                    _, old = self.entries.popitem(last=False)
+                    self.size -= len(old)
+                    self.evictions += 1
+        return data
+
+    def _load_thumbnail(self, path):
+        thumb = os.path.join(self.thumb_dir, os.path.basename(path))
+        try:
+            return _read(thumb)
+        except FileNotFoundError:
+            pass
+        if Image is None:
+            return _read(path)
+        buf = io.BytesIO()
+        try:
+            with Image.open(path) as img:
+                img.thumbnail((self.thumb_size, self.thumb_size))
+                if img.mode in ("RGBA", "LA", "P"):
+                    img.save(buf, "PNG")
+                else:
+                    img.convert("RGB").save(buf, "JPEG", quality=85)
+        except OSError:
+            return _read(path)
+        data = buf.getvalue()
+        _write(thumb, data)
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,137 @@
+import math
+import threading
+import time
+
+HEARTBEAT_INTERVAL = 30  # seconds of silence before a session is pinged
+HEARTBEAT_TIMEOUT = 10   # seconds to answer the ping before eviction
+TICK = 1.0
+WHEEL_SLOTS = 512        # TICK * WHEEL_SLOTS should exceed the longest delay
+
+
+# Hashed timer wheel: one set of items per slot, an item due in n ticks
+# goes to slot (now + n) % slots. Scheduling and cancelling are O(1), and
+# each tick only looks at one slot, so the cost does not grow with the
+# number of idle connections. Items due more than one revolution ahead
+# stay in their slot until their tick comes round. Items handed out by
+# advance() stay "firing" until they are rescheduled or cancelled, so a
+# cancel() that lands while the caller is still looking at an item wins
+# over the caller's reschedule().
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.now = 0
+        self.where = {}  # item -> (slot, due tick)
+        self.firing = set()
+        self.lock = threading.Lock()
+
+    def _put(self, item, delay):
+        due = self.now + max(1, math.ceil(delay / self.tick))
+        slot = due % len(self.slots)
+        old = self.where.get(item)
+        if old is not None:
+            self.slots[old[0]].discard(item)
+        self.slots[slot].add(item)
+        self.where[item] = (slot, due)
+
+    def schedule(self, item, delay):
+        with self.lock:
+            self.firing.discard(item)
+            self._put(item, delay)
+
+    # Schedules an item that advance() returned, unless it was cancelled
+    # since. Returns False when it was.
+    def reschedule(self, item, delay):
+        with self.lock:
+            if item not in self.firing:
+                return False
+            self.firing.discard(item)
+            self._put(item, delay)
+            return True
+
+    def cancel(self, item):
+        with self.lock:
+            self.firing.discard(item)
+            old = self.where.pop(item, None)
+            if old is not None:
+                self.slots[old[0]].discard(item)
+
+    def __len__(self):
+        return len(self.where)
+
+    # Moves one tick forward and returns the items that came due.
+    def advance(self):
+        with self.lock:
+            self.now += 1
+            bucket = self.slots[self.now % len(self.slots)]
+            expired = [item for item in bucket if self.where[item][1] <= self.now]
+            for item in expired:
+                bucket.discard(item)
+                del self.where[item]
+            self.firing.update(expired)
+        return expired
+
+
+# Application-level liveness for server sessions. Readers only stamp
+# `session.last_activity` on every frame (no lock, no timer); the wheel
+# looks at a session once per interval. A session that was quiet for the
+# whole interval gets on_idle(session), which pings it and returns True
+# (or returns False to leave it alone); if nothing arrives within
+# `timeout` after that, evict(session) closes it. Sessions found alive are
+# handed to refresh() in one list per tick, for bulk last_seen writes.
+class Heartbeats:
+    def __init__(self, on_idle, evict, refresh=None, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, tick=TICK):
+        self.on_idle = on_idle
+        self.evict = evict
+        self.refresh = refresh
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick, max(WHEEL_SLOTS, math.ceil((interval + timeout) / tick) + 2))
+        self.stopped = threading.Event()
+        self.pinged = 0
+        self.evicted = 0
+
+    def add(self, session):
+        session.last_activity = time.monotonic()
+        session.pinged_at = None
+        self.wheel.schedule(session, self.interval)
+
+    def remove(self, session):
+        self.wheel.cancel(session)
+
+    def tick(self):
+        now = time.monotonic()
+        alive = []
+        for session in self.wheel.advance():
+            idle = now - session.last_activity
+            if idle < self.interval:
+                session.pinged_at = None
+                if self.wheel.reschedule(session, self.interval - idle):
+                    alive.append(session)
+            elif session.pinged_at is None:
+                if self.on_idle(session):
+                    session.pinged_at = now
+                    self.pinged += 1
+                    self.wheel.reschedule(session, self.timeout)
+                else:
+                    self.wheel.reschedule(session, self.interval)
+            else:
+                self.wheel.cancel(session)
+                self.evicted += 1
+                self.evict(session)
+        if alive and self.refresh:
+            self.refresh(alive)
+
+    def run(self):
+        deadline = time.monotonic()
+        while True:
+            deadline += self.wheel.tick
+            if self.stopped.wait(max(0.0, deadline - time.monotonic())):
+                return
+            self.tick()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
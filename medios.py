@@ -0,0 +1,202 @@
+import heapq
+import selectors
+import socket
+import struct
+import threading
+import time
+
+# Media datagram header: stream id, sequence number, send time (ns since epoch).
+HEADER = struct.Struct("!IIQ")
+MAX_DATAGRAM = 1500
+JITTER_DELAY = 0.05  # seconds a gap may stay open before it counts as loss
+MAX_STREAMS = 64     # jitter buffers kept at once; a new stream evicts the quietest
+STREAM_IDLE = 10     # seconds without packets before a stream is forgotten
+
+
+class MediaSender:
+    def __init__(self, sock, addr, stream_id):
+        self.sock = sock
+        self.addr = addr
+        self.stream_id = stream_id
+        self.seq = 0
+
+    def send(self, payload):
+        header = HEADER.pack(self.stream_id, self.seq, time.time_ns())
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.sock.sendmsg([header, payload], [], 0, self.addr)
+
+
+# Reorders one stream by sequence number. Packets are released in order;
+# a missing sequence number is given up on (and counted as lost) once the
+# packet waiting behind it has been held for `delay` seconds.
+class JitterBuffer:
+    def __init__(self, delay=JITTER_DELAY, capacity=1024):
+        self.delay = delay
+        self.capacity = capacity
+        self.heap = []
+        self.next_seq = None
+        self.highest = -1
+        self.received = 0
+        self.delivered = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.last_arrival = 0.0
+
+    # Returns False when the packet was not kept (late or duplicate).
+    def push(self, seq, ts, buf, n, now):
+        self.received += 1
+        self.last_arrival = now
+        if self.next_seq is not None and seq < self.next_seq:
+            self.late += 1
+            return False
+        if seq < self.highest:
+            self.reordered += 1
+        elif seq == self.highest:
+            self.duplicates += 1
+            return False
+        self.highest = max(self.highest, seq)
+        heapq.heappush(self.heap, (seq, now, ts, buf, n))
+        return True
+
+    # Yields (seq, ts, buf, n) in order; discarded duplicates are yielded
+    # with n == 0 so the caller can recycle their buffers.
+    def pop_ready(self, now):
+        heap = self.heap
+        while heap:
+            seq, arrival = heap[0][0], heap[0][1]
+            if self.next_seq is None:
+                self.next_seq = seq
+            if seq < self.next_seq:
+                entry = heapq.heappop(heap)
+                self.duplicates += 1
+                yield entry[0], entry[2], entry[3], 0
+            elif seq == self.next_seq:
+                entry = heapq.heappop(heap)
+                self.next_seq += 1
+                self.delivered += 1
+                yield entry[0], entry[2], entry[3], entry[4]
+            elif now - arrival >= self.delay or len(heap) > self.capacity:
+                self.lost += seq - self.next_seq
+                self.next_seq = seq
+            else:
+                break
+
+    def stats(self):
+        expected = self.delivered + self.lost
+        return {"received": self.received, "delivered": self.delivered, "lost": self.lost,
+                "late": self.late, "duplicates": self.duplicates, "reordered": self.reordered,
+                "loss_pct": 100.0 * self.lost / expected if expected else 0.0,
+                "buffered": len(self.heap)}
+
+
+# Receive loop: on every wakeup it drains up to `batch` datagrams with
+# recvfrom_into into pooled, preallocated buffers before running the
+# jitter buffers, so a burst costs one select() instead of one per packet.
+# on_packet(key, seq, ts, payload) gets a memoryview that is only valid
+# during the call; key is (addr, stream_id). At most `max_streams` are
+# tracked: one silent for `idle` seconds, or the quietest one when a new
+# stream needs its place, is dropped with its buffered packets and
+# reported to on_stream_end(key). The socket is closed when run() returns.
+class MediaReceiver:
+    def __init__(self, sock, on_packet, delay=JITTER_DELAY, batch=64, packet_size=MAX_DATAGRAM,
+                 max_streams=MAX_STREAMS, idle=STREAM_IDLE, on_stream_end=None):
+        self.sock = sock
+        self.on_packet = on_packet
+        self.on_stream_end = on_stream_end
+        self.max_streams = max_streams
+        self.idle = idle
+        self.delay = delay
+        self.batch = batch
+        self.packet_size = packet_size
+        self.pool = [bytearray(packet_size) for _ in range(batch * 2)]
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeups = 0
+        self.datagrams = 0
+
+    def _recycle(self, buf):
+        if len(self.pool) < self.batch * 4:
+            self.pool.append(buf)
+
+    def run(self):
+        self.sock.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        backlog = False
+        next_sweep = time.monotonic() + 1
+        try:
+            while not self.stopped.is_set():
+                # A full batch means the socket still has data: skip select().
+                if not backlog:
+                    sel.select(self.delay / 2)
+                self.wakeups += 1
+                now = time.monotonic()
+                backlog = self._drain(now) == self.batch
+                self._release(now)
+                if now >= next_sweep:
+                    next_sweep = now + 1
+                    for key in [k for k, jb in self.streams.items() if now - jb.last_arrival >= self.idle]:
+                        self._end(key)
+        finally:
+            sel.close()
+            self.sock.close()
+
+    def _drain(self, now):
+        pool = self.pool
+        count = 0
+        while count < self.batch:
+            buf = pool.pop() if pool else bytearray(self.packet_size)
+            try:
+                n, addr = self.sock.recvfrom_into(buf)
+            except OSError:
+                pool.append(buf)
+                break
+            count += 1
+            self.datagrams += 1
+            if n < HEADER.size:
+                pool.append(buf)
+                continue
+            stream_id, seq, ts = HEADER.unpack_from(buf)
+            key = (addr, stream_id)
+            jb = self.streams.get(key)
+            if jb is None:
+                if len(self.streams) >= self.max_streams:
+                    self._end(min(self.streams, key=lambda k: self.streams[k].last_arrival))
+                with self.lock:
+                    jb = self.streams[key] = JitterBuffer(self.delay)
+            if not jb.push(seq, ts, buf, n, now):
+                pool.append(buf)
+        return count
+
+    def _release(self, now):
+        for key, jb in list(self.streams.items()):
+            for seq, ts, buf, n in jb.pop_ready(now):
+                if n:
+                    self.on_packet(key, seq, ts, memoryview(buf)[HEADER.size:n])
+                self._recycle(buf)
+
+    def _end(self, key):
+        with self.lock:
+            jb = self.streams.pop(key)
+        for entry in jb.heap:
+            self._recycle(entry[3])
+        if self.on_stream_end:
+            self.on_stream_end(key)
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        with self.lock:
+            streams = list(self.streams.items())
+        return {key: jb.stats() for key, jb in streams}
+
+
+def open_socket(port, host=""):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind((host, port))
+    return sock
@@ -0,0 +1,124 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+import protocolo
+
+
+# Server side: login/logout only record the latest state per user; a
+# background thread publishes the net changes once per window as a single
+# versioned delta shared by every subscriber, so a login storm costs one
+# message per subscriber per window instead of one per login.
+class Presence:
+    def __init__(self, window=0.1):
+        self.window = window
+        self.lock = threading.Lock()
+        self.published = set()
+        self.pending = {}
+        self.subscribers = set()
+        self.version = 0
+        self.stopped = threading.Event()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def joined(self, username):
+        with self.lock:
+            self.pending[username] = True
+
+    def left(self, username):
+        with self.lock:
+            self.pending[username] = False
+
+    def subscribe(self, session):
+        with self.lock:
+            self.subscribers.add(session)
+            session.send({"action": "presence", "version": self.version, "snapshot": sorted(self.published)})
+
+    def unsubscribe(self, session):
+        with self.lock:
+            self.subscribers.discard(session)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            joined = [u for u, online in pending.items() if online and u not in self.published]
+            left = [u for u, online in pending.items() if not online and u in self.published]
+            if not joined and not left:
+                return
+            self.published.update(joined)
+            self.published.difference_update(left)
+            self.version += 1
+            delta = {"action": "presence", "version": self.version, "joined": joined, "left": left}
+            subscribers = list(self.subscribers)
+        # One encoding per distinct (legacy, wire) among the subscribers.
+        encoded = {}
+        for session in subscribers:
+            key = (session.legacy, session.wire)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = protocolo.encode(delta, session.legacy, wire=session.wire)
+            session.send_data(data)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.window):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+
+
+# Sorted list of usernames for the paginated directory: a page costs a
+# binary search plus the k names returned.
+class UserIndex:
+    def __init__(self, names=()):
+        self.names = sorted(names)
+
+    def add(self, name):
+        i = bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            self.names.insert(i, name)
+
+    def remove(self, name):
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        i = bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    # Returns (names, next_cursor); next_cursor is None on the last page.
+    def page(self, prefix="", cursor=None, limit=100, exclude=None):
+        names = self.names
+        i = bisect_left(names, prefix)
+        if cursor is not None:
+            i = max(i, bisect_right(names, cursor))
+        result = []
+        while i < len(names) and names[i].startswith(prefix):
+            if len(result) == limit:
+                return result, result[-1]
+            if names[i] != exclude:
+                result.append(names[i])
+            i += 1
+        return result, None
+
+
+# Client side: local copy of the online set kept in sync from the deltas.
+class PresenceView:
+    def __init__(self):
+        self.users = set()
+        self.version = None
+
+    # Returns False when a delta is missing; the caller should resubscribe.
+    def apply(self, payload):
+        if "snapshot" in payload:
+            self.users = set(payload["snapshot"])
+            self.version = payload["version"]
+            return True
+        if self.version is None or payload["version"] != self.version + 1:
+            return False
+        self.users.update(payload.get("joined", []))
+        self.users.difference_update(payload.get("left", []))
+        self.version = payload["version"]
+        return True
@@ -0,0 +1,317 @@
+import json
+import struct
+import threading
+import weakref
+import zlib
+from collections import namedtuple
+
+try:
+    import lz4.block
+except ImportError:  # optional faster codec
+    lz4 = None
+
+try:
+    import msgpack
+except ImportError:  # optional binary serialization
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Frame = 4-byte big-endian body length + 1 flags byte + body.
+HEADER = struct.Struct("!IB")
+# Keeps the first length byte <= 0x03, so a frame can never start with '{'
+# or any other printable byte sent by newline-JSON peers.
+MAX_FRAME = 64 * 1024 * 1024
+
+# Body is raw bytes (file chunks), not JSON.
+BINARY = 0x01
+# Body is compressed; at most one of these is set.
+ZLIB = 0x02
+LZ4 = 0x04
+# Body is MessagePack instead of JSON.
+MSGPACK = 0x08
+
+# Local-only flag: set on messages that arrived as newline-delimited JSON.
+# Never written to the wire; tells the caller to answer in the same format.
+LEGACY = 0x80
+
+_LEGACY_MIN_BYTE = (MAX_FRAME - 1) >> 24
+
+
+COMPRESS_THRESHOLD = 512  # bodies shorter than this are sent uncompressed
+ZLIB_LEVEL = 1
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _lz4_decompress(body):
+    # lz4.block stores the uncompressed size first; check it before
+    # allocating so a small frame cannot expand past MAX_FRAME.
+    if len(body) < 4 or int.from_bytes(body[:4], "little") >= MAX_FRAME:
+        raise ProtocolError("bad lz4 frame")
+    return lz4.block.decompress(body)
+
+
+def _zlib_decompress(body):
+    d = zlib.decompressobj()
+    data = d.decompress(body, MAX_FRAME)
+    if d.unconsumed_tail:
+        raise ProtocolError("compressed frame too large")
+    return data
+
+
+# name -> (flag, compress, decompress), in order of preference.
+CODECS = {}
+if lz4 is not None:
+    CODECS["lz4"] = (LZ4, lambda data: lz4.block.compress(data), _lz4_decompress)
+CODECS["zlib"] = (ZLIB, lambda data: zlib.compress(data, ZLIB_LEVEL), _zlib_decompress)
+_DECOMPRESS = {flag: decompress for flag, _, decompress in CODECS.values()}
+
+
+def _json_dumps(payload):
+    return json.dumps(payload).encode()
+
+
+def _json_loads(body):
+    return json.loads(str(body, "utf-8"))
+
+
+if orjson is not None:
+    # Same JSON on the wire, several times cheaper to produce and parse.
+    _json_dumps, _json_loads = orjson.dumps, orjson.loads
+
+
+# name -> (flag, dumps, loads), in order of preference. JSON is always
+# last: it is what old clients and legacy lines use.
+SERIALIZERS = {}
+if msgpack is not None:
+    SERIALIZERS["msgpack"] = (MSGPACK, lambda payload: msgpack.packb(payload, use_bin_type=True),
+                              lambda body: msgpack.unpackb(body, raw=False))
+SERIALIZERS["json"] = (0, _json_dumps, _json_loads)
+
+
+# Encoding options a connection agreed on in the capability handshake
+# (login, or hello between peers). Immutable, so fan-out code can encode a
+# message once per distinct Wire.
+Wire = namedtuple("Wire", "compression threshold serializer", defaults=(None, COMPRESS_THRESHOLD, "json"))
+PLAIN = Wire()
+
+
+# Capability offer sent by the side that opens a connection.
+def capabilities():
+    return {"compression": list(CODECS), "compress_min": COMPRESS_THRESHOLD, "serialization": list(SERIALIZERS)}
+
+
+# Picks the Wire for an offer from capabilities(); the answer for the
+# other side is wire_caps() of the result. Missing or unknown offers
+# (old clients) get PLAIN.
+def negotiate(offer):
+    if not isinstance(offer, dict):
+        return PLAIN
+    names = offer.get("compression") or ()
+    codec = next((name for name in CODECS if name in names), None)
+    threshold = offer.get("compress_min")
+    if not isinstance(threshold, int) or threshold < 0:
+        threshold = COMPRESS_THRESHOLD
+    formats = offer.get("serialization") or ()
+    serializer = next((name for name in SERIALIZERS if name in formats), "json")
+    return Wire(codec, max(threshold, COMPRESS_THRESHOLD), serializer)
+
+
+def wire_caps(wire):
+    return {"compression": wire.compression, "compress_min": wire.threshold, "serialization": wire.serializer}
+
+
+# Wire from the answer to our own offer.
+def accept_caps(caps):
+    if not isinstance(caps, dict):
+        return PLAIN
+    codec = caps.get("compression") if caps.get("compression") in CODECS else None
+    threshold = caps.get("compress_min")
+    serializer = caps.get("serialization") if caps.get("serialization") in SERIALIZERS else "json"
+    return Wire(codec, threshold if isinstance(threshold, int) else COMPRESS_THRESHOLD, serializer)
+
+
+def encode(payload, legacy=False, flags=0, wire=PLAIN):
+    if legacy:
+        return _json_dumps(payload) + b"\n"
+    flag, dumps, _ = SERIALIZERS[wire.serializer]
+    body = dumps(payload)
+    flags |= flag
+    if wire.compression and len(body) >= wire.threshold:
+        flag, compress, _ = CODECS[wire.compression]
+        packed = compress(body)
+        if len(packed) < len(body):
+            body = packed
+            flags |= flag
+    if len(body) >= MAX_FRAME:
+        raise ProtocolError(f"frame too large: {len(body)} bytes")
+    return HEADER.pack(len(body), flags) + body
+
+
+def decode(flags, body):
+    if flags & BINARY:
+        raise ProtocolError("binary frame")
+    if flags & (ZLIB | LZ4):
+        decompress = _DECOMPRESS.get(flags & (ZLIB | LZ4))
+        if decompress is None:
+            raise ProtocolError(f"unsupported compression flags {flags:#x}")
+        try:
+            body = decompress(body)
+        except ProtocolError:
+            raise
+        except Exception as e:
+            raise ProtocolError(f"bad compressed frame: {e}") from e
+    if flags & MSGPACK:
+        if msgpack is None:
+            raise ProtocolError("msgpack frame but msgpack is not installed")
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise ProtocolError(f"bad msgpack frame: {e}") from e
+    return _json_loads(body)
+
+
+_send_locks = weakref.WeakKeyDictionary()
+_send_locks_guard = threading.Lock()
+_wires = weakref.WeakKeyDictionary()
+
+
+# Serializes writers that share a socket so frames never interleave.
+def send_lock(sock):
+    with _send_locks_guard:
+        lock = _send_locks.get(sock)
+        if lock is None:
+            lock = _send_locks[sock] = threading.Lock()
+        return lock
+
+
+# Wire used by send() on a socket once its handshake is done.
+def set_wire(sock, wire):
+    with _send_locks_guard:
+        _wires[sock] = wire
+
+
+def get_wire(sock):
+    with _send_locks_guard:
+        return _wires.get(sock, PLAIN)
+
+
+def send(sock, payload, legacy=False):
+    data = encode(payload, legacy, wire=get_wire(sock))
+    with send_lock(sock):
+        sock.sendall(data)
+
+
+# Incremental parser over one reusable receive buffer. Callers write into
+# get_buffer() (recv_into / BufferedProtocol), report the byte count with
+# advance() and iterate frames(). Bodies are memoryviews into the buffer and
+# are only valid until the next get_buffer() call.
+#
+# The length in a header is only a claim: the buffer grows with the bytes
+# that actually arrived (at most doubling them), not straight to the frame
+# size, and goes back to `size` once a large frame has been consumed.
+# `max_frame` lets a side that only expects small messages refuse bigger
+# ones outright.
+class FrameDecoder:
+
+    def __init__(self, compat=True, size=64 * 1024, max_frame=MAX_FRAME):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.compat = compat
+        self.max_frame = min(max_frame, MAX_FRAME)
+        self.needed = HEADER.size
+
+    # Bytes received after the last complete frame.
+    def pending(self):
+        return bytes(self.view[self.start:self.end])
+
+    def get_buffer(self, min_free=4096):
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+        want = max(min(self.needed, max(2 * pending, self.size)), pending + min_free)
+        if want > len(self.buf) or (len(self.buf) > self.size and want <= self.size):
+            size = self.size
+            while size < want:
+                size *= 2
+            new_buf = bytearray(size)
+            new_buf[:pending] = self.buf[self.start:self.end]
+            self.buf = new_buf
+            self.view = memoryview(self.buf)
+            self.start, self.end = 0, pending
+        elif len(self.buf) - self.end < min_free:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def advance(self, nbytes):
+        self.end += nbytes
+
+    def frames(self):
+        while self.end > self.start:
+            if self.buf[self.start] > _LEGACY_MIN_BYTE:
+                if not self.compat:
+                    raise ProtocolError("newline-delimited message on a framed connection")
+                line = self._legacy_line()
+                if line is None:
+                    return
+                if bytes(line).strip():
+                    yield LEGACY, line
+                continue
+            if self.end - self.start < HEADER.size:
+                self.needed = HEADER.size
+                return
+            length, flags = HEADER.unpack_from(self.buf, self.start)
+            if length >= self.max_frame:
+                raise ProtocolError(f"frame too large: {length} bytes")
+            total = HEADER.size + length
+            if self.end - self.start < total:
+                self.needed = total
+                return
+            body = self.view[self.start + HEADER.size:self.start + total]
+            self.start += total
+            self.needed = HEADER.size
+            yield flags, body
+
+    def _legacy_line(self):
+        nl = self.buf.find(b"\n", self.start, self.end)
+        if nl < 0:
+            if self.buf[self.start] != ord("{"):
+                # Old CLI peers send bare text without a terminator.
+                nl = self.end
+            elif self.end - self.start >= self.max_frame:
+                raise ProtocolError("unterminated line too long")
+            else:
+                self.needed = self.end - self.start + 1
+                return None
+        line = self.view[self.start:nl]
+        self.start = min(nl + 1, self.end)
+        return line
+
+
+# Yields (flags, body) pairs from a blocking socket until EOF. Iterating
+# again after a socket timeout resumes where the last iteration stopped,
+# starting with any frames that were already buffered.
+class FrameReader:
+
+    def __init__(self, sock, compat=True, max_frame=MAX_FRAME):
+        self.sock = sock
+        self.decoder = FrameDecoder(compat, max_frame=max_frame)
+
+    def __iter__(self):
+        yield from self.decoder.frames()
+        while True:
+            n = self.sock.recv_into(self.decoder.get_buffer())
+            if not n:
+                return
+            self.decoder.advance(n)
+            yield from self.decoder.frames()
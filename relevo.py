@@ -0,0 +1,250 @@
+import secrets
+import socket
+import threading
+import time
+
+RELAY_BUFFER = 256 * 1024  # bytes buffered per direction before reading stops
+RELAY_RATE = 1024 * 1024   # bytes/s per relay, both directions together; 0 = no cap
+RELAY_BURST = 256 * 1024
+JOIN_TIMEOUT = 10          # seconds the first side waits for the second
+
+
+# Byte budget refilled at `rate` bytes/s up to `burst`. reserve() always
+# takes the bytes (they were already read) and returns how long the
+# caller should pause so the average stays at the rate.
+class TokenBucket:
+    def __init__(self, rate, burst=RELAY_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n):
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# Fixed-size buffer between the thread reading one side of a relay and
+# the thread writing to the other. The reader blocks when it is full,
+# which stops reading the socket and lets TCP push back on the sender.
+class RingBuffer:
+    def __init__(self, capacity=RELAY_BUFFER):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.head = 0
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    # Contiguous free space to recv_into, or None once closed. The flag is
+    # True when the buffer was full and the caller had to wait.
+    def free(self):
+        cap = len(self.buf)
+        with self.cond:
+            full = self.size == cap
+            self.cond.wait_for(lambda: self.closed or self.size < cap)
+            if self.closed:
+                return None, full
+            tail = (self.head + self.size) % cap
+            end = cap if tail >= self.head else self.head
+            return self.view[tail:end], full
+
+    def commit(self, n):
+        with self.cond:
+            self.size += n
+            self.cond.notify_all()
+
+    # Contiguous queued bytes, or None once closed and drained.
+    def filled(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.size)
+            if not self.size:
+                return None
+            return self.view[self.head:min(self.head + self.size, len(self.buf))]
+
+    def consume(self, n):
+        with self.cond:
+            self.size -= n
+            self.head = (self.head + n) % len(self.buf)
+            self.cond.notify_all()
+
+    # No more input; what is queued is still delivered.
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # The other side is gone; drop what is queued.
+    def abort(self):
+        with self.cond:
+            self.closed = True
+            self.size = 0
+            self.cond.notify_all()
+
+
+class Relay:
+    def __init__(self, token, users, bucket):
+        self.token = token
+        self.users = users
+        self.bucket = bucket
+        self.created = time.monotonic()
+        self.waiting = None  # endpoint of the side that joined first
+
+
+# First side of a relay on a thread server: blocks in wait() until the
+# second side calls pair().
+class ThreadEndpoint:
+    def __init__(self, session):
+        self.session = session
+        self.partner = None
+        self.event = threading.Event()
+
+    def pair(self, partner):
+        self.partner = partner
+        self.event.set()
+
+    def wait(self, timeout):
+        return self.partner if self.event.wait(timeout) else None
+
+
+# Same for the asyncio server: the partner arrives through a future.
+class AsyncEndpoint:
+    def __init__(self, protocol, loop):
+        self.protocol = protocol
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def pair(self, partner):
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(partner))
+
+
+# Fallback path for peers that cannot reach each other directly. Both
+# clients get the same one-time token over their logged-in sessions, open
+# a new connection to the server and send relay_join; once both are there
+# the server forwards raw bytes between the two sockets, so the peer
+# protocol (hello, chat, transfers) runs over it unchanged. Each direction
+# has a bounded buffer with backpressure, and each relay a bandwidth cap.
+class RelayHub:
+    def __init__(self, registry, rate=RELAY_RATE, buffer=RELAY_BUFFER, join_timeout=JOIN_TIMEOUT):
+        self.rate = rate
+        self.buffer = buffer
+        self.join_timeout = join_timeout
+        self.lock = threading.Lock()
+        self.pending = {}  # token -> Relay waiting for its two sides
+        self.by_pair = {}  # (user, user) sorted -> Relay
+        self.active = registry.gauge("p2p_relay_connections_active", "Client connections in relay mode (two per relay)")
+        self.sessions = registry.counter("p2p_relay_sessions_total", "Relay sessions by outcome", ("result",))
+        self.relayed = registry.counter("p2p_relay_bytes_total", "Bytes forwarded through relays")
+        self.backpressure = registry.counter("p2p_relay_backpressure_total", "Times a relay buffer filled up and reading stopped")
+        self.throttled = registry.counter("p2p_relay_throttled_seconds_total", "Time relays spent paused by the bandwidth cap")
+        registry.callback("p2p_relay_pending", "Relays waiting for their second side", lambda: len(self.pending))
+
+    # Token for a relay between two users; asking twice before both sides
+    # joined returns the same one.
+    def request(self, a, b):
+        pair = tuple(sorted((a, b)))
+        with self.lock:
+            self._expire()
+            relay = self.by_pair.get(pair)
+            if relay is None:
+                relay = Relay(secrets.token_hex(16), pair, TokenBucket(self.rate))
+                self.pending[relay.token] = self.by_pair[pair] = relay
+                self.sessions.inc("requested")
+            return relay.token
+
+    # Returns (relay, partner endpoint) for the second side, (relay, None)
+    # for the first one and (None, None) for an unknown or expired token.
+    def join(self, token, endpoint):
+        with self.lock:
+            self._expire()
+            relay = self.pending.get(token)
+            if relay is None:
+                return None, None
+            if relay.waiting is None:
+                relay.waiting = endpoint
+                return relay, None
+            self._forget(relay)
+            self.sessions.inc("paired")
+        return relay, relay.waiting
+
+    # Gives up on a relay whose second side never came. False when it was
+    # paired in the meantime.
+    def abandon(self, relay):
+        with self.lock:
+            if self.pending.get(relay.token) is not relay:
+                return False
+            self._forget(relay)
+            self.sessions.inc("expired")
+            return True
+
+    def _forget(self, relay):
+        del self.pending[relay.token]
+        if self.by_pair.get(relay.users) is relay:
+            del self.by_pair[relay.users]
+
+    def _expire(self):
+        limit = time.monotonic() - self.join_timeout
+        for relay in [r for r in self.pending.values() if r.created < limit]:
+            self._forget(relay)
+            self.sessions.inc("expired")
+
+    # Thread server: reads `conn` on the calling thread into a ring buffer
+    # that a helper thread writes to `partner`, until either side is done.
+    # Each side of a relay runs this for its own direction. `leftover` is
+    # what the caller already read past relay_join.
+    def pipe(self, relay, conn, partner, leftover=b""):
+        ring = RingBuffer(self.buffer)
+        writer = threading.Thread(target=self._drain, args=(ring, partner), daemon=True)
+        writer.start()
+        try:
+            while leftover:
+                view, _ = ring.free()
+                k = min(len(view), len(leftover))
+                view[:k] = leftover[:k]
+                ring.commit(k)
+                leftover = leftover[k:]
+            while True:
+                view, full = ring.free()
+                if view is None:
+                    break
+                if full:
+                    self.backpressure.inc()
+                n = conn.recv_into(view)
+                if not n:
+                    break
+                ring.commit(n)
+                delay = relay.bucket.reserve(n)
+                if delay:
+                    self.throttled.inc(amount=delay)
+                    time.sleep(delay)
+        except OSError:
+            ring.abort()
+        finally:
+            ring.close()
+            writer.join()
+            # Either side leaving ends the relay; this also wakes the
+            # other side's writer if it is blocked sending to us.
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _drain(self, ring, dst):
+        try:
+            while True:
+                view = ring.filled()
+                if view is None:
+                    break
+                n = dst.send(view)
+                ring.consume(n)
+                self.relayed.inc(amount=n)
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            ring.abort()
@@ -1,142 +1,867 @@
 import socket
 import threading
-import json
-import sqlite3
 import time
+import asyncio
+import argparse
+import atexit
+import json
+import logging
+import os
+import signal
+from collections import deque
+
+import almacen
+import credenciales
+import latidos
+import metricas
+import presencia
+import protocolo
+import relevo
+
+log = logging.getLogger("servidor")
 
 HOST = "192.168.1.73"
 PORT = 8080
 DB_PATH = "Users.db"
+LAST_SEEN_FLUSH = 0.05  # seconds between batched last_seen writes
+
+# Per-connection outbound queue limits (bytes)
+SEND_HIGH_WATER = 256 * 1024
+SEND_LOW_WATER = 64 * 1024
+SEND_MAX_QUEUE = 4 * 1024 * 1024
+SEND_DRAIN_TIMEOUT = 2  # seconds to flush pending replies on disconnect
+
+PRESENCE_WINDOW = 0.1  # seconds of join/leave coalescing per presence delta
+
+LIST_MAX_LIMIT = 500  # most names returned by one list_users page
 
-clients_lock = threading.Lock()
+# Store-and-forward for offline users: at most this much per message, and
+# the backlog goes out in offline_batch frames of up to these sizes.
+OFFLINE_MESSAGE_MAX = 16 * 1024
+OFFLINE_BATCH_MESSAGES = 500
+OFFLINE_BATCH_BYTES = 256 * 1024
+# Largest request frame accepted from a client; requests are small JSON
+# (an offline message is the biggest). Relayed peer traffic is piped as
+# raw bytes and not subject to it.
+REQUEST_MAX_FRAME = OFFLINE_MESSAGE_MAX + 16 * 1024
+
+# Application-level heartbeats: a session quiet for HEARTBEAT_INTERVAL is
+# pinged and evicted if it stays quiet for HEARTBEAT_TIMEOUT more. This is
+# what notices half-open connections (sleeping laptops, dropped Wi-Fi).
+HEARTBEAT_INTERVAL = latidos.HEARTBEAT_INTERVAL
+HEARTBEAT_TIMEOUT = latidos.HEARTBEAT_TIMEOUT
+# Kernel keepalive for clients that cannot answer pings (old protocol)
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464  # Prometheus text endpoint; 0 disables it
+
+ACTIONS = ("register", "login", "list_users", "subscribe_presence", "connect_to_peer", "relay_request", "relay_join",
+           "send_offline", "ack_offline", "ping", "pong", "peer_key", "verify_peer")
+# Requests that touch SQLite or the password hasher; the asyncio server
+# runs them in its executor (see blocking_request).
+DB_ACTIONS = ("register", "login", "send_offline", "ack_offline")
+
+metrics = metricas.Registry()
+connections_open = metrics.gauge("p2p_connections_open", "Open client connections")
+messages_total = metrics.counter("p2p_messages_total", "Requests handled, by action", ("action",))
+bytes_in = metrics.counter("p2p_bytes_in_total", "Bytes received from clients")
+bytes_out = metrics.counter("p2p_bytes_out_total", "Bytes written to clients")
+slow_consumers = metrics.counter("p2p_slow_consumers_dropped_total", "Connections dropped for not reading replies")
+lock_wait = metrics.histogram("p2p_lock_wait_seconds", "Time spent waiting for a lock", ("lock",))
+lock_hold = metrics.histogram("p2p_lock_hold_seconds", "Time a lock was held", ("lock",))
+sqlite_latency = metrics.histogram("p2p_sqlite_query_seconds", "SQLite query latency", ("op",))
+send_queue = metrics.histogram("p2p_send_queue_bytes", "Outbound queue depth after each enqueue",
+                               buckets=metricas.BYTES_BUCKETS)
+offline_queued = metrics.counter("p2p_offline_queued_total", "Messages stored for offline delivery")
+offline_rejected = metrics.counter("p2p_offline_rejected_total", "Offline messages refused, by reason", ("reason",))
+offline_delivered = metrics.counter("p2p_offline_delivered_total", "Stored messages sent to their recipient")
+offline_pruned = metrics.counter("p2p_offline_pruned_total", "Stored messages deleted after an ack")
+offline_batches = metrics.histogram("p2p_offline_batch_messages", "Messages per offline_batch frame",
+                                    buckets=(1, 5, 10, 50, 100, 500))
+logins_total = metrics.counter("p2p_logins_total", "Login attempts, by method and outcome", ("result",))
+heartbeat_pings = metrics.counter("p2p_heartbeat_pings_total", "Pings sent to quiet sessions")
+heartbeat_evictions = metrics.counter("p2p_heartbeat_evictions_total", "Sessions closed for missing heartbeats")
+
+clients_lock = metricas.TimedLock(lock_wait, lock_hold, "clients")
 clients = {}
+online_index = presencia.UserIndex()  # guarded by clients_lock
+
+# Registered users, loaded from the users table on first use
+directory_lock = metricas.TimedLock(lock_wait, lock_hold, "directory")
+directory = None
+
+metrics.callback("p2p_clients_online", "Logged-in users", lambda: len(clients))
+metrics.callback("p2p_send_queue_bytes_total", "Bytes queued for logged-in users",
+                 lambda: sum(c["sock"].queue_depth() for c in list(clients.values())))
+metrics.callback("p2p_offline_backlog_messages", "Messages waiting in the outbox",
+                 lambda: store.outbox_pending() if store else 0)
+metrics.callback("p2p_session_tokens", "Resumable sessions cached in memory",
+                 lambda: len(tokens) if tokens else 0)
+metrics.callback("p2p_heartbeat_sessions", "Connections tracked by the heartbeat wheel",
+                 lambda: len(heartbeats.wheel) if heartbeats else 0)
+
+store = None
+presence = None
+relay_hub = None  # relevo.RelayHub when started with --relay
+heartbeats = None  # latidos.Heartbeats unless started with --heartbeat 0
+hasher = None      # credenciales.Hasher: password hashing in worker processes
+tokens = None      # credenciales.SessionTokens for resumed logins
+peer_keys = None   # credenciales.PeerKeys for LAN discovery identity checks
 
 def init_bd():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        last_seen INTEGER NOT NULL
-    )''')
-    conn.commit()
-    conn.close()
+    global store
+    store = almacen.Store(DB_PATH, LAST_SEEN_FLUSH, observe=lambda op, seconds: sqlite_latency.observe(seconds, op))
 
 def register(username, password):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    try:
-        cur = conn.cursor()
-        cur.execute('INSERT INTO users (username, password, last_seen) VALUES (?, ?, ?)',
-                    (username, password, int(time.time())))
-        conn.commit()
-        return True, "Registered"
-    except Exception as e:
-        return False, "Username exists"
-    finally:
-        conn.close()
+    if not username or not isinstance(password, str):
+        return False, "Missing username or password"
+    return store.register(username, hasher.hash(password))
 
+# A plain password stored before hashing is replaced by its hash on the
+# first login that matches it.
 def login(username, password):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute("SELECT password FROM users WHERE username=?", (username,))
-    result = cur.fetchone()
-    conn.close()
-    if not result:
+    stored = store.password_hash(username)
+    if stored is None:
         return False
-    return result[0] == password
+    ok, outdated = hasher.verify(password, stored)
+    if ok and outdated:
+        store.set_password(username, hasher.hash(password))
+    return ok
 
 def update_last_seen(username):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET last_seen=? WHERE username=?", (int(time.time()), username))
-    conn.commit()
-    conn.close()
+    store.touch(username)
+
+# Heartbeat callbacks, called from the wheel thread. Sessions that said
+# they understand pings get one; connections that never logged in get no
+# ping and are closed after the timeout; logged-in clients of the old
+# protocol are left to TCP keepalive.
+def heartbeat_idle(session):
+    if session.heartbeat:
+        heartbeat_pings.inc()
+        session.send({"action": "ping"})
+        return True
+    return session.username is None
+
+
+def heartbeat_evict(session):
+    log.info("Evicting %s: no heartbeat for %ds", session.username or session.addr, HEARTBEAT_INTERVAL + HEARTBEAT_TIMEOUT)
+    heartbeat_evictions.inc()
+    drop_session(session)
+    session.close()
+
+
+# last_seen for every session the wheel found alive this tick, in one
+# store call and one pass over `clients`.
+def heartbeat_refresh(sessions):
+    now = int(time.time())
+    names = [s.username for s in sessions if s.username]
+    with clients_lock:
+        for name in names:
+            entry = clients.get(name)
+            if entry is not None:
+                entry["last_seen"] = now
+    store.touch_many(names, now)
+
+
+def keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+# A login with a session token only touches memory (the outbox count is
+# kept there too) unless the user has messages waiting, so it does not
+# queue behind password hashes.
+def blocking_request(payload):
+    action = payload.get("action")
+    if action == "login" and payload.get("token") is not None:
+        return store.outbox_count(payload.get("username")) > 0
+    return action in DB_ACTIONS
+
+
+def registered_index():
+    global directory
+    with directory_lock:
+        if directory is None:
+            directory = presencia.UserIndex(store.usernames())
+        return directory
+
+
+# What gets stored for send_offline: only a text message, rebuilt from its
+# text (and the sender's timestamp), so nothing else a client puts in the
+# dict reaches the recipient. None if it is not one.
+def offline_message(message):
+    if not isinstance(message, dict) or message.get("type") != "text" or not isinstance(message.get("text"), str):
+        return None
+    stored = {"type": "text", "text": message["text"]}
+    ts = message.get("ts")
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        stored["ts"] = ts
+    return stored
+
+
+# Sends `username` everything in its outbox past what this session was
+# already sent, packed into a few offline_batch frames. The per-login
+# lock keeps batches in id order when a live message and the login
+# backlog race, so the client can ack cumulatively.
+def flush_offline(username):
+    with clients_lock:
+        entry = clients.get(username)
+    if entry is None or not store.outbox_count(username):
+        return
+    sock = entry["sock"]
+    if getattr(sock, "loop_thread", None) == threading.get_ident():
+        # a message arrived after blocking_request let this login stay on the loop
+        sock.loop.run_in_executor(None, flush_offline, username)
+        return
+    with entry["outbox_lock"]:
+        while True:
+            rows = store.outbox_page(username, entry["outbox_sent"], OFFLINE_BATCH_MESSAGES)
+            if not rows:
+                return
+            batch, size = [], 0
+            for msg_id, sender, body, ts in rows:
+                batch.append({"id": msg_id, "from": sender, "ts": ts, "message": json.loads(body)})
+                size += len(body)
+                if size >= OFFLINE_BATCH_BYTES:
+                    break
+            if not entry["sock"].send({"action": "offline_batch", "messages": batch}):
+                return
+            entry["outbox_sent"] = batch[-1]["id"]
+            offline_delivered.inc(amount=len(batch))
+            offline_batches.observe(len(batch))
+
+class ThreadSession:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.username = None
+        self.legacy = False
+        self.heartbeat = False
+        self.last_activity = time.monotonic()
+        self.wire = protocolo.PLAIN
+        self.outbox = deque()
+        self.queued = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def send(self, payload):
+        return self.send_data(protocolo.encode(payload, self.legacy, wire=self.wire))
+
+    def send_data(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            if self.queued + len(data) > SEND_MAX_QUEUE:
+                log.warning("Dropping slow consumer %s (%d bytes queued)", self.username or self.addr, self.queued)
+                slow_consumers.inc()
+                self._close_locked()
+                return False
+            self.outbox.append(data)
+            self.queued += len(data)
+            queued = self.queued
+            self.cond.notify_all()
+        send_queue.observe(queued)
+        return True
+
+    def queue_depth(self):
+        return self.queued
+
+    # Called by the reader before each request: a client that does not read
+    # its replies stops being read until its queue drains to the low mark.
+    def wait_writable(self):
+        with self.cond:
+            if self.queued > SEND_HIGH_WATER:
+                self.cond.wait_for(lambda: self.closed or self.queued <= SEND_LOW_WATER)
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.outbox or self.closed)
+                if self.closed:
+                    return
+                batch = b"".join(self.outbox)
+                self.outbox.clear()
+            try:
+                self.conn.sendall(batch)
+            except OSError:
+                self.close()
+                return
+            bytes_out.inc(amount=len(batch))
+            with self.cond:
+                self.queued -= len(batch)
+                self.cond.notify_all()
+
+    # Stops the writer thread but leaves the socket open, for relays. What
+    # was already queued is flushed first.
+    def detach(self, drain_timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or not self.queued, drain_timeout)
+            self.closed = True
+            self.cond.notify_all()
+
+    def close(self, drain_timeout=0):
+        with self.cond:
+            if drain_timeout:
+                self.cond.wait_for(lambda: self.closed or not self.queued, drain_timeout)
+            self._close_locked()
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cond.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncSession:
+    def __init__(self, transport, addr, loop):
+        self.transport = transport
+        self.addr = addr
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.username = None
+        self.legacy = False
+        self.heartbeat = False
+        self.last_activity = time.monotonic()
+        self.wire = protocolo.PLAIN
+
+    def send(self, payload):
+        return self.send_data(protocolo.encode(payload, self.legacy, wire=self.wire))
+
+    def send_data(self, data):
+        # register/login run in the executor; everything else is already on the loop
+        if threading.get_ident() == self.loop_thread:
+            return self._write(data)
+        self.loop.call_soon_threadsafe(self._write, data)
+        return True
+
+    # The transport buffer is the outbound queue: the loop drains it and
+    # ClientProtocol.pause_writing() applies the high/low watermarks.
+    def _write(self, data):
+        if self.transport.is_closing():
+            return False
+        queued = self.transport.get_write_buffer_size()
+        if queued + len(data) > SEND_MAX_QUEUE:
+            log.warning("Dropping slow consumer %s (%d bytes queued)", self.username or self.addr, queued)
+            slow_consumers.inc()
+            self.transport.abort()
+            return False
+        self.transport.write(data)
+        bytes_out.inc(amount=len(data))
+        send_queue.observe(queued + len(data))
+        return True
+
+    def queue_depth(self):
+        return self.transport.get_write_buffer_size()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.transport.abort)
+
+
+def process_request(session, payload):
+    action = payload.get("action")
+    current_user = session.username
+    messages_total.inc(action if action in ACTIONS else "other")
+
+    if action == "register":
+        username = payload.get("username")
+        password = payload.get("password")
+        success, msg_resp = register(username, password)
+        if success:
+            with directory_lock:
+                if directory is not None:
+                    directory.add(username)
+        session.send({"status": "ok" if success else "error", "msg": msg_resp})
+
+    elif action == "login":
+        # A token from an earlier login skips the password hash and the
+        # database; a bad or expired one is refused so the client can fall
+        # back to its password.
+        username = payload.get("username")
+        token = payload.get("token")
+        if token is not None:
+            ok = username is not None and tokens.verify(token) == username
+            logins_total.inc("token" if ok else "token_rejected")
+        else:
+            ok = login(username, payload.get("password"))
+            logins_total.inc("password" if ok else "password_rejected")
+            if ok:
+                token = tokens.issue(username)
+        if ok:
+            with clients_lock:
+                clients[username] = {
+                    "sock": session, "addr": session.addr,
+                    "tcp_port": payload.get("tcp_port"),
+                    "udp_port": payload.get("udp_port"),
+                    "last_seen": int(time.time()),
+                    "outbox_lock": threading.Lock(), "outbox_sent": 0
+                }
+                online_index.add(username)
+            session.username = username
+            presence.joined(username)
+            update_last_seen(username)
+            peer_key, expires = peer_keys.issue(username)
+            reply = {"status": "ok", "msg": "Logged in", "token": token, "peer_key": peer_key, "peer_key_expires": expires}
+            if "caps" in payload and not session.legacy:
+                wire = protocolo.negotiate(payload["caps"])
+                reply["caps"] = protocolo.wire_caps(wire)
+                if heartbeats and isinstance(payload["caps"], dict) and payload["caps"].get("heartbeat"):
+                    session.heartbeat = True
+                    reply["heartbeat"] = HEARTBEAT_INTERVAL + HEARTBEAT_TIMEOUT  # longest silence allowed
+                session.send(reply)
+                session.wire = wire
+            else:
+                session.send(reply)
+            log.info("Login %s from %s | Total clients: %d", username, session.addr, len(clients))
+            flush_offline(username)
+        elif token is not None:
+            session.send({"status": "error", "msg": "Invalid or expired session"})
+        else:
+            session.send({"status": "error", "msg": "Invalid credentials"})
+
+    elif action == "list_users":
+        prefix = payload.get("prefix") or ""
+        cursor = payload.get("cursor")
+        limit = payload.get("limit") or LIST_MAX_LIMIT
+        if not isinstance(prefix, str) or not (cursor is None or isinstance(cursor, str)):
+            session.send({"status": "error", "msg": "prefix and cursor must be strings."})
+        elif not isinstance(limit, int) or isinstance(limit, bool):
+            session.send({"status": "error", "msg": "limit must be an integer."})
+        else:
+            limit = max(1, min(limit, LIST_MAX_LIMIT))
+            if payload.get("scope") == "registered":
+                index, index_lock = registered_index(), directory_lock
+            else:
+                index, index_lock = online_index, clients_lock
+            with index_lock:
+                user_list, next_cursor = index.page(prefix, cursor, limit, exclude=current_user)
+            session.send({"action": "user_list", "users": user_list, "prefix": prefix, "cursor": cursor,
+                          "next_cursor": next_cursor})
+            log.debug("list_users from %s: %d users with prefix %r", current_user, len(user_list), prefix)
+
+    elif action == "ping":
+        session.send({"action": "pong"})
+
+    elif action == "peer_key":
+        if current_user:
+            peer_key, expires = peer_keys.issue(current_user)
+            session.send({"action": "peer_key", "key": peer_key, "expires": expires})
+
+    # Checks a LAN peer's answer for a dialer; see credenciales.PeerKeys.
+    # Needs no login: an answer is only good for the nonce it was made for.
+    elif action == "verify_peer":
+        ref = {"ref": payload["ref"]} if "ref" in payload else {}
+        if peer_keys.verify(payload.get("username"), payload.get("expires"), payload.get("nonce"),
+                            payload.get("ip"), payload.get("port"), payload.get("answer")):
+            session.send({"status": "ok", "msg": "Verified", **ref})
+        else:
+            session.send({"status": "error", "msg": "Invalid peer proof", **ref})
+
+    elif action == "subscribe_presence":
+        presence.subscribe(session)
+
+    elif action == "connect_to_peer":
+        target_username = payload.get("target_username")
+        with clients_lock:
+            peer1 = clients.get(current_user)
+            peer2 = clients.get(target_username)
+        if peer1 and peer2:
+            info_for_peer1 = {"action": "peer_info", "peer_username": target_username, "ip": peer2["addr"][0], "tcp_port": peer2["tcp_port"], "udp_port": peer2["udp_port"]}
+            info_for_peer2 = {"action": "peer_info", "peer_username": current_user, "ip": peer1["addr"][0], "tcp_port": peer1["tcp_port"], "udp_port": peer1["udp_port"]}
+            peer1["sock"].send(info_for_peer1)
+            peer2["sock"].send(info_for_peer2)
+        else:
+            session.send({"status": "error", "msg": f"User '{target_username}' not found or is offline."})
+
+    elif action == "send_offline":
+        target_username = payload.get("to")
+        message = offline_message(payload.get("message"))
+        body = json.dumps(message) if message else ""
+        ref = {"ref": payload["ref"]} if "ref" in payload else {}  # echoed so the client can match replies
+        if not current_user:
+            session.send({"status": "error", "msg": "Log in first.", **ref})
+        elif not message:
+            offline_rejected.inc("invalid")
+            session.send({"status": "error", "msg": "Only text messages can be stored.", **ref})
+        elif len(body) > OFFLINE_MESSAGE_MAX:
+            offline_rejected.inc("size")
+            session.send({"status": "error", "msg": "Message too large to store.", **ref})
+        elif target_username not in registered_index():
+            offline_rejected.inc("unknown")
+            session.send({"status": "error", "msg": f"User '{target_username}' does not exist.", **ref})
+        else:
+            msg_id = store.outbox_put(target_username, current_user, body)
+            if msg_id is None:
+                offline_rejected.inc("quota")
+                session.send({"status": "error", "msg": f"The outbox of '{target_username}' is full.", **ref})
+            else:
+                offline_queued.inc()
+                session.send({"status": "ok", "msg": "Queued", "id": msg_id, **ref})
+                flush_offline(target_username)
+
+    elif action == "ack_offline":
+        if current_user and isinstance(payload.get("upto"), int):
+            offline_pruned.inc(amount=store.outbox_ack(current_user, payload["upto"]))
+
+    elif action == "relay_request":
+        target_username = payload.get("target_username")
+        with clients_lock:
+            peer1 = clients.get(current_user)
+            peer2 = clients.get(target_username)
+        if relay_hub is None:
+            session.send({"status": "error", "msg": "Relay is not enabled on this server."})
+        elif peer1 and peer2 and target_username != current_user:
+            token = relay_hub.request(current_user, target_username)
+            peer1["sock"].send({"action": "relay_info", "peer_username": target_username, "token": token})
+            peer2["sock"].send({"action": "relay_info", "peer_username": current_user, "token": token})
+            log.info("Relay requested by %s for %s", current_user, target_username)
+        else:
+            session.send({"status": "error", "msg": f"User '{target_username}' not found or is offline."})
+
+
+# relay_join is the first message on a new connection from each side of
+# a relay. The side that arrives second sends relay_ready to both, so
+# neither client gets relayed bytes before its own relay_ready; the
+# connection then stops carrying requests and only forwards bytes.
+def relay_join(session, payload):
+    messages_total.inc("relay_join")
+    if relay_hub is None or session.username is not None:
+        session.send({"status": "error", "msg": "Relay is not available."})
+        return None, None
+    endpoint = relevo.ThreadEndpoint(session)
+    relay, partner = relay_hub.join(payload.get("token"), endpoint)
+    if relay is None:
+        session.send({"status": "error", "msg": "Unknown or expired relay."})
+        return None, None
+    if partner is None:
+        partner = endpoint.wait(relay_hub.join_timeout)
+        if partner is None and not relay_hub.abandon(relay):
+            partner = endpoint.wait(None)  # paired just as we gave up
+        if partner is None:
+            session.send({"status": "error", "msg": "The peer did not join the relay."})
+        return relay, partner
+    for side in (partner.session, session):
+        side.send({"action": "relay_ready"})
+        side.detach(SEND_DRAIN_TIMEOUT)
+    partner.pair(endpoint)
+    log.info("Relay %s <-> %s", *relay.users)
+    return relay, partner
+
+
+def drop_session(session):
+    presence.unsubscribe(session)
+    with clients_lock:
+        current_user = session.username
+        if current_user and clients.get(current_user, {}).get("sock") is session:
+            log.info("Disconnect %s | Total clients: %d", current_user, len(clients) - 1)
+            del clients[current_user]
+            online_index.remove(current_user)
+            presence.left(current_user)
+
 
 def handle_client(conn, addr):
-    current_user = None
+    session = ThreadSession(conn, addr)
+    connections_open.inc()
+    keepalive(conn)
+    if heartbeats:
+        heartbeats.add(session)
+    reader = protocolo.FrameReader(conn, max_frame=REQUEST_MAX_FRAME)
     try:
-        while True:
-            data = conn.recv(1024)
-            if not data:
+        for flags, body in reader:
+            session.last_activity = time.monotonic()
+            bytes_in.inc(amount=len(body) + (1 if flags & protocolo.LEGACY else protocolo.HEADER.size))
+            try:
+                payload = protocolo.decode(flags, body)
+            except ValueError:
+                log.warning("Invalid message from %s", addr)
+                continue
+            session.wait_writable()
+            session.legacy = bool(flags & protocolo.LEGACY)
+            if payload.get("action") == "relay_join":
+                if heartbeats:
+                    heartbeats.remove(session)
+                relay, partner = relay_join(session, payload)
+                if partner is not None:
+                    relay_hub.active.inc()
+                    try:
+                        relay_hub.pipe(relay, conn, partner.session.conn, reader.decoder.pending())
+                    finally:
+                        relay_hub.active.dec()
                 break
-            messages = data.decode().split("\n")
-            for msg in messages:
-                if not msg.strip():
-                    continue
-                try:
-                    payload = json.loads(msg)
-                except json.JSONDecodeError:
-                    print(f"[SERVER][ERROR] Invalid JSON from {addr}")
-                    continue
-
-                action = payload.get("action")
-                
-                if action == "register":
-                    username = payload.get("username")
-                    password = payload.get("password")
-                    success, msg_resp = register(username, password)
-                    conn.sendall(json.dumps({"status": "ok" if success else "error", "msg": msg_resp}).encode() + b"\n")
-                
-                elif action == "login":
-                    username = payload.get("username")
-                    password = payload.get("password")
-                    if login(username, password):
-                        with clients_lock:
-                            clients[username] = {
-                                "sock": conn, "addr": addr,
-                                "tcp_port": payload.get("tcp_port"),
-                                "udp_port": payload.get("udp_port"),
-                                "last_seen": int(time.time())
-                            }
-                        current_user = username
-                        update_last_seen(username)
-                        conn.sendall(json.dumps({"status": "ok", "msg": "Logged in"}).encode() + b"\n")
-                        print(f"[LOGIN] {username} - {addr} | Total clients: {len(clients)}")
-                    else:
-                        conn.sendall(json.dumps({"status": "error", "msg": "Invalid credentials"}).encode() + b"\n")
-
-                elif action == "list_users":
-                    print(f"\n[DEBUG] Recibida solicitud 'list_users' de '{current_user}'.")
-                    with clients_lock:
-                        user_list = [user for user in clients if user != current_user]
-                        print(f"[DEBUG] Usuarios en línea (excluyendo a {current_user}): {user_list}")
-
-                    response = {"action": "user_list", "users": user_list}
-                    conn.sendall((json.dumps(response) + "\n").encode())
-                    print(f"[DEBUG] Enviada lista de usuarios a {current_user}.\n")
-
-                elif action == "connect_to_peer":
-                    target_username = payload.get("target_username")
-                    with clients_lock:
-                        if target_username in clients and current_user in clients:
-                            peer1 = clients[current_user]
-                            peer2 = clients[target_username]
-                            info_for_peer1 = {"action": "peer_info", "peer_username": target_username, "ip": peer2["addr"][0], "tcp_port": peer2["tcp_port"], "udp_port": peer2["udp_port"]}
-                            info_for_peer2 = {"action": "peer_info", "peer_username": current_user, "ip": peer1["addr"][0], "tcp_port": peer1["tcp_port"], "udp_port": peer1["udp_port"]}
-                            peer1["sock"].sendall((json.dumps(info_for_peer1) + "\n").encode())
-                            peer2["sock"].sendall((json.dumps(info_for_peer2) + "\n").encode())
-                        else:
-                            error_msg = {"status": "error", "msg": f"User '{target_username}' not found or is offline."}
-                            conn.sendall((json.dumps(error_msg) + "\n").encode())
+            process_request(session, payload)
     except Exception as e:
-        print(f"[SERVER][ERROR] Conexión perdida con {addr}: {e}")
+        log.warning("Conexión perdida con %s: %s", addr, e)
     finally:
-        with clients_lock:
-            if current_user and current_user in clients:
-                print(f"[DISCONNECT] {current_user} | Total clients: {len(clients)-1}")
-                del clients[current_user]
+        connections_open.dec()
+        if heartbeats:
+            heartbeats.remove(session)
+        drop_session(session)
+        session.close(SEND_DRAIN_TIMEOUT)
         conn.close()
 
-def start_server():
-    init_bd()
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f"[SERVER] Listening on {HOST}:{PORT}")
+
+# The event loop reads straight into the decoder buffer; decoded requests
+# are handed to one task per connection so they are answered in order.
+class ClientProtocol(asyncio.BufferedProtocol):
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        self.addr = transport.get_extra_info("peername")
+        self.session = AsyncSession(transport, self.addr, self.loop)
+        transport.set_write_buffer_limits(high=SEND_HIGH_WATER, low=SEND_LOW_WATER)
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.decoder = protocolo.FrameDecoder(max_frame=REQUEST_MAX_FRAME)
+        self.pending = asyncio.Queue()
+        self.relay = None
+        self.relay_to = None  # partner ClientProtocol once relaying
+        self.held = set()     # reasons reading is paused in relay mode
+        self.task = self.loop.create_task(self.run())
+        connections_open.inc()
+        keepalive(transport.get_extra_info("socket"))
+        if heartbeats:
+            heartbeats.add(self.session)
+
+    def get_buffer(self, sizehint):
+        if self.relay_to is not None:
+            return self.relay_buf
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        if self.relay_to is not None:
+            self.relay_forward(bytes(self.relay_buf[:nbytes]))
+            return
+        self.session.last_activity = time.monotonic()
+        bytes_in.inc(amount=nbytes)
+        self.decoder.advance(nbytes)
+        try:
+            for flags, body in self.decoder.frames():
+                try:
+                    payload = protocolo.decode(flags, body)
+                except ValueError:
+                    log.warning("Invalid message from %s", self.addr)
+                    continue
+                self.pending.put_nowait((flags, payload))
+        except protocolo.ProtocolError as e:
+            log.warning("Conexión perdida con %s: %s", self.addr, e)
+            self.session.transport.close()
+
+    # Over the high watermark: stop reading this client's requests until its
+    # pending replies drain below the low watermark.
+    # In relay mode the transport buffer is the relay buffer for the
+    # partner's direction, so it is the partner that stops reading.
+    def pause_writing(self):
+        if self.relay_to is not None:
+            relay_hub.backpressure.inc()
+            self.relay_to.hold("full")
+            return
+        self.writable.clear()
+        self.session.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.relay_to is not None:
+            self.relay_to.release("full")
+            return
+        self.writable.set()
+        if not self.session.transport.is_closing():
+            self.session.transport.resume_reading()
+
+    def hold(self, reason):
+        self.held.add(reason)
+        self.session.transport.pause_reading()
+
+    def release(self, reason):
+        self.held.discard(reason)
+        if not self.held and not self.session.transport.is_closing():
+            self.session.transport.resume_reading()
+
+    # Both sides are switched by whichever joined second, after writing
+    # relay_ready to each (see relay_join).
+    def start_relay(self, relay, partner):
+        self.relay = relay
+        self.relay_to = partner
+        self.relay_buf = bytearray(64 * 1024)
+        self.session.transport.set_write_buffer_limits(high=relay_hub.buffer, low=relay_hub.buffer // 4)
+        relay_hub.active.inc()
+        leftover = self.decoder.pending()
+        if leftover:
+            self.relay_forward(leftover)
+
+    def relay_forward(self, data):
+        self.relay_to.session.transport.write(data)
+        relay_hub.relayed.inc(amount=len(data))
+        delay = self.relay.bucket.reserve(len(data))
+        if delay:
+            relay_hub.throttled.inc(amount=delay)
+            self.hold("rate")
+            self.loop.call_later(delay, self.release, "rate")
+
+    async def relay_join(self, payload):
+        messages_total.inc("relay_join")
+        if heartbeats:
+            heartbeats.remove(self.session)
+        if relay_hub is None or self.session.username is not None:
+            self.session.send({"status": "error", "msg": "Relay is not available."})
+            return
+        endpoint = relevo.AsyncEndpoint(self, self.loop)
+        relay, partner = relay_hub.join(payload.get("token"), endpoint)
+        if relay is None:
+            self.session.send({"status": "error", "msg": "Unknown or expired relay."})
+        elif partner is None:
+            try:
+                await asyncio.wait_for(asyncio.shield(endpoint.future), relay_hub.join_timeout)
+            except asyncio.TimeoutError:
+                if relay_hub.abandon(relay):
+                    self.session.send({"status": "error", "msg": "The peer did not join the relay."})
+                    return
+                await endpoint.future
+        else:
+            other = partner.protocol
+            for side in (other, self):
+                side.session.send({"action": "relay_ready"})
+            other.start_relay(relay, self)
+            self.start_relay(relay, other)
+            partner.pair(endpoint)
+            log.info("Relay %s <-> %s", *relay.users)
+
+    def connection_lost(self, exc):
+        if exc:
+            log.warning("Conexión perdida con %s: %s", self.addr, exc)
+        if self.relay_to is not None:
+            relay_hub.active.dec()
+            self.relay_to.session.transport.close()
+        connections_open.dec()
+        if heartbeats:
+            heartbeats.remove(self.session)
+        self.writable.set()
+        self.pending.put_nowait(None)
+
+    async def run(self):
+        try:
+            while True:
+                item = await self.pending.get()
+                if item is None:
+                    break
+                flags, payload = item
+                await self.writable.wait()
+                self.session.legacy = bool(flags & protocolo.LEGACY)
+                if payload.get("action") == "relay_join":
+                    await self.relay_join(payload)
+                    break
+                if blocking_request(payload):
+                    # SQLite calls would stall every other connection on the loop
+                    await self.loop.run_in_executor(None, process_request, self.session, payload)
+                else:
+                    process_request(self.session, payload)
+        except Exception as e:
+            log.warning("Conexión perdida con %s: %s", self.addr, e)
+        finally:
+            drop_session(self.session)
+            if self.relay_to is None:
+                self.session.transport.close()
+
+
+def make_listener(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(1024)
+    return s
+
+
+def serve_threads(s):
+    with s:
         while True:
             conn, addr = s.accept()
             threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
 
+
+async def serve_asyncio(s):
+    server = await asyncio.get_running_loop().create_server(ClientProtocol, sock=s)
+    async with server:
+        await server.serve_forever()
+
+
+# SIGTERM unwinds run_worker like Ctrl+C, so its finally block stops the
+# hashing processes and flushes the store.
+def stop_on_signal(signum, frame):
+    raise SystemExit(0)
+
+
+def run_worker(mode, host, port, db_path, metrics_port=METRICS_PORT, relay_rate=None,
+               heartbeat=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, hash_workers=None):
+    global DB_PATH, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, presence, relay_hub, heartbeats, hasher, tokens, peer_keys
+    DB_PATH = db_path
+    init_bd()
+    hasher = credenciales.Hasher(hash_workers)
+    atexit.register(hasher.close)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop_on_signal)
+    tokens = credenciales.SessionTokens()
+    peer_keys = credenciales.PeerKeys()
+    presence = presencia.Presence(PRESENCE_WINDOW)
+    if relay_rate is not None:
+        relay_hub = relevo.RelayHub(metrics, relay_rate)
+    if heartbeat:
+        HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT = heartbeat, heartbeat_timeout
+        heartbeats = latidos.Heartbeats(heartbeat_idle, heartbeat_evict, heartbeat_refresh, heartbeat, heartbeat_timeout)
+        heartbeats.start()
+    s = make_listener(host, port)
+    log.info("Listening on %s:%d (%s, pid %d)", host, port, mode, os.getpid())
+    if metrics_port:
+        try:
+            metricas.serve(metrics, METRICS_HOST, metrics_port)
+            log.info("Metrics on http://%s:%d/metrics", METRICS_HOST, metrics_port)
+        except OSError as e:
+            log.error("Cannot serve metrics on port %d: %s", metrics_port, e)
+    try:
+        if mode == "asyncio":
+            asyncio.run(serve_asyncio(s))
+        else:
+            serve_threads(s)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if heartbeats:
+            heartbeats.stop()
+        hasher.close()
+        presence.stop()
+        store.close()
+
+
+# relay_rate: bytes/s cap per relay (0 = none); None leaves relays off.
+# heartbeat: seconds of silence before a ping (0 = no heartbeats).
+# hash_workers: password hashing processes (None = one per CPU).
+# The server is a single process: online users, presence, session tokens
+# and relays live in its memory and are not shared with other processes.
+def start_server(mode="threads", host=HOST, port=PORT, db_path=DB_PATH, metrics_port=METRICS_PORT, relay_rate=None,
+                 heartbeat=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, hash_workers=None):
+    run_worker(mode, host, port, db_path, metrics_port=metrics_port, relay_rate=relay_rate,
+               heartbeat=heartbeat, heartbeat_timeout=heartbeat_timeout, hash_workers=hash_workers)
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Servidor de encuentro P2P")
+    parser.add_argument("--mode", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="puerto de /metrics en 127.0.0.1 (0 = desactivado)")
+    parser.add_argument("--relay", action="store_true", help="reenviar por el servidor cuando la conexión directa falla")
+    parser.add_argument("--relay-rate", type=int, default=relevo.RELAY_RATE, help="bytes/s por relevo (0 = sin límite)")
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL, help="segundos sin tráfico antes de enviar un ping (0 = desactivado)")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT, help="segundos para responder al ping antes de cerrar la sesión")
+    parser.add_argument("--hash-workers", type=int, help="procesos para calcular hashes de contraseñas (por defecto, uno por CPU)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    start_server(args.mode, args.host, args.port, args.db, args.metrics_port,
+                 args.relay_rate if args.relay else None, args.heartbeat, args.heartbeat_timeout,
+                 args.hash_workers)
@@ -0,0 +1,87 @@
+import os
+import queue
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# LAN discovery reads these when descubrimiento is imported: keep the
+# announcements on loopback, on a port no other run is using.
+os.environ.setdefault("P2P_DISCOVERY_IF", "127.0.0.1")
+os.environ.setdefault("P2P_DISCOVERY_PORT", str(free_port(socket.SOCK_DGRAM)))
+
+import conexiones  # noqa: E402
+
+
+# Waits for the first event of `kind` (its "type" or "action", or a
+# predicate on the event), skipping the others; None on timeout.
+def wait_event(manager, kind, timeout=10):
+    match = kind if callable(kind) else lambda event: kind in (event.get("type"), event.get("action"))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            event = manager.events.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if match(event):
+            return event
+    return None
+
+
+# Starts servidor.py on a free loopback port; extra arguments go to its
+# command line. Yields the (host, port) address.
+@pytest.fixture
+def server(request, tmp_path):
+    marker = request.node.get_closest_marker("server_args")
+    port = free_port()
+    cmd = [sys.executable, os.path.join(ROOT, "servidor.py"), "--host", "127.0.0.1", "--port", str(port),
+           "--db", str(tmp_path / "users.db"), "--metrics-port", "0", "--hash-workers", "1", "--log-level", "WARNING"]
+    proc = subprocess.Popen(cmd + list(marker.args if marker else ()), cwd=tmp_path)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                pytest.fail("the server did not start")
+            time.sleep(0.05)
+    yield ("127.0.0.1", port)
+    proc.terminate()
+    proc.wait(10)
+
+
+# Registers and logs in a ConnectionManager; closed after the test.
+@pytest.fixture
+def client(server, tmp_path):
+    managers = []
+
+    def make(username, **kwargs):
+        conexiones.register(server, username, "secreto")
+        manager = conexiones.ConnectionManager(server, username, free_port(), free_port(), str(tmp_path / "descargas"),
+                                               **kwargs)
+        ok, msg = manager.login("secreto")
+        assert ok, msg
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        manager.close()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "server_args(*args): extra servidor.py arguments for the server fixture")
@@ -0,0 +1,79 @@
+import os
+import socket
+import threading
+import time
+
+import conexiones
+import protocolo
+from conftest import wait_event
+
+
+def linked(client):
+    ana = client("ana")
+    beto = client("beto")
+    ana.connect("beto")
+    assert wait_event(ana, "peer_connected")["username"] == "beto"
+    assert wait_event(beto, "peer_connected")["username"] == "ana"
+    return ana, beto
+
+
+# A host that reaches beto's port and claims to be ana (who wins the
+# tie-break) must not take over the link, with or without a made-up proof.
+def test_unverified_hello_does_not_replace_a_live_link(client):
+    ana, beto = linked(client)
+    link = beto.peers_snapshot()["ana"]
+    for proof in (None, {"expires": int(time.time()) + 60, "answer": "inventada"}):
+        hello = {"type": "hello", "from": "ana", "caps": {}, "nonce": f"{int(time.time())}.x{id(proof)}"}
+        if proof:
+            hello["proof"] = proof
+        with socket.create_connection(("127.0.0.1", beto.tcp_port)) as sock:
+            protocolo.send(sock, hello)
+            sock.settimeout(2)
+            assert sock.recv(1) == b""  # refused and closed
+        assert beto.peers_snapshot()["ana"] == link
+    assert beto.send_text("ana", "sigo aquí")
+    assert wait_event(ana, lambda e: e.get("text") == "sigo aquí")
+
+
+# The chunks go out on the link's writer thread, but a progress callback
+# (a Streamlit progress bar) has to run on the thread that sent the file.
+def test_send_progress_runs_on_the_callers_thread(client, tmp_path):
+    ana, beto = linked(client)
+    path = tmp_path / "datos.bin"
+    path.write_bytes(os.urandom(300_000))
+    calls = []
+    assert ana.send_file("beto", str(path), progress=lambda tid, done, total: calls.append((threading.get_ident(), done)))
+    assert {thread for thread, _ in calls} == {threading.get_ident()}
+    assert calls[-1][1] == 300_000
+    assert wait_event(beto, "file")["size"] == 300_000
+
+
+# Two Streamlit tabs of one user share a manager: each gets every event,
+# and the last one to leave is the one that may close it.
+def test_every_subscriber_gets_every_event():
+    events = conexiones.EventQueue()
+    events.put({"type": "text", "text": "antes"})
+    first = events.subscribe()
+    second = events.subscribe()
+    events.put({"type": "text", "text": "después"})
+    assert [e["text"] for e in (first.get_nowait(), first.get_nowait())] == ["antes", "después"]
+    assert second.get_nowait()["text"] == "después" and second.empty()
+    assert events.empty()
+    assert events.unsubscribe(first) == 1
+    assert events.unsubscribe(second) == 0
+    events.put({"type": "text", "text": "sin nadie"})
+    assert events.get_nowait()["text"] == "sin nadie"
+
+
+# Only chat messages come from peers; the manager's own event types
+# (a file "received" from any local path, a fake connection) do not.
+def test_peer_cannot_post_internal_events(client):
+    ana, beto = linked(client)
+    sock = ana._peer_sock("beto")
+    for forged in ({"type": "file", "from": "ana", "path": "/etc/passwd", "mime": "image/png"},
+                   {"type": "peer_connected", "username": "carla"},
+                   {"type": "file_progress", "transfer_id": "x", "done": 1, "total": 1}):
+        protocolo.send(sock, forged)
+    protocolo.send(sock, {"type": "text", "from": "carla", "text": "hola", "path": "/etc/passwd"})
+    event = wait_event(beto, lambda e: e.get("type") != "text" or e.get("text") == "hola")
+    assert event["type"] == "text" and event["from"] == "ana" and "path" not in event
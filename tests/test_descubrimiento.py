@@ -0,0 +1,108 @@
+import json
+import socket
+import threading
+import time
+
+import conexiones
+import descubrimiento
+import protocolo
+from conftest import wait_event
+
+
+def wait_cached(manager, username, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        entry = manager.discovery.lookup(username)
+        if entry is not None:
+            return entry
+        time.sleep(0.05)
+    return None
+
+
+def announce(username, tcp_port):
+    sock = descubrimiento.open_socket()
+    try:
+        message = {"type": "announce", "username": username, "tcp_port": tcp_port, "udp_port": None}
+        sock.sendto(json.dumps(message).encode(), (descubrimiento.DISCOVERY_ADDR, descubrimiento.DISCOVERY_PORT))
+    finally:
+        sock.close()
+
+
+# A host on the LAN that claims to be someone else. `answer(hello)`
+# returns its hello_ack.
+def impostor(answer):
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            for flags, body in protocolo.FrameReader(conn):
+                protocolo.send(conn, answer(protocolo.decode(flags, body)))
+                break
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+
+def test_discovery_is_opt_in(client):
+    assert client("ana").discovery is None
+
+
+def test_lan_connect_skips_the_server(client):
+    ana = client("ana", lan_discovery=True)
+    beto = client("beto", lan_discovery=True)
+
+    assert wait_cached(ana, "beto") == ("127.0.0.1", beto.tcp_port, beto.udp_port)
+    ana.connect("beto")
+    assert wait_event(ana, "peer_connected") == {"type": "peer_connected", "username": "beto", "relayed": False}
+    assert "beto" not in ana.pending_connects  # no connect_to_peer was sent
+    assert wait_event(beto, "text")["text"] == "[conexion directa establecida]"
+    assert ana.send_text("beto", "hola")
+    assert wait_event(beto, "text")["text"] == "hola"
+
+
+def test_spoofed_announcement_is_rejected(client):
+    ana = client("ana", lan_discovery=True)
+    carla = client("carla")
+    fake = impostor(lambda hello: {"type": "hello_ack", "from": "carla", "caps": {},
+                                   "proof": {"expires": int(time.time()) + 60, "answer": "inventada"}})
+    try:
+        announce("carla", fake.getsockname()[1])
+        assert wait_cached(ana, "carla")[1] == fake.getsockname()[1]
+        ana.connect("carla")
+        assert "sin poder demostrarlo" in wait_event(ana, "error")["content"]
+        # The server's peer_info leads to the real carla instead.
+        assert wait_event(ana, "peer_connected")["username"] == "carla"
+        assert ana.peers_snapshot()["carla"] == ("127.0.0.1", carla.tcp_port)
+    finally:
+        fake.close()
+
+
+# The impostor dials the real beto with the dialer's nonce and forwards his
+# genuine answer; it is bound to beto's address, so it does not check out
+# for the impostor's. (ana's own proof is dropped on the way: beto would
+# not trust it, as it was made for the impostor's address.)
+def test_relayed_answer_is_rejected(client):
+    ana = client("ana", lan_discovery=True)
+    beto = client("beto")
+
+    def relay(hello):
+        hello.pop("proof")
+        sock, _, ack = conexiones.request(("127.0.0.1", beto.tcp_port), hello)
+        sock.close()
+        return ack
+
+    fake = impostor(relay)
+    try:
+        announce("beto", fake.getsockname()[1])
+        assert wait_cached(ana, "beto")[1] == fake.getsockname()[1]
+        ana.connect("beto")
+        assert "sin poder demostrarlo" in wait_event(ana, "error")["content"]
+        assert wait_event(ana, "peer_connected")["username"] == "beto"
+        assert ana.peers_snapshot()["beto"] == ("127.0.0.1", beto.tcp_port)
+    finally:
+        fake.close()
+
@@ -0,0 +1,30 @@
+import conexiones
+from conftest import wait_event
+
+
+def test_offline_text_is_delivered_on_login(server, client):
+    conexiones.register(server, "beto", "secreto")
+    ana = client("ana")
+    ana.send_offline("beto", "hola")
+    assert wait_event(ana, lambda event: event.get("msg") == "Queued")
+
+    beto = client("beto")
+    event = wait_event(beto, "text")
+    assert event["from"] == "ana" and event["text"] == "hola" and event["offline"]
+
+
+# Only text is stored: anything else would reach the recipient's UI as an
+# event of the sender's choosing.
+def test_offline_message_must_be_text(server, client):
+    conexiones.register(server, "beto", "secreto")
+    ana = client("ana")
+    ana.send_server({"action": "send_offline", "to": "beto",
+                     "message": {"type": "file", "path": "/etc/passwd", "name": "x.png"}})
+    assert wait_event(ana, lambda event: event.get("msg") == "Only text messages can be stored.")
+    ana.send_server({"action": "send_offline", "to": "beto",
+                     "message": {"type": "text", "text": "hola", "from": "carla", "path": "/etc/passwd"}})
+    assert wait_event(ana, lambda event: event.get("msg") == "Queued")
+
+    beto = client("beto")
+    event = wait_event(beto, "text")
+    assert event == {"type": "text", "from": "ana", "text": "hola", "ts": event["ts"], "offline": True}
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from conftest import wait_event
+
+
+@pytest.mark.server_args("--relay")
+def test_relay_round_trip(client, tmp_path):
+    ana = client("ana", force_relay=True, lan_discovery=False)
+    beto = client("beto", force_relay=True, lan_discovery=False)
+
+    ana.connect("beto")
+    assert wait_event(ana, "peer_connected") == {"type": "peer_connected", "username": "beto", "relayed": True}
+    assert wait_event(beto, "peer_connected")["relayed"]
+
+    assert wait_event(beto, "text")["text"] == "[conexion por relevo del servidor]"
+    assert ana.send_text("beto", "hola")
+    assert wait_event(beto, "text")["text"] == "hola"
+    assert beto.send_text("ana", "qué tal")
+    assert wait_event(ana, "text")["text"] == "qué tal"
+
+    data = os.urandom(200_000)
+    path = tmp_path / "foto.bin"
+    path.write_bytes(data)
+    assert ana.send_file("beto", str(path))
+    received = wait_event(beto, "file")
+    assert received["from"] == "ana" and received["size"] == len(data)
+    with open(received["path"], "rb") as f:
+        assert f.read() == data
+
+
+def test_relay_disabled(client):
+    ana = client("ana", force_relay=True, lan_discovery=False)
+    client("beto", force_relay=True, lan_discovery=False)
+
+    ana.connect("beto")
+    reply = wait_event(ana, lambda event: event.get("status") == "error", timeout=15)
+    assert reply["msg"] == "Relay is not enabled on this server."
+    assert "beto" not in ana.peers_snapshot()
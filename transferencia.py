@@ -0,0 +1,285 @@
+import glob
+import hashlib
+import mimetypes
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import canales
+import protocolo
+
+# Binary chunk frame body: 16-byte transfer id + 8-byte offset + raw data.
+CHUNK = struct.Struct("!16sQ")
+DEFAULT_CHUNK_SIZE = 64 * 1024
+ACCEPT_TIMEOUT = 5  # seconds to wait for file_accept before giving up
+ENCODED_CACHE_BYTES = 16 * 1024 * 1024
+DIGEST_CACHE_SIZE = 1024
+
+CONTROL_TYPES = ("file_offer", "file_accept", "file_end")
+
+
+# file_* messages go on the link's CONTROL channel, so the reader thread
+# that answers an offer never writes to the socket itself.
+def send_control(sock, payload):
+    link = canales.get(sock)
+    if link is not None:
+        link.send(payload, canales.CONTROL)
+    else:
+        protocolo.send(sock, payload)
+
+
+def content_id(source):
+    h = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+    else:
+        h.update(source)
+    return h.hexdigest()
+
+
+# Sends and receives files over a peer link. The sender offers the file
+# (name, size, content hash); the receiver answers with the offset it
+# already holds in its spool directory, so an interrupted transfer resumes
+# where it stopped, or with the full size when it already has that content
+# under any name, so nothing is sent. Data then goes as BINARY frames,
+# straight from the file with socket.sendfile or from a memoryview of the
+# in-memory upload. A receive that fails (a chunk outside the offered
+# size, content that does not match its id) is dropped with its partial
+# file and reported through on_error(meta, reason).
+class Transfers:
+    def __init__(self, spool_dir, on_progress=None, progress_step=0.1, on_error=None):
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.progress_step = progress_step
+        self.lock = threading.Lock()
+        self.waiting = {}   # (sock, transfer_id) -> [Event, offset]
+        self.incoming = {}  # (sock, raw id) -> receive state
+        self.digests = {}   # (path, size, mtime_ns) -> content id of files already hashed
+        self.encoded = OrderedDict()  # (content id, encoding) -> bytes, LRU
+        self.encoded_size = 0
+        self.encoded_budget = ENCODED_CACHE_BYTES
+
+    # Content id of a file is cached by path, size and mtime, so offering
+    # the same file to several peers hashes it once.
+    def digest(self, source):
+        if not isinstance(source, str):
+            return content_id(source)
+        st = os.stat(source)
+        key = (os.path.abspath(source), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            tid = self.digests.get(key)
+        if tid is None:
+            tid = content_id(source)
+            with self.lock:
+                if len(self.digests) >= DIGEST_CACHE_SIZE:
+                    del self.digests[next(iter(self.digests))]
+                self.digests[key] = tid
+        return tid
+
+    # Encoded forms of a payload (base64 for old peers, compressed bodies)
+    # by content id, so the same file sent to many peers is encoded once.
+    # build() is only called on a miss; the cache is an LRU bounded by
+    # encoded_budget bytes.
+    def encode_cached(self, tid, encoding, build):
+        key = (tid, encoding)
+        with self.lock:
+            data = self.encoded.get(key)
+            if data is not None:
+                self.encoded.move_to_end(key)
+                return data
+        data = build()
+        if len(data) <= self.encoded_budget:
+            with self.lock:
+                if key not in self.encoded:
+                    self.encoded[key] = data
+                    self.encoded_size += len(data)
+                    while self.encoded_size > self.encoded_budget:
+                        _, old = self.encoded.popitem(last=False)
+                        self.encoded_size -= len(old)
+        return data
+
+    def send(self, sock, source, meta, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, timeout=ACCEPT_TIMEOUT):
+        if chunk_size + CHUNK.size >= protocolo.MAX_FRAME:
+            raise ValueError("chunk_size too large")
+        tid = self.digest(source)
+        size = os.path.getsize(source) if isinstance(source, str) else len(source)
+        waiter = [threading.Event(), 0]
+        with self.lock:
+            self.waiting[(sock, tid)] = waiter
+        try:
+            offer = dict(meta, type="file_offer", transfer_id=tid, size=size)
+            if not meta.get("mime"):
+                offer["mime"] = mimetypes.guess_type(meta.get("name", ""))[0] or "application/octet-stream"
+            send_control(sock, offer)
+            if not waiter[0].wait(timeout):
+                return False
+        finally:
+            with self.lock:
+                self.waiting.pop((sock, tid), None)
+
+        offset = min(waiter[1], size)
+        raw_id = bytes.fromhex(tid)[:16]
+        # On a scheduled link the chunks share the socket with chat and
+        # other transfers; otherwise they are written here back to back.
+        link = canales.get(sock)
+        if link is not None:
+            chunk_size = min(chunk_size, link.frame_cap)
+        # The chunks may be written on the link's writer thread; progress
+        # is reported from this one, so a UI callback runs where it was made.
+        sent = [offset]
+        reported = [None]
+
+        def tick():
+            if progress and sent[0] != reported[0]:
+                reported[0] = sent[0]
+                progress(tid, sent[0], size)
+
+        tick()
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                self._run(link, self._chunks(sock, raw_id, f, size, offset, chunk_size, sent), tick)
+        else:
+            self._run(link, self._chunks(sock, raw_id, memoryview(source), size, offset, chunk_size, sent), tick)
+        send_control(sock, {"type": "file_end", "transfer_id": tid})
+        return True
+
+    @staticmethod
+    def _run(link, frames, tick):
+        if link is not None:
+            link.stream(frames, tick=tick)
+        else:
+            for _ in frames:
+                tick()
+
+    # Writes one chunk frame per step; sent[0] follows the offset.
+    def _chunks(self, sock, raw_id, source, size, offset, chunk_size, sent):
+        while offset < size:
+            n = min(chunk_size, size - offset)
+            header = protocolo.HEADER.pack(CHUNK.size + n, protocolo.BINARY) + CHUNK.pack(raw_id, offset)
+            with protocolo.send_lock(sock):
+                sock.sendall(header)
+                if isinstance(source, memoryview):
+                    sock.sendall(source[offset:offset + n])
+                else:
+                    sock.sendfile(source, offset, n)
+            offset += n
+            sent[0] = offset
+            yield
+
+    def _paths(self, payload):
+        tid = payload["transfer_id"]
+        ext = os.path.splitext(payload.get("name", ""))[1]
+        final = os.path.join(self.spool_dir, tid + ext)
+        return final, final + ".part"
+
+    # A complete file with this content id, whatever its extension.
+    def _existing(self, tid, final):
+        if os.path.exists(final):
+            return final
+        for path in glob.glob(os.path.join(glob.escape(self.spool_dir), tid + ".*")):
+            if not path.endswith((".part", ".tmp")):
+                return path
+        return None
+
+    # Handles a file_* control message. Returns the completed-file message
+    # for the application on file_end, None otherwise.
+    def handle_control(self, sock, payload):
+        kind = payload.get("type")
+        tid = payload.get("transfer_id", "")
+
+        if kind == "file_accept":
+            with self.lock:
+                waiter = self.waiting.get((sock, tid))
+            if waiter:
+                waiter[1] = int(payload.get("offset", 0))
+                waiter[0].set()
+
+        elif kind == "file_offer":
+            raw_id = bytes.fromhex(tid)[:16]
+            size = int(payload["size"])
+            final, part = self._paths(payload)
+            existing = self._existing(tid, final)
+            if existing:
+                offset = size
+                fd = None
+                final = existing
+            else:
+                fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+                offset = os.fstat(fd).st_size
+                if offset > size:
+                    os.ftruncate(fd, 0)
+                    offset = 0
+            state = {"meta": payload, "fd": fd, "received": offset, "reported": offset, "size": size, "path": final}
+            with self.lock:
+                old = self.incoming.get((sock, raw_id))
+                self.incoming[(sock, raw_id)] = state
+            # A repeated offer (the sender timed out waiting for our accept)
+            # replaces the earlier receive; its partial file is the one just
+            # reopened.
+            if old is not None and old["fd"] is not None:
+                os.close(old["fd"])
+            send_control(sock, {"type": "file_accept", "transfer_id": tid, "offset": offset})
+
+        elif kind == "file_end":
+            with self.lock:
+                state = self.incoming.pop((sock, bytes.fromhex(tid)[:16]), None)
+            if state is None:
+                return None
+            final, part = state["path"], self._paths(state["meta"])[1]
+            if state["fd"] is not None:
+                os.close(state["fd"])
+                if content_id(part) != tid:
+                    self._fail(state, part, "corrupt")
+                    return None
+                os.replace(part, final)
+            meta = state["meta"]
+            return {"type": "file", "from": meta.get("from"), "name": meta.get("name"),
+                    "caption": meta.get("caption", ""), "mime": meta.get("mime"),
+                    "size": state["size"], "path": final, "ts": meta.get("ts", time.time())}
+        return None
+
+    def handle_chunk(self, sock, body):
+        raw_id, offset = CHUNK.unpack_from(body)
+        with self.lock:
+            state = self.incoming.get((sock, raw_id))
+        if state is None or state["fd"] is None:
+            return
+        data = body[CHUNK.size:]
+        if offset + len(data) > state["size"]:
+            with self.lock:
+                if self.incoming.get((sock, raw_id)) is state:
+                    del self.incoming[(sock, raw_id)]
+            os.close(state["fd"])
+            self._fail(state, self._paths(state["meta"])[1], "out of range")
+            return
+        os.pwrite(state["fd"], data, offset)
+        state["received"] = offset + len(data)
+        if self.on_progress:
+            size = state["size"]
+            if state["received"] - state["reported"] >= size * self.progress_step or state["received"] == size:
+                state["reported"] = state["received"]
+                self.on_progress(state["meta"], state["received"], size)
+
+    def _fail(self, state, part, reason):
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        if self.on_error:
+            self.on_error(state["meta"], reason)
+
+    # Closes the partial files of a link that went away; they stay in the
+    # spool directory so the next offer resumes them.
+    def drop(self, sock):
+        with self.lock:
+            keys = [k for k in self.incoming if k[0] is sock]
+            states = [self.incoming.pop(k) for k in keys]
+        for state in states:
+            if state["fd"] is not None:
+                os.close(state["fd"])